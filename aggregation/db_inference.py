@@ -1,11 +1,105 @@
 # Inference routines that should run in the background
 import schema
-from util import majorityVote
 import importlib
 inf_mod = importlib.import_module("crowd-estimate.em")
-from app import user_datastore
+from aggregation import sparse_em
+from app import app, user_datastore
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from collections import namedtuple
+import numpy as np
 import datetime
 
+# Votes loaded by load_votes. worker_ids and question_ids are the distinct
+# ObjectIds in order of first appearance; workers and questions index into
+# them for each vote, and values holds the answer values.
+Votes = namedtuple('Votes', ['worker_ids', 'question_ids', 'workers',
+                             'questions', 'values'])
+
+def load_votes(query, batch_size=None):
+    """
+    Load the worker, question and value of every answer matching a raw
+    Mongo query through a single cursor. Only those three fields are
+    fetched and references are kept as ObjectIds, so no worker or
+    question document is dereferenced.
+
+    Returns Votes.
+    """
+    if batch_size is None:
+        batch_size = app.config.get('INFERENCE_VOTE_BATCH_SIZE', 10000)
+    cursor = schema.answer.Answer._get_collection().find(
+        query, {'_id' : False, 'worker' : True, 'question' : True,
+                'value' : True}).batch_size(batch_size)
+
+    w_index = {}
+    q_index = {}
+    worker_ids = []
+    question_ids = []
+    workers = []
+    questions = []
+    values = []
+    for answer in cursor:
+        w = answer.get('worker')
+        q = answer.get('question')
+        if w not in w_index:
+            w_index[w] = len(worker_ids)
+            worker_ids.append(w)
+        if q not in q_index:
+            q_index[q] = len(question_ids)
+            question_ids.append(q)
+        workers.append(w_index[w])
+        questions.append(q_index[q])
+        values.append(answer.get('value'))
+    return Votes(worker_ids, question_ids, np.array(workers, dtype=np.intp),
+                 np.array(questions, dtype=np.intp), values)
+
+def task_query(task_id, **kwargs):
+    """
+    Raw Mongo query for the answers of a task, with extra field conditions.
+    """
+    query = {'task' : ObjectId(str(task_id))}
+    query.update(kwargs)
+    return query
+
+def majority_votes(task_id=None, question_ids=None):
+    """
+    Majority vote of every question of a task, or of the given questions,
+    computed by a single Mongo aggregation. Answers without a value are
+    ignored. Ties go to the smallest value.
+
+    Returns:
+        results - dict {q.id : {'label' : majority_vote_label,
+                                'count' : votes for the label,
+                                'counts' : {value : votes}}}
+        for each question with at least one vote
+    """
+    match = {'value' : {'$ne' : None}}
+    if task_id is not None:
+        match['task'] = ObjectId(str(task_id))
+    if question_ids is not None:
+        match['question'] = {'$in' : [ObjectId(str(q_id)) for
+                                      q_id in question_ids]}
+    pipeline = [
+        {'$match' : match},
+        {'$group' : {'_id' : {'question' : '$question', 'value' : '$value'},
+                     'count' : {'$sum' : 1}}},
+        {'$sort' : {'count' : -1, '_id.value' : 1}},
+        {'$group' : {'_id' : '$_id.question',
+                     'label' : {'$first' : '$_id.value'},
+                     'count' : {'$first' : '$count'},
+                     'counts' : {'$push' : {'value' : '$_id.value',
+                                            'count' : '$count'}}}}]
+
+    results = {}
+    for doc in schema.answer.Answer._get_collection().aggregate(
+            pipeline, allowDiskUse=True):
+        results[str(doc['_id'])] = {
+            'label' : doc['label'],
+            'count' : doc['count'],
+            'counts' : {c['value'] : c['count'] for c in doc['counts']}}
+    return results
+
 def aggregate_task_majority_vote(task_id):
     """
     Assign majority vote labels to each question in the task.
@@ -14,20 +108,20 @@ def aggregate_task_majority_vote(task_id):
         results - dict {q.id : majority_vote_label for each question q}
         with -1 if there were no votes on the question
     """
-    questions = schema.question.Question.objects(task = task_id)
+    questions = schema.question.Question._get_collection().find(
+        {'task' : ObjectId(str(task_id))}, {'name' : True})
+    votes = majority_votes(task_id=task_id)
 
     labels = dict()
 
     for question in questions:
-        answers = schema.answer.Answer.objects(question = question)
-        q_id = str(question.id)
-        ballot = [answer.value for answer in answers]
-        if len(ballot) == 0:
-            print "mv -1 (no votes) on question = ", q_id, question.name
+        q_id = str(question['_id'])
+        if q_id not in votes:
+            print "mv -1 (no votes) on question = ", q_id, question.get('name')
             labels[q_id] = -1
         else:
-            mv = majorityVote(ballot)[0]
-            print "mv on question = ", q_id, question.name, ballot, mv
+            mv = votes[q_id]['label']
+            print "mv on question = ", q_id, question.get('name'), votes[q_id]['counts'], mv
             labels[q_id] = mv
 
     print labels
@@ -36,13 +130,20 @@ def aggregate_task_majority_vote(task_id):
 # TODO Should be part of a background process that periodicallly runs EM 
 # on each task in the database
 #NOTE Assumes all questions are binary
-def aggregate_task_EM(task_id):
+def aggregate_task_EM(task_id, incremental=False, engine='crowd-estimate'):
     """
     Within a given task, use the Expectation Maximization algorithm to
     estimate worker skills and question label probabilities + difficulties.
     Only uses the data contained in the task, i.e. does not use any
     worker history that might be elsewhere in our database.
 
+    If incremental, only re-estimates around the answers completed since
+    the last run (see run_em_incremental), falling back to a full run
+    when that is not possible.
+
+    engine is 'crowd-estimate' for the crowd-estimate module or 'sparse'
+    for aggregation.sparse_em.
+
     Returns:
         result - dict {
         'posteriors': dict {q.id : EM_posterior_estimate for each question q},
@@ -52,53 +153,219 @@ def aggregate_task_EM(task_id):
     """
     print "Agg Task EM called, getting answer objects", datetime.datetime.utcnow()
 
+    #Answer.complete_time is local time
+    run_start = datetime.datetime.now()
+
     #get all completed answers from the task
     answers = schema.answer.Answer.objects(task = task_id, status='Completed')
 
     #debug time taken by EM run
     print "Agg Task EM start em", datetime.datetime.utcnow()
 
-    result = run_em(answers)
+    result = None
+    if incremental:
+        result, changed = run_em_incremental(task_id, answers, engine)
+    if result is None:
+        result = run_em(load_votes(task_query(task_id, status='Completed')),
+                        engine)
+        changed = result
 
     # Write to DB
-    write_success = write_em(result)
+    write_counts = write_em(changed)
 
-    if not write_success:
+    if write_counts is None:
         return {'error': 'failure when writing inference results to DB'}
+    print "Agg Task EM wrote %(written)d estimates, skipped %(skipped)d unchanged" % write_counts
+
+    #Remember what this run covered for the next incremental run. Worker
+    #estimates written after timestamp (UTC, as in inference_results)
+    #come from EM runs of other tasks.
+    num_answers = answers.filter(complete_time__lte=run_start).count()
+    schema.task.Task.objects(id=task_id).update_one(
+        set__inference_state__EM={'complete_time' : run_start,
+                                  'num_answers' : num_answers,
+                                  'timestamp' : str(datetime.datetime.utcnow())})
 
     #debug time taken by EM run
     print "Agg Task EM ret", datetime.datetime.utcnow()
 
     return result
 
-def run_em(answers):
+def run_em_incremental(task_id, answers, engine='crowd-estimate'):
+    """
+    Re-estimate only the questions and workers of answers completed since
+    the last EM run of the task, seeding EM with the stored estimates.
+
+    Each round runs EM on every vote of the active questions and workers
+    and keeps their new estimates (the 'sparse' engine also keeps the
+    estimates of the others fixed). Workers and questions connected to an
+    estimate that moved by more than EM_INCREMENTAL_TOLERANCE become
+    active in the next round, for at most EM_INCREMENTAL_MAX_ROUNDS rounds.
+
+    Returns tuple (result for the whole task, result for the re-estimated
+    questions and workers only), or (None, None) if a full run is needed:
+    no previous run, answers completed without a complete_time or removed
+    since, worker skills re-estimated by another task's EM run since, or a
+    neighbourhood of more than EM_INCREMENTAL_MAX_FRACTION of the votes.
     """
-    Loads Answer DB objects into inference module (EM) format,
+    tolerance = app.config.get('EM_INCREMENTAL_TOLERANCE', 0.01)
+    max_rounds = app.config.get('EM_INCREMENTAL_MAX_ROUNDS', 5)
+    max_fraction = app.config.get('EM_INCREMENTAL_MAX_FRACTION', 0.5)
+
+    task = schema.task.Task.objects.only('inference_state').get(id=task_id)
+    state = (task.inference_state or {}).get('EM')
+    if state is None or state.get('timestamp') is None:
+        return None, None
+
+    num_total = answers.count()
+    num_old = answers.filter(complete_time__lte=state['complete_time']).count()
+    new_votes = load_votes(task_query(
+        task_id, status='Completed',
+        complete_time={'$gt' : state['complete_time']}))
+    if (num_old != state['num_answers'] or
+        num_old + len(new_votes.values) != num_total):
+        print "EM incremental: answers changed since last run, full run"
+        return None, None
+    print "EM incremental: %d new answers" % len(new_votes.values)
+
+    #Stored estimates of the whole task
+    posteriors = {}
+    difficulties = {}
+    for q in schema.question.Question.objects(task=task_id).only(
+            'inference_results').as_pymongo():
+        em = q.get('inference_results', {}).get('EM')
+        if em is not None:
+            posteriors[str(q['_id'])] = em['posterior']
+            difficulties[str(q['_id'])] = em['difficulty']
+    w_ids = schema.answer.Answer._get_collection().distinct(
+        'worker', {'task' : ObjectId(str(task_id)), 'status' : 'Completed'})
+    skills = {str(w_id) : None for w_id in w_ids}
+    for w in schema.worker.Worker.objects(id__in=w_ids).only(
+            'inference_results').as_pymongo():
+        em = w.get('inference_results', {}).get('EM')
+        if em is not None:
+            #Worker estimates are shared by all tasks. Those of another
+            #task's run must not seed or stay fixed in this one.
+            if em.get('timestamp', '') > state['timestamp']:
+                print "EM incremental: worker skills changed by another task, full run"
+                return None, None
+            skills[str(w['_id'])] = em['skill']
+
+    def moved(old, new):
+        return old is None or abs(new - old) > tolerance
+
+    active_q = set(new_votes.question_ids)
+    active_w = set(new_votes.worker_ids)
+    changed_q = set()
+    changed_w = set()
+    for i in range(max_rounds):
+        if len(active_q) == 0 and len(active_w) == 0:
+            break
+        votes = load_votes(task_query(
+            task_id, status='Completed',
+            **{'$or' : [{'question' : {'$in' : list(active_q)}},
+                        {'worker' : {'$in' : list(active_w)}}]}))
+        if len(votes.values) > max_fraction * num_total:
+            print "EM incremental: neighbourhood too large, full run"
+            return None, None
+
+        em_workers = {}
+        for w_oid in votes.worker_ids:
+            w_id = str(w_oid)
+            em_workers[w_id] = {'skill': skills.get(w_id)}
+            if engine == 'sparse':
+                em_workers[w_id]['fixed'] = (
+                    w_oid not in active_w and skills.get(w_id) is not None)
+        em_questions = {}
+        for q_oid in votes.question_ids:
+            q_id = str(q_oid)
+            em_questions[q_id] = {'difficulty': difficulties.get(q_id)}
+            if engine == 'sparse':
+                em_questions[q_id]['fixed'] = (
+                    q_oid not in active_q and difficulties.get(q_id) is not None)
+        em_votes = em_vote_dict(votes)
+        if engine == 'sparse':
+            res = sparse_em.estimate(em_votes, em_workers, em_questions)
+        else:
+            res = inf_mod.estimate(em_votes, em_workers, em_questions)
+
+        #Only active questions and workers had all their votes in this run
+        moved_q = np.zeros(len(votes.question_ids), dtype=bool)
+        moved_w = np.zeros(len(votes.worker_ids), dtype=bool)
+        for (q, q_oid) in enumerate(votes.question_ids):
+            if q_oid not in active_q:
+                continue
+            q_id = str(q_oid)
+            moved_q[q] = (moved(difficulties.get(q_id), res['questions'][q_id]) or
+                          moved(posteriors.get(q_id), res['posteriors'][q_id]))
+            difficulties[q_id] = res['questions'][q_id]
+            posteriors[q_id] = res['posteriors'][q_id]
+            changed_q.add(q_id)
+        for (w, w_oid) in enumerate(votes.worker_ids):
+            if w_oid not in active_w:
+                continue
+            w_id = str(w_oid)
+            moved_w[w] = moved(skills.get(w_id), res['workers'][w_id])
+            skills[w_id] = res['workers'][w_id]
+            changed_w.add(w_id)
+
+        #Voters on moved questions and questions of moved workers
+        next_w = set(votes.worker_ids[w] for w in
+                     np.unique(votes.workers[moved_q[votes.questions]]))
+        next_q = set(votes.question_ids[q] for q in
+                     np.unique(votes.questions[moved_w[votes.workers]]))
+
+        next_q -= active_q
+        next_w -= active_w
+        print "EM incremental round %d: %d votes, %d questions and %d workers moved on" % (
+            i, len(votes.values), len(next_q), len(next_w))
+        if len(next_q) == 0 and len(next_w) == 0:
+            break
+        active_q |= next_q
+        active_w |= next_w
+
+    result = {'posteriors' : posteriors,
+              'workers' : {w_id : skill for (w_id, skill) in
+                           skills.iteritems() if skill is not None},
+              'questions' : difficulties}
+    changed = {'posteriors' : {q_id : posteriors[q_id] for q_id in changed_q},
+               'workers' : {w_id : skills[w_id] for w_id in changed_w},
+               'questions' : {q_id : difficulties[q_id] for q_id in changed_q}}
+    return result, changed
+
+def em_vote_dict(votes):
+    """
+    Votes in the inference module (EM) format, {(w.id, q.id) : {'vote' : 0 or 1}}
+    """
+    w_ids = [str(w_oid) for w_oid in votes.worker_ids]
+    q_ids = [str(q_oid) for q_oid in votes.question_ids]
+    return {(w_ids[w], q_ids[q]) : {'vote' : int(value)} for (w, q, value) in
+            zip(votes.workers.tolist(), votes.questions.tolist(), votes.values)}
+
+def run_em(votes, engine='crowd-estimate'):
+    """
+    Loads votes into inference module (EM) format,
     runs EM, returns the result.
 
-    answers argument: sequence of Answer objects on which to run EM.
+    votes argument: Votes (see load_votes) on which to run EM.
+    engine argument: 'crowd-estimate' or 'sparse', see run_sparse_em.
     """
+    if engine == 'sparse':
+        return run_sparse_em(votes)
+
     print "run_em called", datetime.datetime.utcnow()
 
     # reformat for EM
-    em_votes = {}
-    em_workers = {}
-    em_questions = {}
-    for answer in answers:
-        w_id = str(answer.worker.id)
-        q_id = str(answer.question.id)
-        label = int(answer.value)
-        em_votes[(w_id,q_id)] = {'vote':label}
-        #NOTE overwriting with default value repeatedly
-        #TODO allow using prev q.inference_results and/or gold data as initial estimates
-        em_workers[w_id] = {'skill': None}
-        em_questions[q_id] = {'difficulty': None} 
-    
+    #TODO allow using prev q.inference_results and/or gold data as initial estimates
+    em_votes = em_vote_dict(votes)
+    em_workers = {str(w_oid) : {'skill': None} for w_oid in votes.worker_ids}
+    em_questions = {str(q_oid) : {'difficulty': None} for
+                    q_oid in votes.question_ids}
+
     print "run_em loaded data", datetime.datetime.utcnow()
 
-    print "em_votes", em_votes
-    print "em_workers", em_workers
-    print "em_questions", em_questions
+    print "run_em: %d votes, %d workers, %d questions" % (
+        len(em_votes), len(em_workers), len(em_questions))
     start = datetime.datetime.utcnow()
     res = inf_mod.estimate(em_votes, em_workers, em_questions)
     end = datetime.datetime.utcnow()
@@ -106,11 +373,50 @@ def run_em(answers):
 
     return res
 
-def write_em(res):
-    """Write inference results to DB.
+def run_sparse_em(votes):
+    """
+    Same as run_em, but runs the vectorized aggregation.sparse_em directly
+    on the vote arrays. As in run_em, only the last vote of a worker on a
+    question counts.
+    """
+    print "run_sparse_em called", datetime.datetime.utcnow()
 
-    Returns True if all data successfully written, False otherwise
+    workers = votes.workers
+    questions = votes.questions
+    values = np.array(votes.values).astype(np.int64)
+
+    #keep the last vote of each (worker, question) pair
+    pairs = workers * len(votes.question_ids) + questions
+    _, last = np.unique(pairs[::-1], return_index=True)
+    last = len(pairs) - 1 - last
+
+    start = datetime.datetime.utcnow()
+    posteriors, skills, difficulties = sparse_em.estimate_arrays(
+        workers[last], questions[last], values[last], len(votes.worker_ids),
+        len(votes.question_ids))
+    end = datetime.datetime.utcnow()
+    print "Sparse EM algorithm took time =", str(end-start)
+
+    w_ids = [str(w_oid) for w_oid in votes.worker_ids]
+    q_ids = [str(q_oid) for q_oid in votes.question_ids]
+    return {'posteriors' : dict(zip(q_ids, posteriors.tolist())),
+            'workers' : dict(zip(w_ids, skills.tolist())),
+            'questions' : dict(zip(q_ids, difficulties.tolist()))}
+
+def write_em(res, epsilon=None, batch_size=None):
+    """Write inference results to DB with unordered bulk updates.
+
+    Questions and workers whose stored posterior, difficulty and skill
+    all differ by less than epsilon (default EM_WRITE_EPSILON) from the
+    new estimates are skipped.
+
+    Returns dict {'written' : n, 'skipped' : n} of questions and workers
+    if all data successfully written, None otherwise
     """
+    if epsilon is None:
+        epsilon = app.config.get('EM_WRITE_EPSILON', 1e-3)
+    if batch_size is None:
+        batch_size = app.config.get('EM_WRITE_BATCH_SIZE', 1000)
 
     posteriors = res['posteriors']
     skills = res['workers']
@@ -118,19 +424,62 @@ def write_em(res):
 
     timestamp = str(datetime.datetime.utcnow())
 
-    for (q_id,posterior_est) in posteriors.iteritems():
-        # grab difficulty estimate for this question
-        difficulty_est = difficulties[q_id]
+    # NOTE overwrites previous EM results!
+    questions = {q_id : {'posterior':posterior_est,
+                         'difficulty':difficulties[q_id]} for
+                 (q_id,posterior_est) in posteriors.iteritems()}
+    workers = {w_id : {'skill':skill_est} for
+               (w_id,skill_est) in skills.iteritems()}
+
+    counts = {'written' : 0, 'skipped' : 0}
+    try:
+        for (collection, estimates) in [
+                (schema.question.Question._get_collection(), questions),
+                (schema.worker.Worker._get_collection(), workers)]:
+            written, skipped = write_estimates(collection, estimates,
+                                               timestamp, epsilon, batch_size)
+            counts['written'] += written
+            counts['skipped'] += skipped
+    except BulkWriteError as e:
+        print "EM write failed", e.details
+        return None
+
+    return counts
 
-        q = schema.question.Question.objects.get(id=q_id)
-        # NOTE overwrites previous EM results!
-        q.inference_results['EM'] = {'timestamp':timestamp, 'posterior':posterior_est, 'difficulty':difficulty_est}
-        q.save()
+def write_estimates(collection, estimates, timestamp, epsilon, batch_size):
+    """
+    Set inference_results.EM of the documents whose stored estimates moved
+    by epsilon or more.
+
+    Args:
+        estimates: dict {id : {name : estimate}}
 
-    for (w_id,skill_est) in skills.iteritems():
-        w = schema.worker.Worker.objects.get(id=w_id)
-        # NOTE overwrites previous EM results!
-        w.inference_results['EM'] = {'timestamp':timestamp, 'skill':skill_est}
-        w.save()
+    Returns tuple (number written, number skipped)
+    """
+    ids = [ObjectId(entity_id) for entity_id in estimates]
+    written = 0
+    skipped = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start+batch_size]
+        stored = {}
+        for doc in collection.find({'_id' : {'$in' : batch}},
+                                   {'inference_results.EM' : True}):
+            stored[doc['_id']] = doc.get('inference_results', {}).get('EM', {})
 
-    return True
+        requests = []
+        for oid in batch:
+            new = estimates[str(oid)]
+            old = stored.get(oid, {})
+            if all(old.get(name) is not None and
+                   abs(value - old[name]) < epsilon for
+                   (name, value) in new.iteritems()):
+                skipped += 1
+                continue
+            em = dict(new)
+            em['timestamp'] = timestamp
+            requests.append(UpdateOne({'_id' : oid},
+                                      {'$set' : {'inference_results.EM' : em}}))
+        if len(requests) > 0:
+            collection.bulk_write(requests, ordered=False)
+            written += len(requests)
+    return written, skipped
@@ -0,0 +1,221 @@
+"""
+Vectorized EM for binary labels under the Dai et al skill/difficulty model.
+
+A worker of skill gamma answers a question of difficulty d correctly with
+probability a(d,gamma) = 0.5*(1+(1-d)^gamma), the same model as
+crowd-estimate's EM and the POMDP controller. Votes are kept as three
+parallel arrays (worker index, question index, vote), so every sum over
+votes is one np.bincount, i.e. a sparse matrix-vector product.
+"""
+import numpy as np
+
+MIN_SKILL = 0.01
+MAX_SKILL = 10.0
+MIN_DIFFICULTY = 0.001
+MAX_DIFFICULTY = 0.999
+DEFAULT_SKILL = 1.0
+DEFAULT_DIFFICULTY = 0.5
+
+def accuracy(difficulties, skills):
+    return 0.5 * (1.0 + (1.0 - difficulties) ** skills)
+
+def estimate_arrays(workers, questions, votes, num_workers, num_questions,
+                    skills=None, difficulties=None, fixed_workers=None,
+                    fixed_questions=None, prior=0.5, difficulty_prior=(2.0, 2.0),
+                    skill_prior=1.0, max_iter=100, tol=1e-3, newton_steps=1):
+    """
+    Run EM on integer-indexed votes.
+
+    Args:
+        workers, questions: index of the worker and question of each vote
+        votes: 0 or 1 for each vote
+        skills, difficulties: initial estimates, nan for the defaults
+        fixed_workers, fixed_questions: bool arrays, True for estimates to
+            keep as given
+        prior: probability of label 1 before any vote
+        difficulty_prior: (alpha, beta) of a Beta prior on difficulties.
+            Without it a question all votes agree on gets difficulty 0,
+            and one they split on difficulty 1.
+        skill_prior: standard deviation of a log-normal prior on skills,
+            centered on DEFAULT_SKILL
+        max_iter: maximum number of EM iterations
+        tol: stop once no skill, and posteriors and difficulties on
+            average, move by more
+        newton_steps: Newton steps per parameter in each M step
+
+    Returns tuple of arrays (posteriors, skills, difficulties), the
+    posterior being the probability of label 1.
+    """
+    workers = np.asarray(workers, dtype=np.intp)
+    questions = np.asarray(questions, dtype=np.intp)
+    ones = np.asarray(votes).astype(np.int64) == 1
+
+    skills = _initial(skills, num_workers, DEFAULT_SKILL)
+    difficulties = _initial(difficulties, num_questions, DEFAULT_DIFFICULTY)
+    free_workers = _free(fixed_workers, num_workers)
+    free_questions = _free(fixed_questions, num_questions)
+    skills = np.clip(skills, MIN_SKILL, MAX_SKILL)
+    difficulties = np.clip(difficulties, MIN_DIFFICULTY, MAX_DIFFICULTY)
+
+    posteriors = np.empty(num_questions)
+    log_prior = np.log(prior) - np.log(1.0 - prior)
+    for i in range(max_iter):
+        #E step: log odds of label 1 from all votes on each question
+        a = accuracy(difficulties[questions], skills[workers])
+        log_ratio = np.log(a) - np.log(1.0 - a)
+        log_odds = log_prior + np.bincount(
+            questions, weights=np.where(ones, log_ratio, -log_ratio),
+            minlength=num_questions)
+        new_posteriors = 1.0 / (1.0 + np.exp(-log_odds))
+
+        #M step: probability that each vote is correct
+        correct = np.where(ones, new_posteriors[questions],
+                           1.0 - new_posteriors[questions])
+        old_skills = skills
+        old_difficulties = difficulties
+        for step in range(newton_steps):
+            skills = _newton_skills(skills, difficulties, workers, questions,
+                                    correct, num_workers, free_workers,
+                                    skill_prior)
+            difficulties = _newton_difficulties(skills, difficulties, workers,
+                                                questions, correct,
+                                                num_questions, free_questions,
+                                                difficulty_prior)
+
+        #A few questions near 50/50 converge slowly, so questions are
+        #judged on average
+        change = max(_mean_change(new_posteriors, posteriors) if i > 0 else
+                     np.inf,
+                     _mean_change(difficulties, old_difficulties),
+                     _max_change(skills, old_skills))
+        posteriors = new_posteriors
+        if change < tol:
+            break
+
+    return posteriors, skills, difficulties
+
+def estimate(votes, workers, questions, **kwargs):
+    """
+    Drop-in for crowd-estimate's em.estimate.
+
+    Args:
+        votes: dict {(w_id, q_id) : {'vote' : 0 or 1}}
+        workers: dict {w_id : {'skill' : initial skill or None}}, with
+            'fixed' : True to keep the skill as given
+        questions: dict {q_id : {'difficulty' : initial difficulty or None}},
+            with 'fixed' : True to keep the difficulty as given
+        kwargs: passed on to estimate_arrays
+
+    Returns dict {'posteriors' : {q_id : probability of label 1},
+                  'workers' : {w_id : skill},
+                  'questions' : {q_id : difficulty}}
+    """
+    w_ids = list(workers)
+    q_ids = list(questions)
+    w_index = {w_id : i for (i, w_id) in enumerate(w_ids)}
+    q_index = {q_id : i for (i, q_id) in enumerate(q_ids)}
+    pairs = list(votes)
+    posteriors, skills, difficulties = estimate_arrays(
+        [w_index[w_id] for (w_id, q_id) in pairs],
+        [q_index[q_id] for (w_id, q_id) in pairs],
+        [votes[pair]['vote'] for pair in pairs],
+        len(w_ids), len(q_ids),
+        skills=[_value(workers[w_id], 'skill') for w_id in w_ids],
+        difficulties=[_value(questions[q_id], 'difficulty') for q_id in q_ids],
+        fixed_workers=[workers[w_id].get('fixed', False) for w_id in w_ids],
+        fixed_questions=[questions[q_id].get('fixed', False) for
+                         q_id in q_ids],
+        **kwargs)
+    return {'posteriors' : dict(zip(q_ids, posteriors.tolist())),
+            'workers' : dict(zip(w_ids, skills.tolist())),
+            'questions' : dict(zip(q_ids, difficulties.tolist()))}
+
+def _value(entity, name):
+    value = entity.get(name)
+    return np.nan if value is None else value
+
+def _initial(values, n, default):
+    if values is None:
+        return np.full(n, default)
+    values = np.array(values, dtype=np.float64)
+    values[np.isnan(values)] = default
+    return values
+
+def _free(fixed, n):
+    if fixed is None:
+        return np.ones(n, dtype=bool)
+    return ~np.asarray(fixed, dtype=bool)
+
+def _max_change(new, old):
+    if len(new) == 0:
+        return 0.0
+    return np.abs(new - old).max()
+
+def _mean_change(new, old):
+    if len(new) == 0:
+        return 0.0
+    return np.abs(new - old).mean()
+
+def _log_likelihood_slope(correct, a):
+    """
+    Derivative of the expected log likelihood of each vote w.r.t. a.
+    """
+    return correct / a - (1.0 - correct) / (1.0 - a)
+
+def _newton_skills(skills, difficulties, workers, questions, correct, n,
+                   free, prior):
+    """
+    One Newton step on log(skill) for every free worker.
+    """
+    log_easiness = np.log1p(-difficulties)[questions]
+    def gradient(skills):
+        log_prior = -(np.log(skills) - np.log(DEFAULT_SKILL)) / prior ** 2
+        g = skills[workers]
+        x = np.exp(g * log_easiness)
+        a = 0.5 * (1.0 + x)
+        #d a / d log(skill) = 0.5 * x * log(1-d) * skill
+        da = 0.5 * x * log_easiness * g
+        return log_prior + np.bincount(
+            workers, weights=_log_likelihood_slope(correct, a) * da,
+            minlength=n)
+    return _newton_step(skills, gradient, np.log, np.exp, free,
+                        MIN_SKILL, MAX_SKILL)
+
+def _newton_difficulties(skills, difficulties, workers, questions, correct,
+                         n, free, prior):
+    """
+    One Newton step on logit(difficulty) for every free question.
+    """
+    alpha, beta = prior
+    g = skills[workers]
+    def gradient(difficulties):
+        log_prior = (alpha - 1.0) * (1.0 - difficulties) - (beta - 1.0) * difficulties
+        d = difficulties[questions]
+        x = np.exp(g * np.log1p(-d))
+        a = 0.5 * (1.0 + x)
+        #d a / d logit(d) = -0.5 * g * x / (1-d) * d * (1-d)
+        da = -0.5 * g * x * d
+        return log_prior + np.bincount(
+            questions, weights=_log_likelihood_slope(correct, a) * da,
+            minlength=n)
+    logit = lambda p: np.log(p) - np.log(1.0 - p)
+    expit = lambda t: 1.0 / (1.0 + np.exp(-t))
+    return _newton_step(difficulties, gradient, logit, expit, free,
+                        MIN_DIFFICULTY, MAX_DIFFICULTY)
+
+def _newton_step(values, gradient, to_free, from_free, free, low, high,
+                 h=1e-4, max_step=1.0):
+    """
+    Newton step in the unconstrained coordinates u = to_free(values), with
+    the second derivative taken by finite differences of the gradient.
+    Where the objective is not concave the step follows the gradient.
+    """
+    u = to_free(values)
+    g = gradient(values)
+    g_h = gradient(from_free(u + h))
+    curvature = (g_h - g) / h
+    step = np.where(curvature < 0, -g / np.where(curvature < 0, curvature, -1.0),
+                    np.sign(g) * max_step)
+    step = np.clip(step, -max_step, max_step)
+    step[~free] = 0.0
+    return np.clip(from_free(u + step), low, high)
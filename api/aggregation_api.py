@@ -1,12 +1,11 @@
 from flask.ext.restful import reqparse, abort, Api, Resource
 from flask.ext.security import auth_token_required
 from flask import url_for
-from schema.answer import Answer
 from schema.question import Question
 from schema.worker import Worker
 import json
-from collections import Counter
 from schema.inferenceJob import InferenceJob
+from aggregation import db_inference
 from util import get_requester_document, get_task_document, requester_token_match, requester_task_match, start_inference_job
 
 answer_agg_parser = reqparse.RequestParser()
@@ -44,15 +43,13 @@ class AnswerAggregationApi(Resource):
 
     def majority_vote(self, question):
         """
-        Returns the most common answer to the given question.
+        Returns the most common answer to the given question,
+        None if it has no answers.
         """
-        answers = Answer.objects(question=question)
-        values = []
-        for answer in answers:
-            values.append(answer.value)
-
-        counts = Counter(values)
-        return counts.most_common(1)[0][0]
+        votes = db_inference.majority_votes(question_ids=[question.id])
+        if str(question.id) not in votes:
+            return None
+        return votes[str(question.id)]['label']
 
 # parser for starting aggregation jobs
 task_agg_start_parser = reqparse.RequestParser()
@@ -75,8 +72,8 @@ class TaskAggregationApi(Resource):
 
         Returns: JSON representation of this job as created (use ID to look it up later).
         
-        :param str strategy: optionally specify inference algorithm. 'EM', 'majority_vote' etc.
-        :param dict additional_params: optional settings for the given inference/aggregation algorithm
+        :param str strategy: optionally specify inference algorithm. 'EM', 'sparse_EM', 'majority_vote' etc.
+        :param dict additional_params: optional settings for the given inference/aggregation algorithm, e.g. {"incremental": true} for EM
         :param str requester_id: req_id.
         """
         # TODO make this POST because it creates a resource
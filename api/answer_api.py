@@ -5,11 +5,11 @@ import flask.ext.restful.inputs
 from flask.ext.security import login_required, current_user, auth_token_required
 from flask import url_for
 from schema.answer import Answer
-from schema.question import Question
 from schema.worker import Worker
 from schema.requester import Requester
 from schema.task import Task
-from util import get_or_insert_worker, requester_token_match_and_task_match, requester_token_match, requester_task_match
+from controllers.pomdp_controller import update_question_belief
+from util import get_or_insert_worker, requester_token_match_and_task_match, requester_token_match, requester_task_match, get_cached_question, count_live_answers, clear_open_assignment
 import datetime
 import json
 import sys, traceback
@@ -124,10 +124,9 @@ class AnswerListApi(Resource):
 
         requester = Requester.objects.get(id = requester_id)
         task = Task.objects.get(id = task_id)
-        question = Question.objects.get(name = question_name,
-                                        task = task)
+        question = get_cached_question(task_id, question_name=question_name)
 
-        if not str(question.task.id) == task_id:
+        if question is None:
             return "Sorry, your question and task are inconsistent"
             
         
@@ -169,6 +168,15 @@ class AnswerListApi(Resource):
             answer.value = value
             answer.status = 'Completed'
             answer.save()
+            update_question_belief(task_id, answer.id, question.id, worker.id,
+                                   value, worker.inference_results.get(
+                                       'EM', {}).get('skill'))
+            if is_alive:
+                count_live_answers(task_id, question.id, 1)
+            #Assignment strategies skip questions the worker has answered
+            app.redis.sadd(redis_get_worker_assignments_var(task_id,
+                                                            worker.id),
+                           str(question.id))
             
             task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
             #Check if the question is in the queue.
@@ -200,6 +208,11 @@ class AnswerListApi(Resource):
             answer.value = value
             answer.status = 'Completed'
             answer.save()
+            update_question_belief(task_id, answer.id, question.id, worker.id,
+                                   value, worker.inference_results.get(
+                                       'EM', {}).get('skill'))
+            clear_open_assignment(task_id, worker_source, worker_platform_id,
+                                  question.id)
         return {'success' : answer.value}
 
 
@@ -242,10 +255,10 @@ class AnswerListApi2(Resource):
         for submitted_answer in submitted_answers:
             question_name, value = submitted_answer
             
-            question = Question.objects.get(name = question_name,
-                                            task = task)
+            question = get_cached_question(task_id,
+                                           question_name=question_name)
 
-            if not str(question.task.id) == task_id:
+            if question is None:
                 return "Sorry, your question and task are inconsistent"
 
 
@@ -287,6 +300,16 @@ class AnswerListApi2(Resource):
                 answer.value = value
                 answer.status = 'Completed'
                 answer.save()
+                update_question_belief(task_id, answer.id, question.id,
+                                       worker.id, value,
+                                       worker.inference_results.get(
+                                           'EM', {}).get('skill'))
+                if is_alive:
+                    count_live_answers(task_id, question.id, 1)
+                #Assignment strategies skip questions the worker has answered
+                app.redis.sadd(redis_get_worker_assignments_var(task_id,
+                                                                worker.id),
+                               str(question.id))
 
                 task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
                 #Check if the question is in the queue.
@@ -318,6 +341,12 @@ class AnswerListApi2(Resource):
                 answer.value = value
                 answer.status = 'Completed'
                 answer.save()
+                update_question_belief(task_id, answer.id, question.id,
+                                       worker.id, value,
+                                       worker.inference_results.get(
+                                           'EM', {}).get('skill'))
+                clear_open_assignment(task_id, worker_source,
+                                      worker_platform_id, question.id)
         return {'success' : values}
 
 class AnswerApi(Resource):
@@ -11,11 +11,100 @@ import schema.requester
 import schema.answer
 import json
 import random
-from util import requester_token_match, requester_token_match_and_task_match, get_or_insert_worker, get_alive_answers, requester_task_match
+from util import requester_token_match, requester_token_match_and_task_match, get_or_insert_worker, requester_task_match, cache_task_question_metadata, get_cached_question, get_live_answer_count, count_live_answers, rebuild_live_answer_counts, get_open_assignments, record_open_assignment
 import sys, traceback
-from redis.exceptions import WatchError
 
-from controllers.pomdp_controller import POMDPController
+from controllers.pomdp_controller import controller_cache
+
+# Pick, check, increment and evict in a single server-side step.
+# KEYS[1]: task queue (sorted set of question ids scored by number of answers)
+# KEYS[2]: set of questions already assigned to the worker
+# KEYS[3]: task question metadata hash (question id -> JSON)
+# ARGV[1]: maximum number of questions to assign
+# ARGV[2]: '1' to only pick the questions (previews), without reserving them
+# Returns a list whose first element is the id of a queued question
+# whose metadata is not cached yet (the script stops there), or '' if
+# there was none, followed by the ids of the assigned questions.
+MIN_ANSWERS_SCRIPT = """
+local num_questions = tonumber(ARGV[1])
+local preview = ARGV[2] == '1'
+local result = {''}
+local task_questions = redis.call('ZRANGE', KEYS[1], 0, -1)
+for i, question in ipairs(task_questions) do
+    if #result > num_questions then
+        break
+    end
+    local meta = redis.call('HGET', KEYS[3], question)
+    if not meta then
+        result[1] = question
+        break
+    end
+    meta = cjson.decode(meta)
+    -- If the worker has not done it before, assign it. Otherwise, if the
+    -- question allows for multiple answers from the same worker, assign it.
+    if meta['unique_workers'] ~= true or
+       redis.call('SISMEMBER', KEYS[2], question) == 0 then
+        if not preview then
+            redis.call('SADD', KEYS[2], question)
+            local score = tonumber(redis.call('ZINCRBY', KEYS[1], 1, question))
+            -- If this assignment causes the question to reach its allocated
+            -- budget, remove it from the queue.
+            local budget = tonumber(meta['answers_per_question'])
+            if budget == nil or score >= budget then
+                redis.call('ZREM', KEYS[1], question)
+            end
+        end
+        table.insert(result, question)
+    end
+end
+return result
+"""
+min_answers_script = app.redis.register_script(MIN_ANSWERS_SCRIPT)
+
+# Check and reserve the first suitable candidate in a single server-side
+# step, so two workers cannot both take a question's last slot.
+# KEYS[1]: set of open questions
+# KEYS[2]: set of questions already assigned to the worker
+# KEYS[3]: question live answer counters (hash question id -> count)
+# KEYS[4]: task live answer counter
+# KEYS[5]: task question metadata hash (question id -> JSON)
+# ARGV[1]: '1' to only pick the question (previews), without reserving it
+# ARGV[2...]: candidate question ids, in random order
+# Returns the id of the chosen question, or nil if no candidate is open
+# and unassigned to the worker.
+RANDOM_CHOICE_SCRIPT = """
+local preview = ARGV[1] == '1'
+for i = 2, #ARGV do
+    local question = ARGV[i]
+    local meta = redis.call('HGET', KEYS[5], question)
+    if meta and
+       redis.call('SISMEMBER', KEYS[1], question) == 1 and
+       redis.call('SISMEMBER', KEYS[2], question) == 0 then
+        local budget = tonumber(cjson.decode(meta)['answers_per_question'])
+        local count = tonumber(redis.call('HGET', KEYS[3], question)) or 0
+        if budget ~= nil and count < budget then
+            if not preview then
+                redis.call('SADD', KEYS[2], question)
+                count = tonumber(redis.call('HINCRBY', KEYS[3], question, 1))
+                if redis.call('EXISTS', KEYS[4]) == 1 then
+                    redis.call('INCR', KEYS[4])
+                end
+                if count >= budget then
+                    redis.call('SREM', KEYS[1], question)
+                end
+            end
+            return question
+        end
+    end
+end
+return false
+"""
+random_choice_script = app.redis.register_script(RANDOM_CHOICE_SCRIPT)
+
+# The random strategy draws this many distinct open questions at a time,
+# and gives up sampling after this many draws.
+RANDOM_CHOICE_SAMPLE_SIZE = 10
+RANDOM_CHOICE_RETRIES = 3
 
 nextq_parser = reqparse.RequestParser()
 #TODO:
@@ -75,36 +164,38 @@ class NextQuestionApi(Resource):
         if not requester_task_match(requester_id, task_id):
             return "Sorry, your requester_id and task_id do not match"
 
+        worker_platform_id = args['worker_id']
+        worker_source = args['worker_source']
+
+        #A returning worker gets one of their current assignments back
+        #from the Redis index of open assignments, i.e. after a bundle.
+        current_assignment = get_open_assignments(task_id, worker_source,
+                                                  worker_platform_id)
+
+        if len(current_assignment) > 0:
+            current_assignment.sort(key=lambda a: a['question_id'])
+            return {'question_name' : current_assignment[0]['question_name'],
+                    'question_id': current_assignment[0]['question_id'],
+                    'question_data' : current_assignment[0]['question_data']}
+
         task = schema.task.Task.objects.get_or_404(id=task_id)
         requester = schema.requester.Requester.objects.get_or_404(
             id=requester_id)
-        worker_platform_id = args['worker_id']
-        worker_source = args['worker_source']
 
         sys.stdout.flush()
         worker = get_or_insert_worker(worker_platform_id, worker_source)
         if worker == None:
             return "You have not entered a valid worker source. It must be one of: [mturk,] "
 
-        current_assignment = schema.answer.Answer.objects(
-            task = task,
-            worker=worker,
-            status = 'Assigned')
-
-        if len(current_assignment) == 1:
-            return {'question_name' : current_assignment[0].question.name,
-                    'question_id': str(current_assignment[0].question.id),
-                    'question_data' : current_assignment[0].question.data}
-
         #If the task budget has been reached, then make no more assignemnts
-        if (len(schema.answer.Answer.objects(task=task, is_alive=True)) >=
-            task.total_task_budget and task.total_task_budget != -1):
+        if (task.total_task_budget not in (None, -1) and
+            get_live_answer_count(task_id) >= task.total_task_budget):
             return {'error' : 'The total task budget has been reached'}
         
         if strategy == 'min_answers':
-            question = self.min_answers(task_id, worker)
+            question = self.min_answers(task_id, worker, preview)
         elif strategy == 'random':
-            question = self.random_choice(task_id, worker)
+            question = self.random_choice(task_id, worker, preview)
         elif strategy == 'pomdp':
             #use additional strategy parameters
             settings = args['additional_params']
@@ -117,15 +208,23 @@ class NextQuestionApi(Resource):
         
 
         if not preview:
+            assign_time = datetime.datetime.now()
             answer = schema.answer.Answer(question = question,
                                           task = task,
                                       requester=requester,
                                           worker = worker,
                                           status = 'Assigned',
-                                          assign_time=datetime.datetime.now,
+                                          assign_time=assign_time,
                                           is_alive = True)
             
             answer.save()
+            #The random strategy already counted the answer when it
+            #reserved the question
+            if strategy != 'random':
+                count_live_answers(task_id, question.id, 1)
+            record_open_assignment(task_id, worker_source, worker_platform_id,
+                                   question, assign_time,
+                                   task.assignment_duration)
         return {'question_name' : question.name,
                 'question_id' : str(question.id),
                 'question_data' : question.data}
@@ -136,98 +235,277 @@ class NextQuestionApi(Resource):
         NOTE: Can set custom POMDP penalty (i.e. -100) for submitting an incorrect answer
         """
         print("Using new pomdp controller for assignment...")
-        controller = POMDPController(task_id, settings)
+        controller = controller_cache.get(task_id, settings)
+        if not controller.hasPolicy():
+            #The policy is being solved in the background. Fill the
+            #question with the fewest answers meanwhile.
+            print("No POMDP policy yet, assigning by min_answers")
+            return self.min_answers(task_id, worker)
         assignment_dict = controller.assign([worker])
         if assignment_dict.has_key(str(worker.id)):
             q_id = assignment_dict[str(worker.id)]
-            return schema.question.Question.objects.get(id=q_id)
+            return get_cached_question(task_id, question_id=q_id)
         else:
             print("POMDP controller did not make an assignment")
             return None
 
-    ####
-    # NOT FULLY TESTED
-    ####
-    def random_choice(self, task_id, worker):
-
-        task = schema.task.Task.objects.get_or_404(id=task_id)
+    def random_choice(self, task_id, worker, preview=False):
+        """
+        Draw a random question among the task's open questions (fewer live
+        answers than answers_per_question) that the worker has not been
+        assigned or answered yet, and reserve it for the worker.
+        With preview, the question is only picked, not reserved.
 
-        questions = schema.question.Question.objects(task=task)
-        
-        qlist = list(questions)
+        Samples a few open questions at a time and hands them to a Redis
+        script that checks and reserves the first suitable one in one
+        step. Falls back to the set difference if every sample was
+        already assigned to the worker.
+        """
+        open_questions_var = redis_get_task_open_questions_var(task_id)
+        worker_assignments_var = redis_get_worker_assignments_var(task_id,
+                                                                  worker.id)
+        keys = [open_questions_var,
+                worker_assignments_var,
+                redis_get_task_question_live_answers_var(task_id),
+                redis_get_task_live_answers_var(task_id),
+                redis_get_task_question_meta_var(task_id)]
 
-        #First filter for questions that are alive
-        filtered_qlist = filter(
-            lambda q:len(get_alive_answers(q)) < q.answers_per_question,
-            qlist)
+        pipe = app.redis.pipeline(transaction=False)
+        pipe.exists(redis_get_task_question_live_answers_var(task_id))
+        pipe.srandmember(open_questions_var, RANDOM_CHOICE_SAMPLE_SIZE)
+        counters_built, candidates = pipe.execute()
+        if not counters_built:
+            rebuild_live_answer_counts(task_id)
+            candidates = app.redis.srandmember(open_questions_var,
+                                               RANDOM_CHOICE_SAMPLE_SIZE)
 
-        #Next filter out the questions that the worker has already
-        #answered
-        filtered_qlist = filter(
-            lambda q:
-            len(schema.answer.Answer.objects(question=q, worker=worker,
-                                             status='Completed')) == 0,
-            filtered_qlist)
+        for attempt in range(RANDOM_CHOICE_RETRIES + 1):
+            if attempt == RANDOM_CHOICE_RETRIES:
+                candidates = list(app.redis.sdiff(open_questions_var,
+                                                  worker_assignments_var))
+            elif attempt > 0:
+                candidates = app.redis.srandmember(open_questions_var,
+                                                   RANDOM_CHOICE_SAMPLE_SIZE)
+            if len(candidates) == 0:
+                return None
+            random.shuffle(candidates)
+            chosen_question = random_choice_script(
+                keys=keys, args=['1' if preview else '0'] + candidates)
+            if chosen_question is None:
+                continue
+            question = get_cached_question(task_id,
+                                           question_id=chosen_question)
+            if question is not None:
+                return question
+            #The question was deleted since it was cached. Undo the
+            #reservation and drop it from the open questions.
+            if not preview:
+                app.redis.srem(worker_assignments_var, chosen_question)
+                count_live_answers(task_id, chosen_question, -1)
+            app.redis.srem(open_questions_var, chosen_question)
+        return None
 
-        
-        if len(filtered_qlist) == 0:
+    def min_answers(self, task_id, worker, preview=False):
+        """
+        Assumes that task and worker IDs have been checked.
+        """
+        questions = self.reserve_min_answers(task_id, worker, 1, preview)
+        if len(questions) == 0:
             return None
-        question = random.choice(filtered_qlist)
-        return question
+        return questions[0]
 
-    def min_answers(self, task_id, worker):
+    def reserve_min_answers(self, task_id, worker, num_questions,
+                            preview=False):
         """
-        Assumes that task and worker IDs have been checked.
+        Reserve up to num_questions questions with the fewest answers
+        for the worker. Assumes that task and worker IDs have been checked.
+        With preview, the questions are only picked, not reserved.
+
+        The whole pick-check-increment-evict sequence runs as one Redis
+        script, so a reservation costs one round trip however contended
+        the queue is.
         """
 
         worker_id = worker.id
-        chosen_question = None
-        task = schema.task.Task.objects.get_or_404(id=task_id)
 
         task_questions_var = redis_get_task_queue_var(task_id, 'min_answers')
         worker_assignments_var = redis_get_worker_assignments_var(task_id,
                                                                   worker_id)
+        question_meta_var = redis_get_task_question_meta_var(task_id)
+
+        chosen_questions = []
+        while len(chosen_questions) < num_questions:
+            #A preview reserves nothing, so each pass picks from the start
+            if preview:
+                chosen_questions = []
+            result = min_answers_script(
+                keys=[task_questions_var,
+                      worker_assignments_var,
+                      question_meta_var],
+                args=[num_questions - len(chosen_questions),
+                      '1' if preview else '0'])
+            missing_question = result[0]
 
+            #Questions deleted since they were cached are dropped from the
+            #queue and their reservation undone, and others picked instead
+            stale = False
+            for question_id in result[1:]:
+                question = get_cached_question(task_id,
+                                               question_id=question_id)
+                if question is None:
+                    stale = True
+                    app.redis.zrem(task_questions_var, question_id)
+                    if not preview:
+                        app.redis.srem(worker_assignments_var, question_id)
+                else:
+                    chosen_questions.append(question)
 
-        pipe = app.redis.pipeline()
-        while 1:
-            try:
-                pipe.watch(task_questions_var)
-                pipe.watch(worker_assignments_var)
-                task_questions = pipe.zrange(task_questions_var, 0, -1)
-                for question in task_questions:
-                    #If the worker has not done it before, assign it.
-                    #Otherwise, if the question allows for
-                    #multiple answers from the same worker,
-                    #assign it.
-                    if not pipe.sismember(worker_assignments_var, question):
-                        chosen_question = question
-                        break
-                    else:
-                        question_obj = schema.question.Question.objects.get(
-                            id=question)
-                        if not question_obj.unique_workers:    
-                            chosen_question = question
-                            break
-                    
-                if chosen_question is None:
-                    return None
-                chosen_question_obj = schema.question.Question.objects.get(
-                    id=chosen_question)
-                
-                pipe.sadd(worker_assignments_var, chosen_question)
-                pipe.zincrby(task_questions_var, chosen_question, 1)
-                
-                #If this assignemnt causes the question to
-                #reach its allocated budget,
-                #Remove it from the queue.                        
-                if (pipe.zscore(task_questions_var,chosen_question) >=
-                    chosen_question_obj.answers_per_question):
-                    pipe.zrem(task_questions_var, chosen_question)
+            if missing_question:
+                #The metadata of a queued question is not in Redis yet.
+                #Load it for the whole task. If the question no longer
+                #exists, drop it from the queue.
+                cache_task_question_metadata(task_id)
+                if not app.redis.hexists(question_meta_var, missing_question):
+                    app.redis.zrem(task_questions_var, missing_question)
+            elif not stale:
                 break
-            except WatchError:
-                continue
-            finally:
-                pipe.reset()
-                
-        return chosen_question_obj
+
+        return chosen_questions
+
+
+
+class POMDPControllerCacheApi(Resource):
+    def get(self):
+        """Get the hit and miss counts of the POMDP controller cache.
+
+        **Example response:**
+
+        .. code-block:: json
+
+            {
+                "hits" : 120,
+                "misses" : 4,
+                "cached_in_process" : 2
+            }
+
+        """
+        return controller_cache.stats()
+
+nextq_bundle_parser = nextq_parser.copy()
+nextq_bundle_parser.replace_argument('strategy', type=str, required=False,
+                                     default='min_answers')
+nextq_bundle_parser.add_argument('num_questions', type=int, required=True)
+
+
+class NextQuestionBundleApi(NextQuestionApi):
+    """
+    Usage:
+    GET /url with JSON={worker_id:XXX, task_id:XXX, num_questions:XXX}
+    """
+
+    def get(self):
+
+        """Assign several questions from the given task to the given worker at once.
+
+        The questions are reserved in one atomic step and their answer
+        placeholders inserted with one bulk write. If the worker still has
+        open assignments in the task, those are returned instead.
+
+        :param str worker_id: worker's platform id
+        :param str worker_source: i.e. mturk
+        :param str task_id:
+        :param str requester_id: id of requester who owns this task
+        :param int num_questions: maximum number of questions to assign
+        :param str strategy: optional, only 'min_answers' is supported.
+        :param bool preview: optional, if true then the question ids will be returned but no assignments will be created.
+
+        **Example response:**
+
+        .. code-block:: json
+
+            {
+                "questions" : [
+                    {
+                        "question_name" : "999999",
+                        "question_id" : "1234",
+                        "question_data" : "some q data"
+                    }
+                ]
+            }
+
+        """
+
+        args = nextq_bundle_parser.parse_args()
+
+        strategy = args['strategy']
+        preview = args['preview']
+        task_id = args['task_id']
+        num_questions = args['num_questions']
+
+        requester_id = args['requester_id']
+
+        if not requester_task_match(requester_id, task_id):
+            return "Sorry, your requester_id and task_id do not match"
+
+        if strategy != 'min_answers':
+            return {'error' : 'Invalid Strategy'}
+
+        worker_platform_id = args['worker_id']
+        worker_source = args['worker_source']
+
+        current_assignments = get_open_assignments(task_id, worker_source,
+                                                   worker_platform_id)
+        if len(current_assignments) > 0:
+            return {'questions' : [
+                {'question_name' : assignment['question_name'],
+                 'question_id' : assignment['question_id'],
+                 'question_data' : assignment['question_data']}
+                for assignment in current_assignments]}
+
+        task = schema.task.Task.objects.get_or_404(id=task_id)
+        requester = schema.requester.Requester.objects.get_or_404(
+            id=requester_id)
+
+        worker = get_or_insert_worker(worker_platform_id, worker_source)
+        if worker == None:
+            return "You have not entered a valid worker source. It must be one of: [mturk,] "
+
+        #Never assign more questions than the task budget has left
+        if task.total_task_budget not in (None, -1):
+            num_questions = min(num_questions,
+                                task.total_task_budget -
+                                get_live_answer_count(task_id))
+            if num_questions <= 0:
+                return {'error' : 'The total task budget has been reached'}
+
+        questions = self.reserve_min_answers(task_id, worker, num_questions,
+                                             preview)
+
+        if len(questions) == 0:
+            return {'error' : 'The strategy did not assign any question'}
+
+        if not preview:
+            assign_time = datetime.datetime.now()
+            answers = [schema.answer.Answer(question = question,
+                                            task = task,
+                                            requester = requester,
+                                            worker = worker,
+                                            status = 'Assigned',
+                                            assign_time = assign_time,
+                                            is_alive = True)
+                       for question in questions]
+            schema.answer.Answer.objects.insert(answers, load_bulk=False)
+
+            pipe = app.redis.pipeline(transaction=False)
+            for question in questions:
+                count_live_answers(task_id, question.id, 1, client=pipe)
+                record_open_assignment(task_id, worker_source,
+                                       worker_platform_id, question,
+                                       assign_time, task.assignment_duration,
+                                       client=pipe)
+            pipe.execute()
+
+        return {'questions' : [{'question_name' : question.name,
+                                'question_id' : str(question.id),
+                                'question_data' : question.data}
+                               for question in questions]}
@@ -9,7 +9,7 @@ from schema.requester import Requester
 import schema.answer
 import json
 import random
-from util import requester_token_match, requester_token_match_and_task_match, requeue, requeueHelper
+from util import requester_token_match, requester_token_match_and_task_match, requeue, requeueHelper, cache_question_metadata
 from mongoengine.queryset import DoesNotExist
 from redis.exceptions import WatchError
 
@@ -129,6 +129,7 @@ class QuestionListApi(Resource):
         app.redis.zadd(redis_get_task_queue_var(task_id, 'min_answers'),
                        0,
                        str(questionDocument.id))
+        cache_question_metadata(task_id, [questionDocument])
 
         return {'question_id' : str(questionDocument.id)}
 
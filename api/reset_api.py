@@ -1,5 +1,9 @@
+from app import app
+from redis_util import redis_get_task_live_answers_var, redis_get_task_question_live_answers_var, redis_get_task_open_questions_var, redis_get_task_question_meta_var, redis_get_task_question_names_var
 from flask.ext.restful import reqparse, abort, Api, Resource
 from schema.answer import Answer
+from util import clear_task_open_assignments
+from controllers.pomdp_controller import controller_cache
 import json
 from flask.ext.security import login_required, current_user, auth_token_required
 
@@ -25,5 +29,12 @@ class ResetApi(Resource):
         for answer in all_answers:
             answer.is_alive = False
             answer.save()
+        app.redis.delete(redis_get_task_live_answers_var(task_id),
+                         redis_get_task_question_live_answers_var(task_id),
+                         redis_get_task_open_questions_var(task_id),
+                         redis_get_task_question_meta_var(task_id),
+                         redis_get_task_question_names_var(task_id))
+        clear_task_open_assignments(task_id)
+        controller_cache.invalidate(task_id)
 
         return "Task %s reset." % task_id
@@ -10,10 +10,11 @@ from schema.task import Task
 from schema.requester import Requester
 from schema.worker import Worker
 from flask.json import jsonify
-from util import requester_token_match, requester_token_match_and_task_match, clear_task_from_redis
+from util import requester_token_match, requester_token_match_and_task_match, clear_task_from_redis, cache_question_metadata
 import json
 import datetime
 from redis.exceptions import WatchError
+from controllers.pomdp_controller import controller_cache
 
 
 task_parser = reqparse.RequestParser()
@@ -184,9 +185,11 @@ class TaskListApi(Resource):
         task.save()
         
         question_id_list = []
+        saved_questions = []
         for questionDocument in questionDocuments:
             try:
                 questionDocument.save()
+                saved_questions.append(questionDocument)
                 #REDIS update 
                 # -add this question to the queue
                 app.redis.zadd(redis_get_task_queue_var(task.id, 'min_answers'),
@@ -204,6 +207,7 @@ class TaskListApi(Resource):
                 cl, exc, tb = sys.exc_info()
                 line_number = traceback.extract_tb(tb)[-1][1]
 
+        cache_question_metadata(task.id, saved_questions)
                 
         ret = {'task_id' : str(task.id)}
         if questions:
@@ -299,12 +303,15 @@ class TaskSetBudget(Resource):
                     continue
                 finally:
                     pipe.reset()
+            cache_question_metadata(task_id, questions)
 
         if not total_task_budget == None:
             task = Task.objects.get_or_404(id=task_id)
             task.total_task_budget = total_task_budget
             task.save()
 
+        controller_cache.invalidate(task_id)
+
         if answers_per_question:
             if not total_task_budget:
                 return "Task %s now allows %d answers per question" % (
@@ -337,6 +344,7 @@ class TaskDelete(Resource):
             Answer.objects(task = task_id).delete()
             Question.objects(task = task_id).delete()
             Task.objects.get(id = task_id).delete()
+            clear_task_from_redis(task_id)
             
             return {'success' : 'Task %s deleted!' % task_id}
 
@@ -346,6 +354,7 @@ class TaskDelete(Resource):
             for task in tasks:
                 Answer.objects(task = task).delete()
                 Question.objects(task = task).delete()
+                clear_task_from_redis(task.id)
             tasks.delete()
                 
             return {'success' :
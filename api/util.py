@@ -6,13 +6,15 @@ from schema.answer import Answer
 from schema.task import Task
 from schema.requester import Requester
 from schema.inferenceJob import InferenceJob
-from redis_util import redis_get_worker_assignments_var, redis_get_task_queue_var
+from redis_util import redis_get_worker_assignments_var, redis_get_task_queue_var, redis_get_task_question_meta_var, redis_get_task_question_names_var, redis_get_task_live_answers_var, redis_get_worker_open_assignments_var, redis_get_task_open_assignment_workers_var, redis_get_task_question_live_answers_var, redis_get_task_open_questions_var, redis_get_task_beliefs_var, redis_get_task_belief_skills_var, redis_get_task_belief_answers_var, redis_get_task_belief_votes_var
 from aggregation import db_inference
 from mongoengine.queryset import DoesNotExist
 from redis.exceptions import WatchError
+from bson import ObjectId
 import datetime
+import json
 
-from controllers.pomdp_controller import POMDPController
+from controllers.pomdp_controller import controller_cache
 
 def requester_token_match(requester_id):
     return str(current_user.id) == requester_id
@@ -52,6 +54,335 @@ def get_alive_answers(question):
 
     return answers
 
+def question_metadata(question):
+    """
+    Serialize the fields of a question that assignment and answer
+    ingestion need, so that they never have to read it from Mongo.
+    """
+    return json.dumps({'name' : question.name,
+                       'data' : question.data,
+                       'answers_per_question' : question.answers_per_question,
+                       'unique_workers' : question.unique_workers})
+
+def cache_question_metadata(task_id, questions):
+    """
+    Write the metadata of the given questions into the task's
+    question metadata hash in Redis, and index them by name.
+    Returns the number of questions cached.
+    """
+    metadata = {}
+    names = {}
+    for question in questions:
+        metadata[str(question.id)] = question_metadata(question)
+        names[question.name] = str(question.id)
+    if len(metadata) > 0:
+        pipe = app.redis.pipeline(transaction=False)
+        pipe.hmset(redis_get_task_question_meta_var(task_id), metadata)
+        pipe.hmset(redis_get_task_question_names_var(task_id), names)
+        pipe.execute()
+        refresh_open_questions(task_id, metadata.keys())
+    return len(metadata)
+
+def question_from_metadata(question_id, metadata):
+    """
+    Build a Question document from cached metadata.
+    It is not loaded from Mongo and must not be saved, but it can be
+    referenced by answers and carries the fields needed to serve it.
+    """
+    metadata = json.loads(metadata)
+    return Question(id=ObjectId(question_id),
+                    name=metadata['name'],
+                    data=metadata['data'],
+                    answers_per_question=metadata['answers_per_question'],
+                    unique_workers=metadata['unique_workers'])
+
+def get_cached_question(task_id, question_id=None, question_name=None):
+    """
+    Look up a question of the task by id or by name in the Redis
+    metadata cache, loading just that question from Mongo on a miss.
+    Returns None if the task has no such question.
+    """
+    meta_var = redis_get_task_question_meta_var(task_id)
+    q_id = question_id
+    if q_id is None:
+        q_id = app.redis.hget(redis_get_task_question_names_var(task_id),
+                              question_name)
+    if q_id is not None:
+        metadata = app.redis.hget(meta_var, q_id)
+        if metadata is not None:
+            return question_from_metadata(q_id, metadata)
+
+    if question_id is not None:
+        if not ObjectId.is_valid(str(question_id)):
+            return None
+        questions = Question.objects(task=task_id, id=question_id)
+    else:
+        questions = Question.objects(task=task_id, name=question_name)
+    question = questions.first()
+    if question is None:
+        return None
+    cache_question_metadata(task_id, [question])
+    return question
+
+def get_cached_task_questions(task_id):
+    """
+    Return all questions of the task built from the Redis metadata cache.
+    """
+    meta_var = redis_get_task_question_meta_var(task_id)
+    metadata = app.redis.hgetall(meta_var)
+    if len(metadata) == 0 and cache_task_question_metadata(task_id) > 0:
+        metadata = app.redis.hgetall(meta_var)
+    return [question_from_metadata(q_id, m)
+            for (q_id, m) in metadata.iteritems()]
+
+def cache_task_question_metadata(task_id):
+    """
+    Rebuild the question metadata hash of a task from Mongo.
+    Used when a question is found in the queue without cached metadata,
+    i.e. for tasks created before the cache existed or after clearing Redis.
+    """
+    return cache_question_metadata(task_id, Question.objects(task=task_id))
+
+# Adjust the live answer counters of a task and of one of its questions,
+# and keep the set of open questions (live answers < answers_per_question)
+# in sync. Counters that have not been built are left alone; they are
+# rebuilt from Mongo on their next read.
+# KEYS[1]: task live answer counter
+# KEYS[2]: question live answer counters (hash question id -> count)
+# KEYS[3]: set of open questions
+# KEYS[4]: task question metadata hash
+# ARGV[1]: amount to add
+# ARGV[2]: question id
+LIVE_ANSWERS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    local count = tonumber(redis.call('HINCRBY', KEYS[2], ARGV[2], ARGV[1]))
+    local meta = redis.call('HGET', KEYS[4], ARGV[2])
+    local budget = nil
+    if meta then
+        budget = tonumber(cjson.decode(meta)['answers_per_question'])
+    end
+    if budget ~= nil and count < budget then
+        redis.call('SADD', KEYS[3], ARGV[2])
+    else
+        redis.call('SREM', KEYS[3], ARGV[2])
+    end
+end
+return true
+"""
+live_answers_script = app.redis.register_script(LIVE_ANSWERS_SCRIPT)
+
+# Recompute whether the given questions are open, after their metadata
+# changed. Questions without a counter yet start at 0 live answers.
+# KEYS[1]: question live answer counters
+# KEYS[2]: set of open questions
+# KEYS[3]: task question metadata hash
+# ARGV: question ids
+REFRESH_OPEN_QUESTIONS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+for i, question in ipairs(ARGV) do
+    redis.call('HSETNX', KEYS[1], question, 0)
+    local count = tonumber(redis.call('HGET', KEYS[1], question))
+    local meta = redis.call('HGET', KEYS[3], question)
+    local budget = nil
+    if meta then
+        budget = tonumber(cjson.decode(meta)['answers_per_question'])
+    end
+    if budget ~= nil and count < budget then
+        redis.call('SADD', KEYS[2], question)
+    else
+        redis.call('SREM', KEYS[2], question)
+    end
+end
+return true
+"""
+refresh_open_questions_script = app.redis.register_script(
+    REFRESH_OPEN_QUESTIONS_SCRIPT)
+
+def count_live_answers(task_id, question_id, amount=1, client=None):
+    """
+    Record that amount answers to the question became alive (or,
+    if negative, were deleted or stopped being alive).
+    Pass a pipeline as client to batch several updates.
+    """
+    if amount != 0:
+        live_answers_script(
+            keys=[redis_get_task_live_answers_var(task_id),
+                  redis_get_task_question_live_answers_var(task_id),
+                  redis_get_task_open_questions_var(task_id),
+                  redis_get_task_question_meta_var(task_id)],
+            args=[amount, str(question_id)],
+            client=client)
+
+def refresh_open_questions(task_id, question_ids):
+    """
+    Update the open question set of the task for the given questions,
+    i.e. after they were created or their budget changed.
+    """
+    if len(question_ids) > 0:
+        refresh_open_questions_script(
+            keys=[redis_get_task_question_live_answers_var(task_id),
+                  redis_get_task_open_questions_var(task_id),
+                  redis_get_task_question_meta_var(task_id)],
+            args=[str(question_id) for question_id in question_ids])
+
+# Field of the question live answer counters marking them as built, so
+# that a task without questions is not recounted on every request.
+LIVE_ANSWERS_BUILT = '_built'
+
+def rebuild_live_answer_counts(task_id):
+    """
+    Count the live answers of a task in Mongo, per question, in a single
+    aggregation and store the results as the task's live answer counter,
+    per-question counters and open question set.
+    Returns the number of live answers in the task.
+    """
+    questions = get_cached_task_questions(task_id)
+    counts = {str(question.id) : 0 for question in questions}
+    budgets = {str(question.id) : question.answers_per_question
+               for question in questions}
+    grouped = Answer._get_collection().aggregate([
+        {'$match' : {'task' : ObjectId(str(task_id)), 'is_alive' : True}},
+        {'$group' : {'_id' : '$question', 'count' : {'$sum' : 1}}}])
+    total = 0
+    for group in grouped:
+        counts[str(group['_id'])] = group['count']
+        total += group['count']
+    open_questions = [q_id for (q_id, count) in counts.iteritems()
+                      if budgets.get(q_id) is not None and
+                      count < budgets[q_id]]
+
+    counts_var = redis_get_task_question_live_answers_var(task_id)
+    open_var = redis_get_task_open_questions_var(task_id)
+    pipe = app.redis.pipeline()
+    pipe.set(redis_get_task_live_answers_var(task_id), total)
+    pipe.delete(counts_var)
+    pipe.delete(open_var)
+    counts[LIVE_ANSWERS_BUILT] = 1
+    pipe.hmset(counts_var, counts)
+    if len(open_questions) > 0:
+        pipe.sadd(open_var, *open_questions)
+    pipe.execute()
+    return total
+
+def get_live_answer_count(task_id):
+    """
+    Number of live answers of the task, read from its Redis counter.
+    """
+    count = app.redis.get(redis_get_task_live_answers_var(task_id))
+    if count is None:
+        return rebuild_live_answer_counts(task_id)
+    return int(count)
+
+# Marks a worker's open assignment hash as complete, so that a hash
+# holding no assignments still answers lookups without Mongo.
+OPEN_ASSIGNMENTS_LOADED = '_loaded'
+
+def open_assignment_entry(question, assign_time, assignment_duration):
+    """
+    Serialize an open assignment as stored in the worker's
+    open assignment hash.
+    """
+    deadline = None
+    if assign_time is not None and assignment_duration is not None:
+        deadline = (assign_time + datetime.timedelta(
+            seconds=assignment_duration)).isoformat()
+    return json.dumps({'question_id' : str(question.id),
+                       'question_name' : question.name,
+                       'question_data' : question.data,
+                       'deadline' : deadline})
+
+def record_open_assignment(task_id, worker_source, worker_id, question,
+                           assign_time, assignment_duration, client=None):
+    """
+    Add an assignment of the question to the worker's open assignments,
+    and the worker to the task's workers with open assignments.
+    worker_id is the worker's platform id.
+    Pass a pipeline as client to batch several updates.
+    """
+    if client is None:
+        client = app.redis
+    client.hset(
+        redis_get_worker_open_assignments_var(task_id, worker_source,
+                                              worker_id),
+        str(question.id),
+        open_assignment_entry(question, assign_time, assignment_duration))
+    client.sadd(redis_get_task_open_assignment_workers_var(task_id),
+                json.dumps([worker_source, worker_id]))
+
+def clear_open_assignment(task_id, worker_source, worker_id, question_id):
+    """
+    Remove an assignment that was completed or requeued from the
+    worker's open assignments.
+    """
+    app.redis.hdel(
+        redis_get_worker_open_assignments_var(task_id, worker_source,
+                                              worker_id),
+        str(question_id))
+
+def load_open_assignments(task_id, worker_source, worker_id):
+    """
+    Build the worker's open assignment hash from the assigned
+    answers in Mongo. Returns the entries written.
+    """
+    entries = {OPEN_ASSIGNMENTS_LOADED : '1'}
+    worker = Worker.objects(platform_id = worker_id,
+                            platform_name = worker_source).first()
+    if worker is not None:
+        task = Task.objects.get(id = task_id)
+        assigned = Answer.objects(task = task_id,
+                                  worker = worker,
+                                  status = 'Assigned').only(
+                                      'question', 'assign_time').as_pymongo()
+        for answer in assigned:
+            question = get_cached_question(
+                task_id, question_id=str(answer['question']))
+            if question is None:
+                continue
+            entries[str(question.id)] = open_assignment_entry(
+                question, answer.get('assign_time'), task.assignment_duration)
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.hmset(
+        redis_get_worker_open_assignments_var(task_id, worker_source,
+                                              worker_id),
+        entries)
+    pipe.sadd(redis_get_task_open_assignment_workers_var(task_id),
+              json.dumps([worker_source, worker_id]))
+    pipe.execute()
+    return entries
+
+def get_open_assignments(task_id, worker_source, worker_id):
+    """
+    Return the worker's open assignments in the task as a list of dicts
+    with keys question_id, question_name, question_data and deadline.
+    Only reads Mongo the first time a worker is seen in the task.
+    """
+    entries = app.redis.hgetall(
+        redis_get_worker_open_assignments_var(task_id, worker_source,
+                                              worker_id))
+    if OPEN_ASSIGNMENTS_LOADED not in entries:
+        entries = load_open_assignments(task_id, worker_source, worker_id)
+    return [json.loads(entry) for (field, entry) in entries.iteritems()
+            if field != OPEN_ASSIGNMENTS_LOADED]
+
+def clear_task_open_assignments(task_id):
+    """
+    Delete the open assignment hashes of the workers recorded in the
+    task's open assignment worker set. They are rebuilt from Mongo on each worker's next request.
+    """
+    workers_var = redis_get_task_open_assignment_workers_var(task_id)
+    pipe = app.redis.pipeline(transaction=False)
+    for worker in app.redis.smembers(workers_var):
+        (worker_source, worker_id) = json.loads(worker)
+        pipe.delete(redis_get_worker_open_assignments_var(
+            task_id, worker_source, worker_id))
+    pipe.delete(workers_var)
+    pipe.execute()
+
 def clear_task_from_redis(task_id):
     
     num_questions_deleted = 0
@@ -61,15 +392,24 @@ def clear_task_from_redis(task_id):
         task_queue = app.redis.zrange(task_queue_var, 0, -1)
         num_questions_deleted += len(task_queue)
         app.redis.delete(task_queue_var)
+    app.redis.delete(redis_get_task_question_meta_var(task_id))
+    app.redis.delete(redis_get_task_question_names_var(task_id))
+    app.redis.delete(redis_get_task_live_answers_var(task_id))
+    app.redis.delete(redis_get_task_question_live_answers_var(task_id))
+    app.redis.delete(redis_get_task_open_questions_var(task_id))
+    app.redis.delete(redis_get_task_beliefs_var(task_id),
+                     redis_get_task_belief_skills_var(task_id),
+                     redis_get_task_belief_answers_var(task_id),
+                     redis_get_task_belief_votes_var(task_id))
 
 
-    worker_assignments_deleted = 0
-    for worker in Worker.objects():
-        worker_assignments_var = redis_get_worker_assignments_var(
-            task_id, worker.id)
-        worker_assignments_deleted += app.redis.delete(
-            worker_assignments_var)
-        
+    pipe = app.redis.pipeline(transaction=False)
+    for worker in Worker.objects().only('id'):
+        pipe.delete(redis_get_worker_assignments_var(task_id, worker.id))
+    worker_assignments_deleted = sum(pipe.execute())
+    clear_task_open_assignments(task_id)
+    controller_cache.invalidate(task_id)
+
 
     return (num_questions_deleted, worker_assignments_deleted)
 
@@ -108,7 +448,18 @@ def start_inference_job(job_id):
     elif job.strategy == "EM":
         print "Running inference job with strategy =  EM"
         #run EM
-        results = db_inference.aggregate_task_EM(task_id)
+        results = db_inference.aggregate_task_EM(
+            task_id, incremental=job.additional_params.get('incremental', False))
+        #write result to DB
+        job.results = results
+        job.status = 'Completed'
+        job.save()
+    elif job.strategy == "sparse_EM":
+        print "Running inference job with strategy =  sparse_EM"
+        #run the vectorized EM
+        results = db_inference.aggregate_task_EM(
+            task_id, incremental=job.additional_params.get('incremental', False),
+            engine='sparse')
         #write result to DB
         job.results = results
         job.status = 'Completed'
@@ -116,7 +467,8 @@ def start_inference_job(job_id):
     elif job.strategy == "pomdp":
         print "Running inference job with strategy =  pomdp"
         #get pomdp status for all questions in task
-        pomdp_controller = POMDPController(task_id, settings = job.additional_params)
+        pomdp_controller = controller_cache.get(task_id,
+                                                settings = job.additional_params)
         results = pomdp_controller.getStatus(task_id)
         #write result to DB
         job.results = results
@@ -125,6 +477,21 @@ def start_inference_job(job_id):
     else:
         print "Error: don't know how to run the job=", job.to_json()
 
+@app.celery.task(name='reconcile_live_answers')
+def reconcile_live_answers(task_id=None):
+    """
+    Rebuild the live answer counters from Mongo, for one task or for all
+    of them, to repair any drift from updates racing a counter rebuild.
+    """
+    if task_id is None:
+        task_ids = [task.id for task in Task.objects.only('id')]
+    else:
+        task_ids = [task_id]
+    for task_id in task_ids:
+        rebuild_live_answer_counts(task_id)
+    print "Live answer counters reconciled for %d tasks" % len(task_ids)
+    return True
+
 @app.celery.task(name='requeue')
 def requeue():
     question_ids_to_requeue = []
@@ -204,11 +571,16 @@ def requeueHelper(task_id, requester_id, question_ids,
                 else:
                     pipe.zincrby(task_questions_var, question_id, -1)
 
-                answer = Answer.objects(
+                #Assigned answers are created alive, so every deleted
+                #assignment frees up one unit of the task budget.
+                num_deleted = Answer.objects(
                     task=task_id,
                     question = question_id,
                     worker = worker,
                     status = 'Assigned').delete()
+                count_live_answers(task_id, question_id, -num_deleted)
+                clear_open_assignment(task_id, worker_source, worker_id,
+                                      question_id)
                 pipe.srem(worker_assignments_var, question_id)
             except WatchError:
                 continue
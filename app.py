@@ -24,6 +24,7 @@ api = Api(app)
 
 app.config['CORS_HEADERS'] = 'Content-Type'
 cors = CORS(app, resources={"/assign_next_question": {"origins": "*"},
+                            "/assign_next_questions": {"origins": "*"},
                             "/answers":  {"origins": "*"},
                             "/task_data": {"origins" : "*"}})
 
@@ -160,6 +161,8 @@ api.add_resource(QuestionRequeueApi, '/requeue')
 # next question
 from api.assignment_api import *
 api.add_resource(NextQuestionApi, '/assign_next_question') #DOES NOT REQUIRE SECURITY
+api.add_resource(NextQuestionBundleApi, '/assign_next_questions') #DOES NOT REQUIRE SECURITY
+api.add_resource(POMDPControllerCacheApi, '/pomdp/controller_cache') #UNSECURED
 
 #TODO not implemented yet
 from api.aggregation_api import *
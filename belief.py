@@ -0,0 +1,126 @@
+"""
+Vectorized question beliefs for the Dai et al POMDP.
+
+Same model as util.initBelief/util.updateBelief, but all questions of a task
+are kept in one (questions x states) array and observations are applied in
+batches. Beliefs are accumulated as log probabilities so long vote histories
+do not underflow.
+"""
+import numpy as np
+
+class BeliefEngine(object):
+    """
+    Beliefs over (label, difficulty) states for many questions at once.
+
+    State ordering matches util.updateBelief and pomdp_peng:
+    [(True,0.0),...,(True,1.0),(False,0.0),...,(False,1.0),<TERMINAL STATE>]
+
+    Args:
+        num_questions: number of rows in the belief array
+        num_difficulty_bins: discretize difficulty [0,1] into n bins
+        num_answer_choices: must be 2, labels are 0 or 1
+        skill_grid: sorted worker skills for which accuracies are
+            precomputed. Skills are rounded to the nearest grid point.
+    """
+    def __init__(self, num_questions, num_difficulty_bins=11,
+                 num_answer_choices=2, skill_grid=None):
+        assert num_answer_choices == 2
+        self.num_difficulty_bins = num_difficulty_bins
+        self.num_answer_choices = num_answer_choices
+        self.num_states = num_answer_choices * num_difficulty_bins + 1
+        self.difficulties = np.linspace(0.0, 1.0, num_difficulty_bins)
+
+        if skill_grid is None:
+            skill_grid = np.linspace(0.0, 10.0, 10001)
+        self.skill_grid = np.asarray(skill_grid, dtype=np.float64)
+
+        #accuracy[g,d] = a(d,g) = 0.5*(1+(1-d)^g) for every grid skill
+        accuracy = 0.5 * (1.0 + (1.0 - self.difficulties[np.newaxis, :]) **
+                          self.skill_grid[:, np.newaxis])
+        with np.errstate(divide='ignore'):
+            self.log_correct = np.log(accuracy)
+            self.log_incorrect = np.log(1.0 - accuracy)
+
+        self.log_beliefs = np.zeros((num_questions, self.num_states - 1))
+
+    @property
+    def num_questions(self):
+        return self.log_beliefs.shape[0]
+
+    def add_questions(self, n):
+        """
+        Append n questions with uniform beliefs, returns their row indices.
+        """
+        start = self.num_questions
+        self.log_beliefs = np.vstack(
+            [self.log_beliefs, np.zeros((n, self.num_states - 1))])
+        return np.arange(start, start + n)
+
+    def reset(self, questions=None):
+        """
+        Return the given rows (default all) to the uniform prior.
+        """
+        if questions is None:
+            self.log_beliefs[:] = 0.0
+        else:
+            self.log_beliefs[questions] = 0.0
+
+    def skill_index(self, skills):
+        """
+        Index of the nearest grid point for each skill.
+        """
+        skills = np.asarray(skills, dtype=np.float64)
+        idx = np.searchsorted(self.skill_grid, skills)
+        idx = np.clip(idx, 1, len(self.skill_grid) - 1)
+        left = self.skill_grid[idx - 1]
+        right = self.skill_grid[idx]
+        idx -= (skills - left) <= (right - skills)
+        return idx
+
+    def observe(self, questions, observations, skills):
+        """
+        Apply a batch of observations.
+
+        Args:
+            questions: row index of the question for each observation
+            observations: 0 or 1 for each observation (int or str)
+            skills: skill estimate of the worker behind each observation
+        """
+        questions = np.asarray(questions, dtype=np.intp)
+        observations = np.asarray(observations).astype(np.int64)
+        assert np.all((observations == 0) | (observations == 1))
+        if len(questions) == 0:
+            return
+
+        g = self.skill_index(skills)
+        log_correct = self.log_correct[g]
+        log_incorrect = self.log_incorrect[g]
+
+        #True states come first, so a vote of 1 is correct for the
+        #first half of the states and a vote of 0 for the second half
+        votes_true = (observations == 1)[:, np.newaxis]
+        loglik = np.hstack([np.where(votes_true, log_correct, log_incorrect),
+                            np.where(votes_true, log_incorrect, log_correct)])
+
+        #Sum per question and state (much faster than np.add.at)
+        for state in range(self.num_states - 1):
+            self.log_beliefs[:, state] += np.bincount(
+                questions, weights=loglik[:, state],
+                minlength=self.num_questions)
+
+    def beliefs(self, questions=None):
+        """
+        Normalized beliefs, one row per question, terminal state last (p=0).
+        """
+        if questions is None:
+            log_beliefs = self.log_beliefs
+        else:
+            log_beliefs = self.log_beliefs[questions]
+        if log_beliefs.ndim == 1:
+            log_beliefs = log_beliefs[np.newaxis, :]
+
+        out = np.zeros((log_beliefs.shape[0], self.num_states))
+        shifted = log_beliefs - log_beliefs.max(axis=1)[:, np.newaxis]
+        probs = np.exp(shifted)
+        out[:, :-1] = probs / probs.sum(axis=1)[:, np.newaxis]
+        return out
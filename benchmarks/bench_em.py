@@ -0,0 +1,88 @@
+"""
+Compare the vectorized aggregation.sparse_em with the crowd-estimate EM
+module on synthetic tasks of 10k, 100k and 1M votes (10 votes per
+question). crowd-estimate runs only if its submodule is checked out.
+
+Usage: python benchmarks/bench_em.py [max votes]
+"""
+import os
+import sys
+import time
+import importlib
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from aggregation import sparse_em
+
+VOTES_PER_QUESTION = 10
+VOTES_PER_WORKER = 200
+
+def synthetic_task(num_votes, seed=0):
+    """
+    Returns (workers, questions, votes, labels) arrays
+    """
+    rng = np.random.RandomState(seed)
+    num_questions = num_votes // VOTES_PER_QUESTION
+    num_workers = max(20, num_votes // VOTES_PER_WORKER)
+    skills = rng.uniform(0.3, 3.0, num_workers)
+    difficulties = rng.uniform(0.05, 0.95, num_questions)
+    labels = rng.randint(0, 2, num_questions)
+    #distinct workers on each question
+    workers = np.concatenate([rng.choice(num_workers, VOTES_PER_QUESTION,
+                                         replace=False) for
+                              q in range(num_questions)])
+    questions = np.repeat(np.arange(num_questions), VOTES_PER_QUESTION)
+    correct = (rng.random_sample(len(workers)) <
+               sparse_em.accuracy(difficulties[questions], skills[workers]))
+    votes = np.where(correct, labels[questions], 1 - labels[questions])
+    return workers, questions, votes, labels
+
+def as_dicts(workers, questions, votes):
+    """
+    crowd-estimate's input format
+    """
+    em_votes = {}
+    em_workers = {}
+    em_questions = {}
+    for (w, q, v) in zip(workers.tolist(), questions.tolist(), votes.tolist()):
+        em_votes[(str(w), str(q))] = {'vote' : v}
+        em_workers[str(w)] = {'skill' : None}
+        em_questions[str(q)] = {'difficulty' : None}
+    return em_votes, em_workers, em_questions
+
+def accuracy(posteriors, labels):
+    return np.mean((np.asarray(posteriors) > 0.5) == labels)
+
+if __name__ == '__main__':
+    max_votes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    engines = [('sparse dicts', sparse_em.estimate)]
+    try:
+        engines.append(('crowd-estimate',
+                        importlib.import_module("crowd-estimate.em").estimate))
+    except ImportError:
+        print "crowd-estimate not checked out, skipping it"
+
+    for num_votes in [10000, 100000, 1000000]:
+        if num_votes > max_votes:
+            break
+        workers, questions, votes, labels = synthetic_task(num_votes)
+        majority = np.bincount(questions, weights=votes) * 2 > VOTES_PER_QUESTION
+        print "%8d votes, majority vote accuracy %.4f" % (
+            num_votes, accuracy(majority, labels))
+
+        begin = time.time()
+        posteriors, skills, difficulties = sparse_em.estimate_arrays(
+            workers, questions, votes, workers.max() + 1, len(labels))
+        print "%8d votes %-14s %8.2fs accuracy %.4f" % (
+            num_votes, 'sparse arrays', time.time() - begin,
+            accuracy(posteriors, labels))
+
+        for (name, estimate) in engines:
+            begin = time.time()
+            em_votes, em_workers, em_questions = as_dicts(workers, questions,
+                                                          votes)
+            res = estimate(em_votes, em_workers, em_questions)
+            posteriors = [res['posteriors'][str(q)] for
+                          q in range(len(labels))]
+            print "%8d votes %-14s %8.2fs accuracy %.4f" % (
+                num_votes, name, time.time() - begin,
+                accuracy(posteriors, labels))
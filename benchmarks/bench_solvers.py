@@ -0,0 +1,49 @@
+"""
+Compare the in-process PBVI solver with zmdp on the tiger test POMDP and
+the Dai et al model. zmdp runs only if ZMDP_ALIAS is set.
+
+Usage: python benchmarks/bench_solvers.py [timeout]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'test'))
+import pomdp
+import pomdp_peng
+from test_pomdp import TigerPOMDP
+
+def tiger_model():
+    t = TigerPOMDP()
+    arrays = pomdp.POMDP.closures_to_arrays(
+        t.states, t.actions, t.observations, t.f_start, t.f_transition,
+        t.f_observation, t.f_reward)
+    return (t.states, t.actions, t.observations) + arrays + (0.95,)
+
+def dai_model(gamma=1.0, reward_incorrect=-50):
+    p = pomdp_peng.PengPOMDP(11, gamma)
+    arrays = p.model_arrays(gamma, -1, 0, reward_incorrect)
+    return (p.states, p.actions, p.observations) + arrays + (0.9999,)
+
+if __name__ == '__main__':
+    timeout = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    solvers = [('pbvi', pomdp.PBVIPOMDP)]
+    if 'ZMDP_ALIAS' in os.environ:
+        solvers.append(('zmdp', pomdp.ZPOMDP))
+    else:
+        print "ZMDP_ALIAS not set, skipping zmdp"
+
+    for (name, model) in [('tiger', tiger_model()),
+                          ('dai gamma=1.0', dai_model(1.0)),
+                          ('dai gamma=2.0', dai_model(2.0))]:
+        states, actions, observations, start, T, O, R, discount = model
+        for (solver_name, solver) in solvers:
+            begin = time.time()
+            policy = solver().solve_arrays(states, actions, observations,
+                                           start, T, O, R, discount,
+                                           timeout=timeout)
+            seconds = time.time() - begin
+            action, reward = policy.get_best_action(start)
+            print "%-14s %-5s %7.3fs %4d alpha vectors, start: %s %.4f" % (
+                name, solver_name, seconds, len(policy.action_nums),
+                actions[action], reward)
@@ -0,0 +1,60 @@
+"""
+Compare the regex + YAML zMDP policy parser with the streaming one.
+
+Usage: python benchmarks/bench_zmdp_parser.py [num_planes] [num_states]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import zmdp_util
+
+def write_policy(filename, num_planes, num_states):
+    """
+    Write a random zMDP policy. Each plane leaves the terminal state
+    undefined half of the time.
+    """
+    with open(filename, 'w') as f:
+        f.write('# benchmark policy\n{\n')
+        f.write('  policyType => "MaxPlanesLowerBound",\n')
+        f.write('  numPlanes => %d,\n' % num_planes)
+        f.write('  planes => [\n')
+        for i in range(num_planes):
+            n = num_states - (i % 2)
+            f.write('    {\n      action => %d,\n' % (i % 3))
+            f.write('      numEntries => %d,\n      entries => [\n' % n)
+            for s in range(n):
+                f.write('        %d, %.17g,\n' % (s, -np.random.random()))
+            f.write('      ]\n    },\n')
+        f.write('  ]\n}\n')
+
+def best_time(f, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__ == '__main__':
+    num_planes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_states = int(sys.argv[2]) if len(sys.argv) > 2 else 23
+
+    fd, filename = tempfile.mkstemp(suffix='.policy')
+    os.close(fd)
+    try:
+        write_policy(filename, num_planes, num_states)
+        print "%d planes, %d states, %d bytes" % (
+            num_planes, num_states, os.path.getsize(filename))
+
+        yaml_time = best_time(
+            lambda: zmdp_util.read_zmdp_policy(filename, num_states), 1)
+        fast_time = best_time(
+            lambda: zmdp_util.read_zmdp_policy_arrays(filename, num_states))
+        print "regex + yaml: %.3fs" % yaml_time
+        print "streaming:    %.3fs" % fast_time
+        print "speedup:      %.1fx" % (yaml_time / fast_time)
+    finally:
+        os.remove(filename)
@@ -19,9 +19,83 @@ class Config(object):
 
 
     CELERY_TIMEZONE = 'UTC'
-    CELERY_IMPORTS = ['api.util']
+    CELERY_IMPORTS = ['api.util', 'controllers.pomdp_controller']
     CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml']
     BROKER_POOL_LIMIT = 0
+
+    # A cached POMDP controller (EM estimates + parsed policy) is rebuilt
+    # after this many seconds or this many new completed answers in its task
+    POMDP_CONTROLLER_CACHE_TTL = 300
+    POMDP_CONTROLLER_CACHE_MAX_NEW_ANSWERS = 20
+    POMDP_CONTROLLER_CACHE_MAX_TASKS = 100
+
+    # Inference loads votes from Mongo in batches of this many answers
+    INFERENCE_VOTE_BATCH_SIZE = 10000
+
+    # EM results are written back in bulk batches of EM_WRITE_BATCH_SIZE
+    # questions or workers, skipping those whose estimates moved by less
+    # than EM_WRITE_EPSILON
+    EM_WRITE_EPSILON = 1e-3
+    EM_WRITE_BATCH_SIZE = 1000
+
+    # EM engine of the POMDP controller, 'crowd-estimate' or 'sparse'
+    # (the vectorized aggregation.sparse_em)
+    EM_ENGINE = 'crowd-estimate'
+
+    # EM for the POMDP controller only re-estimates the questions and
+    # workers around answers completed since the task's last run, rippling
+    # out while estimates move by more than EM_INCREMENTAL_TOLERANCE.
+    # Falls back to a full run when the neighbourhood grows past
+    # EM_INCREMENTAL_MAX_FRACTION of the task's votes.
+    EM_INCREMENTAL = True
+    EM_INCREMENTAL_TOLERANCE = 0.01
+    EM_INCREMENTAL_MAX_ROUNDS = 5
+    EM_INCREMENTAL_MAX_FRACTION = 0.5
+
+    # Stored question beliefs are recomputed from all answers when any
+    # worker's EM skill estimate moves by more than this
+    BELIEF_SKILL_TOLERANCE = 0.05
+
+    # Solved POMDP policies are shared through Mongo GridFS ('gridfs') or
+    # only through POLICY_STORE_DIR on the local disk ('local')
+    POLICY_STORE_BACKEND = 'gridfs'
+    POLICY_STORE_DIR = 'policies'
+    POLICY_STORE_CACHE_SIZE = 16
+
+    # One process at a time solves each policy, holding a Redis lease for
+    # up to this many seconds. Others poll the store for its result.
+    POLICY_SOLVE_LEASE = 900
+    POLICY_SOLVE_POLL_INTERVAL = 1.0
+
+    # 'zmdp' runs the external solver (needs ZMDP_ALIAS), 'pbvi' solves
+    # in process with pomdp.PBVIPOMDP
+    POLICY_SOLVER = 'zmdp'
+
+    # Pruning of solved policies before they are stored: 'exact' drops
+    # pointwise dominated alpha vectors, 'approximate' also drops those
+    # never best at beliefs reachable with up to POLICY_PRUNE_MAX_VOTES
+    # votes of average skill, 'none' keeps everything
+    POLICY_PRUNE = 'exact'
+    POLICY_PRUNE_MAX_VOTES = 20
+
+    # Decisions for questions with at most POLICY_DECISION_TABLE_MAX_VOTES
+    # votes are looked up by their vote counts per skill bucket, keeping
+    # POLICY_DECISION_TABLE_SIZE entries per policy (0 to disable)
+    POLICY_DECISION_TABLE_SIZE = 10000
+    POLICY_DECISION_TABLE_MAX_VOTES = 10
+    POLICY_DECISION_TABLE_SKILL_BUCKET = 0.1
+
+    # A controller serving a fallback policy checks for its own policy
+    # at most this often (seconds)
+    POLICY_REFRESH_INTERVAL = 5
+
+    # Grid of policies solved ahead of time by warm_policies.py or the
+    # warm_policy_grid job, and loaded at boot when POLICY_PRELOAD is set
+    POLICY_GRID_GAMMAS = [round(0.1 * i, 1) for i in range(1, 31)]
+    POLICY_GRID_REWARD_INCORRECT = [-50]
+    POLICY_GRID_DISCOUNTS = [0.9999]
+    POLICY_GRID_TIMEOUT = 300
+    POLICY_PRELOAD = False
     
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
@@ -35,6 +109,11 @@ class DevelopmentConfig(Config):
             'schedule': timedelta(seconds=5),
             'args': ()
         },
+        'reconcile-live-answers-every-hour': {
+            'task': 'reconcile_live_answers',
+            'schedule': timedelta(hours=1),
+            'args': ()
+        },
     }
 
 class Production(Config):
@@ -42,6 +121,8 @@ class Production(Config):
     DEVELOPMENT = False
     TESTING = False
 
+    POLICY_PRELOAD = True
+
     REQUEUE_INTERVAL = int(os.environ['REQUEUE_INTERVAL'])
 
     CELERYBEAT_SCHEDULE = {
@@ -50,4 +131,9 @@ class Production(Config):
             'schedule': timedelta(seconds=REQUEUE_INTERVAL),
             'args': ()
         },
+        'reconcile-live-answers-every-hour': {
+            'task': 'reconcile_live_answers',
+            'schedule': timedelta(hours=1),
+            'args': ()
+        },
     }
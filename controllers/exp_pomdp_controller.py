@@ -5,7 +5,6 @@ import pomdp_peng
 import pomdp_policy
 import util
 import os
-import shutil
 import importlib
 inf_mod = importlib.import_module("crowd-estimate.em")
 
@@ -124,17 +123,25 @@ class expPOMDPController():
         print "Calculating beliefs"
         beliefs = self.belief
 
-        #2) Get POMDP data for each question
+        #2) Get POMDP data for all questions at once
         print "Getting POMDP decision for each question"
         out = {}
-        for (q_id,belief) in beliefs.iteritems():
-            print "q_id", q_id
-
+        q_ids = beliefs.keys()
+        if len(q_ids) == 0:
+            return out
+        belief_matrix = np.array([beliefs[q_id] for q_id in q_ids])
+        rewards = self.policy.get_action_rewards_batch(belief_matrix)
+        best_actions, best_rewards = self.policy.choose_best_actions(rewards)
+        actions = [int(a) for a in self.policy.actions]
+
+        for (i, q_id) in enumerate(q_ids):
             #get POMDP action reward pairs
-            action_rewards = {str(a):r for a,r in self.policy.get_action_rewards(belief).iteritems()}
+            action_rewards = {str(a):r for a,r in zip(actions, rewards[i])
+                              if r != -np.inf}
 
             #which action has best expected reward
-            best_action, best_expected_reward = self.policy.get_best_action(belief)
+            best_action = int(best_actions[i])
+            best_expected_reward = best_rewards[i]
 
             #get best action as readable string (submit-true, etc.)
             best_action_str = self.pomdp_var.actions[best_action]
@@ -248,10 +255,16 @@ class expPOMDPController():
         # average worker skill = 1.0 and reward for incorrect answer of -100
         filename = 'dai_%.1f_%s.policy' % (self.average_gamma, self.reward_incorrect)
         print "Updating policy to %s..." % filename
-        if os.path.isdir(self.policy_dir) and os.path.isfile(self.policy_dir + '/' + filename):
+        npz_filename = os.path.splitext(filename)[0] + '.npz'
+        if os.path.isfile(self.policy_dir + '/' + npz_filename):
+            #previously solved and saved in binary form
+            print "Policy already solved"
+            policy = pomdp_policy.POMDPPolicy(self.policy_dir + '/' + npz_filename, file_format='npz')
+        elif os.path.isdir(self.policy_dir) and os.path.isfile(self.policy_dir + '/' + filename):
             #previously solved
             print "Policy already solved"
             policy = pomdp_policy.POMDPPolicy(self.policy_dir + '/' + filename, file_format='zmdp', n_states= self.num_states)
+            policy.save(self.policy_dir + '/' + npz_filename)
         else:
             #have to solve it
             print "Policy needs to be solved"
@@ -261,11 +274,11 @@ class expPOMDPController():
                                   self.pomdp_var.f_transition,
                                   self.pomdp_var.CLOSURE_f_observation(self.average_gamma),
                                   self.pomdp_var.CLOSURE_f_reward(self.reward_create, self.reward_correct, self.reward_incorrect),
-                                  discount=self.discount, timeout=self.timeout, directory=self.policy_dir)
+                                  discount=self.discount, timeout=self.timeout, directory=self.policy_dir,
+                                  policy_filename=self.policy_dir + '/' + filename)
 
             #save our new policy where we can find it again
-            #rename p.policy to filename w/params
-            shutil.move(self.policy_dir + '/p.policy', self.policy_dir + '/' + filename)
+            policy.save(self.policy_dir + '/' + npz_filename)
         return policy
 
     def HELPER_update_belief(self, old_belief, observation, gamma):
@@ -1,16 +1,40 @@
 import datetime
 import numpy as np
+from belief import BeliefEngine
+from decision_table import decision_table, skill_bucket, vote_counts_key, num_votes
 import pomdp
 import pomdp_peng
-import pomdp_policy
 import util
 import schema
 import os
-import shutil
+import json
+import time
+import uuid
 
 from aggregation.db_inference import aggregate_task_EM
+from policy_store import policy_store, policy_key
 from app import app
 from redis_util import *
+from redis.exceptions import WatchError
+from celery.signals import worker_process_init
+
+NUM_DIFFICULTY_BINS = 11  # 0.0-1.0
+NUM_ANSWER_CHOICES = 2  # either 0 or 1
+REWARD_CORRECT = 0
+REWARD_CREATE = -1
+
+#Field of the belief skills hash holding the skill used for workers
+#without an EM estimate. Its presence marks the task's beliefs as built.
+DEFAULT_SKILL_FIELD = '_default'
+
+#Answers completed this long before a belief rebuild started its scan are
+#folded in again after it, in case the scan missed them
+BELIEF_REBUILD_MARGIN = datetime.timedelta(seconds=60)
+BELIEF_REBUILD_TEMP_TTL = 3600
+
+#Beliefs are updated with worker skills of at least this much. With a skill
+#of 0 every answer is certain, so two conflicting answers give a NaN belief.
+MIN_BELIEF_SKILL = 0.01
 
 class POMDPController():
     """
@@ -36,22 +60,25 @@ class POMDPController():
         calculates belief state and action-reward pairs for each question in T
         returns 
 
-    See getPolicy() for information on POMDP policy solving and caching.
+    See getPolicy() and policy_store for information on POMDP policy
+    solving and caching.
     """
     def __init__(self, task_id, settings={}):
         # XXX assumes task_id has been checked already
         self.task_id = task_id
         self.task = schema.task.Task.objects.get(id=task_id)
 
-        #1)Run EM
-        #TODO want this to just access latest estimates as opposed to running
-        #a new session of EM on the entire task
-        EM_results = aggregate_task_EM(task_id)
+        #1)Run EM, only around the answers new since the last run
+        #if EM_INCREMENTAL is set
+        EM_results = aggregate_task_EM(
+            task_id, incremental=app.config.get('EM_INCREMENTAL', True),
+            engine=app.config.get('EM_ENGINE', 'crowd-estimate'))
         print EM_results
 
         #2)Get avg gamma from EM results, if none default to 1.0
         self.average_gamma = self.getAverageGamma(EM_results)
         print self.average_gamma
+        self.skills = EM_results['workers']
 
         #3)Create POMDP policy
 
@@ -61,10 +88,10 @@ class POMDPController():
         self.reward_incorrect = settings.get('reward_incorrect', -50)
        
         # Constants
-        self.reward_correct = 0
-        self.reward_create = -1
-        self.num_difficulty_bins = 11  # 0.0-1.0
-        self.num_answer_choices = 2  # either 0 or 1
+        self.reward_correct = REWARD_CORRECT
+        self.reward_create = REWARD_CREATE
+        self.num_difficulty_bins = NUM_DIFFICULTY_BINS
+        self.num_answer_choices = NUM_ANSWER_CHOICES
         self.num_states = 1 + self.num_difficulty_bins * self.num_answer_choices # includes terminal state
 
         # XXX POMDP weird stuff
@@ -77,28 +104,71 @@ class POMDPController():
             self.num_difficulty_bins, self.average_gamma)
 
         # Initialize pomdp policy with given parameters
+        self.policy_is_fallback = False
+        self.policy_checked = time.time()
         self.policy = self.getPolicy()
 
+        #4)Recompute stored question beliefs if skill estimates have moved
+        self.syncBeliefs()
+
     def getStatus(self, includeVotes=False):
         """
         Returns all observations and pomdp opinions of question status
         """
-        #1) Calculate beliefs
-        #TODO want to cache beliefs and make incremental updates
-        print "Calculating beliefs"
-        beliefs = self.calculateBeliefs()
-
-        #2) Get POMDP data for each question
+        #0) Switch to our own policy if it has been solved since.
+        #Assignment checks hasPolicy first, so only background jobs
+        #get here without any policy; they wait for the solve.
+        self.refreshPolicy()
+        if self.policy is None:
+            params = self.getPolicyParams()
+            self.policy = policy_store.get_or_solve(
+                params, lambda: solve_dai_policy(params, self.policy_dir))
+            self.policy_is_fallback = False
+
+        #1) Read maintained vote counts, and beliefs of questions
+        #with too many votes for the decision table
+        print "Reading beliefs"
+        counts = self.calculateVoteCounts()
+        max_votes = app.config.get('POLICY_DECISION_TABLE_MAX_VOTES', 10)
+        if app.config.get('POLICY_DECISION_TABLE_SIZE', 10000) <= 0:
+            max_votes = -1
+        keys = {q_id : vote_counts_key(c) for (q_id, c) in counts.iteritems()}
+        table_ids = [q_id for q_id in keys if num_votes(keys[q_id]) <= max_votes]
+        belief_ids = [q_id for q_id in keys if num_votes(keys[q_id]) > max_votes]
+
+        #2) Get POMDP data for all questions at once
         print "Getting POMDP decision for each question"
         out = {}
-        for (q_id,belief) in beliefs.iteritems():
-            print "q_id", q_id
-
+        q_ids = table_ids + belief_ids
+        if len(q_ids) == 0:
+            return out
+        rewards = np.empty((len(q_ids), len(self.policy.actions)))
+        if len(table_ids) > 0:
+            table = decision_table(
+                self.policy,
+                num_difficulty_bins=self.num_difficulty_bins,
+                num_answer_choices=self.num_answer_choices,
+                bucket_width=app.config.get(
+                    'POLICY_DECISION_TABLE_SKILL_BUCKET', 0.1),
+                max_entries=app.config.get('POLICY_DECISION_TABLE_SIZE', 10000))
+            rewards[:len(table_ids)] = table.get_action_rewards(
+                [keys[q_id] for q_id in table_ids])
+        if len(belief_ids) > 0:
+            beliefs = self.calculateBeliefs(belief_ids)
+            belief_matrix = np.array([beliefs[q_id] for q_id in belief_ids])
+            rewards[len(table_ids):] = self.policy.get_action_rewards_batch(
+                belief_matrix)
+        best_actions, best_rewards = self.policy.choose_best_actions(rewards)
+        actions = [int(a) for a in self.policy.actions]
+
+        for (i, q_id) in enumerate(q_ids):
             #get POMDP action reward pairs
-            action_rewards = {str(a):r for a,r in self.policy.get_action_rewards(belief).iteritems()}
+            action_rewards = {str(a):r for a,r in zip(actions, rewards[i])
+                              if r != -np.inf}
 
             #which action has best expected reward
-            best_action, best_expected_reward = self.policy.get_best_action(belief)
+            best_action = int(best_actions[i])
+            best_expected_reward = best_rewards[i]
 
             #get best action as readable string (submit-true, etc.)
             best_action_str = self.pomdp_var.actions[best_action]
@@ -199,33 +269,166 @@ class POMDPController():
 
     # Helper methods (ideally not exposed)
 
-    def calculateBeliefs(self):
-        """Calculate belief states for each question in the task.
-        Uses latest estimate of worker skills from DB
+    def calculateBeliefs(self, q_ids=None):
+        """Get belief states for the given questions (default all questions
+        in the task). Beliefs are kept in Redis and updated as answers
+        come in, see update_question_belief.
         """
-
+        beliefs_var = redis_get_task_beliefs_var(self.task_id)
+        skills_var = redis_get_task_belief_skills_var(self.task_id)
+
+        pipe = app.redis.pipeline()
+        pipe.exists(skills_var)
+        pipe.hgetall(beliefs_var)
+        built, stored = pipe.execute()
+        if not built:
+            self.rebuildBeliefs()
+            stored = app.redis.hgetall(beliefs_var)
+
+        if q_ids is None:
+            q_ids = [str(q_id) for q_id in self.getQuestions().scalar('id')]
         belief = {}
+        for q in q_ids:
+            if q in stored:
+                belief[q] = json.loads(stored[q])
+            else:
+                belief[q] = self.HELPER_init_belief()
 
-        for question in self.getQuestions():
-            q = str(question.id)
-            belief[q] = self.HELPER_init_belief()
-
-            #print belief[q]
-            for answer in self.getQuestionCompletedAnswers(question):
-                #print q
-                #print str(answer.question.id)
-                assert str(answer.question.id) == q
-                w_skill = answer.worker.inference_results['EM']['skill']
-                # answer.value must be "0" or "1"
-                assert answer.value == "0" or answer.value == "1"
-                #print answer.value, w_skill
-                belief[q] = self.HELPER_update_belief(belief[q], answer.value, w_skill)
-                #print belief[q]
-
-        #print "Question beliefs:", belief
-        #print "##################"
         return belief
 
+    def calculateVoteCounts(self):
+        """Get vote counts {skill bucket : [votes for 0, votes for 1]} for
+        each question in the task. Kept in Redis next to the beliefs.
+        """
+        skills_var = redis_get_task_belief_skills_var(self.task_id)
+        votes_var = redis_get_task_belief_votes_var(self.task_id)
+
+        pipe = app.redis.pipeline()
+        pipe.exists(skills_var)
+        pipe.hgetall(votes_var)
+        built, stored = pipe.execute()
+        if not built or len(stored) == 0:
+            self.rebuildBeliefs()
+            stored = app.redis.hgetall(votes_var)
+
+        counts = {}
+        for q_id in self.getQuestions().scalar('id'):
+            q = str(q_id)
+            if q in stored:
+                counts[q] = json.loads(stored[q])
+            else:
+                counts[q] = {}
+
+        return counts
+
+    def syncBeliefs(self):
+        """Rebuild the stored beliefs unless they were computed with skills
+        within BELIEF_SKILL_TOLERANCE of the latest EM estimates.
+        """
+        tolerance = app.config.get('BELIEF_SKILL_TOLERANCE', 0.05)
+        used_skills = app.redis.hgetall(
+            redis_get_task_belief_skills_var(self.task_id))
+        if DEFAULT_SKILL_FIELD not in used_skills:
+            self.rebuildBeliefs()
+            return
+
+        for (w_id, skill) in self.skills.iteritems():
+            if (w_id not in used_skills or
+                abs(float(used_skills[w_id]) - belief_skill(skill)) >
+                tolerance):
+                print "Skill estimates changed, rebuilding beliefs"
+                self.rebuildBeliefs()
+                return
+
+    def rebuildBeliefs(self):
+        """Recalculate belief states for each question in the task from all
+        completed answers, using the latest EM skill estimates, and store them.
+
+        The new state is written to temporary keys and renamed over the
+        stored one in a single transaction, so answers coming in during the
+        Mongo scan cannot abort it. Answers completed since shortly before
+        the scan are then folded in again, update_question_belief skipping
+        those the scan already saw.
+        """
+        beliefs_var = redis_get_task_beliefs_var(self.task_id)
+        skills_var = redis_get_task_belief_skills_var(self.task_id)
+        answers_var = redis_get_task_belief_answers_var(self.task_id)
+        votes_var = redis_get_task_belief_votes_var(self.task_id)
+        bucket_width = app.config.get('POLICY_DECISION_TABLE_SKILL_BUCKET', 0.1)
+        scan_start = datetime.datetime.now() - BELIEF_REBUILD_MARGIN
+
+        rows = {}
+        for q_id in self.getQuestions().scalar('id'):
+            rows[str(q_id)] = len(rows)
+
+        #Record the skill of every EM worker, including those without
+        #binary answers, so syncBeliefs does not rebuild for them
+        used_skills = {w : belief_skill(skill) for
+                       (w, skill) in self.skills.iteritems()}
+        used_skills[DEFAULT_SKILL_FIELD] = belief_skill(self.average_gamma)
+        votes = {}
+        answer_ids = []
+        questions = []
+        observations = []
+        skills = []
+        answers = self.getCompletedAnswers().only(
+            'question', 'worker', 'value').as_pymongo()
+        for answer in answers:
+            # answer value must be "0" or "1"
+            if answer.get('value') not in ("0", "1"):
+                continue
+            q = str(answer['question'])
+            w = str(answer['worker'])
+            w_skill = belief_skill(self.skills.get(w, self.average_gamma))
+            used_skills[w] = w_skill
+            answer_ids.append(str(answer['_id']))
+            questions.append(rows.setdefault(q, len(rows)))
+            observations.append(int(answer['value']))
+            skills.append(w_skill)
+            count = votes.setdefault(q, {}).setdefault(
+                str(skill_bucket(w_skill, bucket_width)), [0, 0])
+            count[int(answer['value'])] += 1
+
+        engine = BeliefEngine(len(rows), self.num_difficulty_bins,
+                              self.num_answer_choices)
+        engine.observe(questions, observations, skills)
+        beliefs = engine.beliefs()
+        belief_dict = {q : json.dumps(beliefs[row].tolist()) for
+                       (q, row) in rows.iteritems()}
+        votes_dict = {q : json.dumps(votes.get(q, {})) for q in rows}
+
+        #Temporary keys expire in case we die before renaming them
+        suffix = '_rebuild_%s' % uuid.uuid4().hex
+        temp_vars = {}
+        pipe = app.redis.pipeline(transaction=False)
+        for (var, values) in [(beliefs_var, belief_dict),
+                              (votes_var, votes_dict),
+                              (skills_var, used_skills)]:
+            if len(values) > 0:
+                temp_vars[var] = var + suffix
+                pipe.hmset(var + suffix, values)
+        if len(answer_ids) > 0:
+            temp_vars[answers_var] = answers_var + suffix
+            pipe.sadd(answers_var + suffix, *answer_ids)
+        for temp_var in temp_vars.itervalues():
+            pipe.expire(temp_var, BELIEF_REBUILD_TEMP_TTL)
+        pipe.execute()
+
+        pipe = app.redis.pipeline()
+        pipe.delete(beliefs_var, skills_var, answers_var, votes_var)
+        for (var, temp_var) in temp_vars.iteritems():
+            pipe.rename(temp_var, var)
+            pipe.persist(var)
+        pipe.execute()
+
+        recent = self.getCompletedAnswers().filter(
+            complete_time__gte=scan_start).only(
+                'question', 'worker', 'value').as_pymongo()
+        for answer in recent:
+            update_question_belief(self.task_id, answer['_id'],
+                                   answer['question'], answer['worker'],
+                                   answer.get('value'),
+                                   self.skills.get(str(answer['worker'])))
 
     def getAverageGamma(self, EM_results):
         """
@@ -247,50 +450,399 @@ class POMDPController():
     def getQuestions(self):
         return schema.question.Question.objects(task=self.task)
 
+    def getPolicyParams(self):
+        """
+        Every parameter of the POMDP model, identifies its policy in the
+        policy store. Worker skill is rounded to 0.1 so similar tasks share
+        policies.
+        """
+        return dai_policy_params(self.average_gamma, self.reward_incorrect,
+                                 self.discount, self.timeout)
+
     def getPolicy(self):
         """
-        Solve POMDP policy based on current parameters
+        Get POMDP policy for the current parameters from the policy store.
+
+        If it has not been solved yet, a solve_policy job is queued and the
+        closest solved policy is used meanwhile (see refreshPolicy).
+        Returns None if no policy has been solved at all; requests never
+        wait for a solve.
         """
-        # NOTE Naming scheme of POMDP policy files:
-        # dai_<worker skill rounded to 0.1>_<reward for incorrect answer>.policy
-        # i.e. 'dai_1.0_-100' is the policy for the Dai-AIJ13 pomdp with
-        # average worker skill = 1.0 and reward for incorrect answer of -100
-        filename = 'dai_%.1f_%s.policy' % (self.average_gamma, self.reward_incorrect)
-        if os.path.isdir(self.policy_dir) and os.path.isfile(self.policy_dir + '/' + filename):
-            #previously solved
-            policy = pomdp_policy.POMDPPolicy(self.policy_dir + '/' + filename, file_format='zmdp', n_states= self.num_states)
+        params = self.getPolicyParams()
+        policy = policy_store.get(params)
+        if policy is not None:
+            return policy
+
+        queue_policy_solve(params)
+        self.policy_is_fallback = True
+        policy = policy_store.nearest(params)
+        if policy is not None:
+            print "Using nearest solved policy until ours is ready"
         else:
-            #have to solve it
-            zpomdp = pomdp.ZPOMDP()
-            policy = zpomdp.solve(self.pomdp_var.states, self.pomdp_var.actions, self.pomdp_var.observations,
-                                  self.pomdp_var.CLOSURE_f_start(self.num_states),
-                                  self.pomdp_var.f_transition,
-                                  self.pomdp_var.CLOSURE_f_observation(self.average_gamma),
-                                  self.pomdp_var.CLOSURE_f_reward(self.reward_create, self.reward_correct, self.reward_incorrect),
-                                  discount=self.discount, timeout=self.timeout, directory=self.policy_dir)
-
-            #save our new policy where we can find it again
-            #rename p.policy to filename w/params
-            shutil.move(self.policy_dir + '/p.policy', self.policy_dir + '/' + filename)
+            print "No policy solved yet"
         return policy
 
+    def refreshPolicy(self):
+        """
+        If serving a fallback policy, or none, switch to the policy for our
+        parameters once it is published, or to the nearest one while we
+        have none. Checks at most every POLICY_REFRESH_INTERVAL seconds.
+        """
+        if not self.policy_is_fallback:
+            return
+        now = time.time()
+        if now - self.policy_checked < app.config.get('POLICY_REFRESH_INTERVAL', 5):
+            return
+        self.policy_checked = now
+        params = self.getPolicyParams()
+        policy = policy_store.get(params)
+        if policy is not None:
+            print "Switching to newly solved policy"
+            self.policy = policy
+            self.policy_is_fallback = False
+        elif self.policy is None:
+            self.policy = policy_store.nearest(params)
+
+    def hasPolicy(self):
+        """
+        Whether a policy, ours or a fallback, is available for assignment.
+        """
+        self.refreshPolicy()
+        return self.policy is not None
+
     def HELPER_update_belief(self, old_belief, observation, gamma):
         """
         Update belief for question q_id based on observation by worker with skill=gamma
         Will convert observation to integer 1 or 0 if it is a string
         """
-        observation = int(observation)
-        #print "old_belief:", old_belief, type(old_belief)
-        #print "observation:", observation, type(observation)
-        #print "gamma:", gamma, type(gamma)
-
-        diffs = [0.1*i for i in range(self.num_difficulty_bins)]
-        new_belief = util.updateBelief(old_belief, None, observation, diffs, gamma)
-        #print "new_belief", new_belief, type(new_belief)
-        return new_belief
+        return update_belief(old_belief, observation, gamma)
 
     def HELPER_init_belief(self):
         """
         Uniform over non-terminal states, append terminal state w/p=0
         """
-        return util.initBelief(self.num_answer_choices, self.num_difficulty_bins)
+        return init_belief()
+
+
+def dai_policy_params(average_gamma, reward_incorrect, discount, timeout):
+    """
+    Parameters of the Dai et al POMDP, see POMDPController.getPolicyParams.
+    Includes how the solved policy is pruned, so differently pruned
+    policies are stored apart.
+    """
+    prune = app.config.get('POLICY_PRUNE', 'exact')
+    prune_max_votes = None
+    if prune == 'approximate':
+        prune_max_votes = app.config.get('POLICY_PRUNE_MAX_VOTES', 20)
+    return {'model' : 'dai',
+            'average_gamma' : round(average_gamma, 1),
+            'reward_incorrect' : reward_incorrect,
+            'reward_correct' : REWARD_CORRECT,
+            'reward_create' : REWARD_CREATE,
+            'discount' : discount,
+            'timeout' : timeout,
+            'num_difficulty_bins' : NUM_DIFFICULTY_BINS,
+            'num_answer_choices' : NUM_ANSWER_CHOICES,
+            'solver' : app.config.get('POLICY_SOLVER', 'zmdp'),
+            'prune' : prune,
+            'prune_max_votes' : prune_max_votes}
+
+def policy_grid():
+    """
+    Parameters of every policy in the configured grid of
+    POLICY_GRID_GAMMAS x POLICY_GRID_REWARD_INCORRECT x POLICY_GRID_DISCOUNTS
+    """
+    return [dai_policy_params(gamma, reward_incorrect, discount,
+                              app.config.get('POLICY_GRID_TIMEOUT', 300))
+            for gamma in app.config.get('POLICY_GRID_GAMMAS', [])
+            for reward_incorrect in app.config.get('POLICY_GRID_REWARD_INCORRECT', [])
+            for discount in app.config.get('POLICY_GRID_DISCOUNTS', [])]
+
+def preload_policy_grid():
+    """
+    Load every solved policy of the grid into the in-process LRU.
+    Returns the number of policies loaded.
+    """
+    grid = policy_grid()
+    policy_store.cache_size = max(policy_store.cache_size, len(grid))
+    return len([params for params in grid if
+                policy_store.get(params) is not None])
+
+@app.before_first_request
+def preload_policies():
+    """
+    With POLICY_PRELOAD, load the grid policies when a web process starts
+    serving, rather than when this module is imported.
+    """
+    if app.config.get('POLICY_PRELOAD', False):
+        print "Preloaded %d grid policies" % preload_policy_grid()
+
+@worker_process_init.connect
+def preload_worker_policies(**kwargs):
+    """
+    Same as preload_policies, in each celery worker process.
+    """
+    preload_policies()
+
+@app.celery.task(name='warm_policy_grid')
+def warm_policy_grid():
+    """
+    Queue a solve_policy job for every policy of the grid not stored yet,
+    so the celery workers solve them in parallel.
+    """
+    queued = 0
+    for params in policy_grid():
+        if policy_store.get(params) is None:
+            solve_policy.delay(params)
+            queued += 1
+    print "Queued %d policy solves" % queued
+    return queued
+
+def solve_dai_policy(params, directory='policies'):
+    """
+    Solve the Dai et al POMDP described by params (see getPolicyParams)
+    """
+    pomdp_var = pomdp_peng.PengPOMDP(params['num_difficulty_bins'],
+                                     params['average_gamma'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start, T, O, R = pomdp_var.model_arrays(params['average_gamma'],
+                                            params['reward_create'],
+                                            params['reward_correct'],
+                                            params['reward_incorrect'])
+    if params['solver'] == 'pbvi':
+        solver = pomdp.PBVIPOMDP()
+    else:
+        solver = pomdp.ZPOMDP()
+    policy = solver.solve_arrays(pomdp_var.states, pomdp_var.actions,
+                                 pomdp_var.observations, start, T, O, R,
+                                 discount=params['discount'],
+                                 timeout=params['timeout'],
+                                 directory=directory)
+    if params['prune'] == 'approximate':
+        before, after = policy.prune(reachable_beliefs(
+            params, params['prune_max_votes']))
+    elif params['prune'] == 'exact':
+        before, after = policy.prune()
+    else:
+        return policy
+    print "Pruned policy %s from %d to %d alpha vectors" % (
+        policy_key(params), before, after)
+    return policy
+
+def reachable_beliefs(params, max_votes):
+    """
+    Beliefs of a question after every mix of up to max_votes votes from
+    workers of average skill, plus the terminal belief.
+    """
+    counts = [(ones, zeros) for ones in range(max_votes + 1) for
+              zeros in range(max_votes + 1 - ones)]
+    engine = BeliefEngine(len(counts), params['num_difficulty_bins'],
+                          params['num_answer_choices'])
+    questions = [q for (q, (ones, zeros)) in enumerate(counts) for
+                 _ in range(ones + zeros)]
+    observations = [v for (ones, zeros) in counts for
+                    v in [1] * ones + [0] * zeros]
+    engine.observe(questions, observations,
+                   [params['average_gamma']] * len(questions))
+    terminal = np.zeros((1, engine.num_states))
+    terminal[0, -1] = 1.0
+    return np.vstack([engine.beliefs(), terminal])
+
+@app.celery.task(name='solve_policy')
+def solve_policy(params):
+    """
+    Solve and store the policy for params unless it already is
+    """
+    policy_store.get_or_solve(params, lambda: solve_dai_policy(params))
+    return policy_key(params)
+
+def queue_policy_solve(params):
+    """
+    Queue a solve_policy job, unless one was queued within the solve lease
+    """
+    queued_var = redis_get_policy_queued_var(policy_key(params))
+    if app.redis.set(queued_var, 1, nx=True, ex=policy_store.lease):
+        solve_policy.delay(params)
+
+def update_belief(old_belief, observation, gamma):
+    """
+    Update a question belief based on observation by worker with skill=gamma
+    Will convert observation to integer 1 or 0 if it is a string
+    """
+    observation = int(observation)
+    diffs = [0.1*i for i in range(NUM_DIFFICULTY_BINS)]
+    return util.updateBelief(old_belief, None, observation, diffs, gamma)
+
+def init_belief():
+    """
+    Uniform over non-terminal states, append terminal state w/p=0
+    """
+    return util.initBelief(NUM_ANSWER_CHOICES, NUM_DIFFICULTY_BINS)
+
+def belief_skill(skill):
+    """
+    Worker skill to update beliefs with, at least MIN_BELIEF_SKILL
+    """
+    return max(float(skill), MIN_BELIEF_SKILL)
+
+def update_question_belief(task_id, answer_id, question_id, worker_id, value,
+                           worker_skill=None):
+    """
+    Fold one completed answer into the stored belief of its question.
+
+    Args:
+        answer_id, question_id, worker_id: ids of the answer, its question
+            and its worker
+        value: the answer's value
+        worker_skill: EM skill estimate of the worker, if any
+
+    Does nothing if the task's beliefs are not maintained (no POMDP
+    controller has built them yet), if the answer is not binary, or if
+    the answer was already included by a rebuild.
+    Returns True if the belief was updated.
+    """
+    if value not in ("0", "1"):
+        return False
+
+    skills_var = redis_get_task_belief_skills_var(task_id)
+    #Most tasks have no POMDP beliefs, so check before watching anything
+    if not app.redis.hexists(skills_var, DEFAULT_SKILL_FIELD):
+        return False
+
+    beliefs_var = redis_get_task_beliefs_var(task_id)
+    answers_var = redis_get_task_belief_answers_var(task_id)
+    votes_var = redis_get_task_belief_votes_var(task_id)
+    a_id = str(answer_id)
+    q_id = str(question_id)
+    w_id = str(worker_id)
+    bucket_width = app.config.get('POLICY_DECISION_TABLE_SKILL_BUCKET', 0.1)
+
+    pipe = app.redis.pipeline()
+    while 1:
+        try:
+            pipe.watch(beliefs_var, skills_var, answers_var, votes_var)
+            if not pipe.hexists(skills_var, DEFAULT_SKILL_FIELD):
+                return False
+            if pipe.sismember(answers_var, a_id):
+                return False
+
+            #Use the skill the stored beliefs were built with, so a later
+            #change in the estimate is noticed by syncBeliefs
+            w_skill = pipe.hget(skills_var, w_id)
+            if w_skill is None:
+                w_skill = worker_skill
+            if w_skill is None:
+                w_skill = pipe.hget(skills_var, DEFAULT_SKILL_FIELD)
+            w_skill = belief_skill(w_skill)
+
+            stored = pipe.hget(beliefs_var, q_id)
+            if stored is None:
+                belief = init_belief()
+            else:
+                belief = json.loads(stored)
+            belief = update_belief(belief, value, w_skill)
+
+            stored = pipe.hget(votes_var, q_id)
+            votes = {} if stored is None else json.loads(stored)
+            count = votes.setdefault(
+                str(skill_bucket(w_skill, bucket_width)), [0, 0])
+            count[int(value)] += 1
+
+            pipe.multi()
+            pipe.hset(beliefs_var, q_id, json.dumps(belief))
+            pipe.hset(votes_var, q_id, json.dumps(votes))
+            pipe.hsetnx(skills_var, w_id, w_skill)
+            pipe.sadd(answers_var, a_id)
+            pipe.execute()
+            return True
+        except WatchError:
+            continue
+        finally:
+            pipe.reset()
+
+
+class POMDPControllerCache():
+    """
+    Process-level cache of POMDP controllers, one per task and settings,
+    so that EM estimates and the parsed policy are reused across requests.
+
+    A cached controller is rebuilt when it is older than ttl seconds,
+    when its task has gained max_new_answers live answers since it was
+    built, when the task lost live answers (requeues, deletions, resets)
+    or when the task was invalidated by any process.
+    Hits and misses are counted in Redis across all processes.
+    """
+    def __init__(self, ttl, max_new_answers, max_tasks):
+        self.ttl = ttl
+        self.max_new_answers = max_new_answers
+        self.max_tasks = max_tasks
+        self.entries = {}
+
+    def get(self, task_id, settings={}):
+        """
+        Return a controller for the task, building it if needed.
+        """
+        key = (str(task_id), json.dumps(settings, sort_keys=True))
+        (num_answers, generation) = app.redis.mget(
+            redis_get_task_live_answers_var(task_id),
+            redis_get_pomdp_controller_generation_var(task_id))
+        if num_answers is None:
+            #The live answer counter is built on the next assignment
+            num_answers = schema.answer.Answer.objects(
+                task=task_id, is_alive=True).count()
+        num_answers = int(num_answers)
+        now = time.time()
+
+        entry = self.entries.get(key)
+        if (entry is not None and
+            now - entry['created'] < self.ttl and
+            entry['generation'] == generation and
+            0 <= num_answers - entry['num_answers'] < self.max_new_answers):
+            self.count('hits')
+            return entry['controller']
+
+        self.count('misses')
+        controller = self.build(task_id, settings)
+        self.entries[key] = {'controller' : controller,
+                             'created' : now,
+                             'generation' : generation,
+                             'num_answers' : num_answers}
+
+        #Evict the oldest controllers if too many tasks are cached
+        while len(self.entries) > self.max_tasks:
+            oldest = min(self.entries,
+                         key=lambda k: self.entries[k]['created'])
+            del self.entries[oldest]
+        return controller
+
+    def build(self, task_id, settings):
+        return POMDPController(task_id, settings)
+
+    def invalidate(self, task_id):
+        """
+        Drop all cached controllers of the task, in every process.
+        """
+        app.redis.incr(redis_get_pomdp_controller_generation_var(task_id))
+        for key in self.entries.keys():
+            if key[0] == str(task_id):
+                del self.entries[key]
+
+    def count(self, event):
+        app.redis.hincrby(redis_get_pomdp_controller_cache_stats_var(),
+                          event, 1)
+
+    def stats(self):
+        """
+        Returns dict with the hit and miss counts of all processes
+        and the number of controllers cached in this process.
+        """
+        counts = app.redis.hgetall(redis_get_pomdp_controller_cache_stats_var())
+        return {'hits' : int(counts.get('hits', 0)),
+                'misses' : int(counts.get('misses', 0)),
+                'cached_in_process' : len(self.entries)}
+
+controller_cache = POMDPControllerCache(
+    app.config.get('POMDP_CONTROLLER_CACHE_TTL', 300),
+    app.config.get('POMDP_CONTROLLER_CACHE_MAX_NEW_ANSWERS', 20),
+    app.config.get('POMDP_CONTROLLER_CACHE_MAX_TASKS', 100))
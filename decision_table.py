@@ -0,0 +1,116 @@
+"""
+Memoized POMDP decisions for the Dai et al model.
+
+With worker skills rounded into buckets, the belief of a question depends
+only on how many votes of each value it got from each skill bucket. The
+same few vote counts come up over and over (most questions have a handful
+of votes), so the action rewards for each are computed once per policy and
+then looked up.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from belief import BeliefEngine
+
+def skill_bucket(skill, width=0.1):
+    """
+    Index of the skill bucket of a worker, bucket b stands for skill b*width.
+    """
+    return int(round(float(skill) / width))
+
+def vote_counts_key(counts):
+    """
+    Hashable key of a question's vote counts.
+
+    Args:
+        counts: dict {skill bucket : [votes for 0, votes for 1]}
+    """
+    return tuple(sorted((int(bucket), int(zeros), int(ones)) for
+                        (bucket, (zeros, ones)) in counts.iteritems()))
+
+def num_votes(key):
+    return sum(zeros + ones for (bucket, zeros, ones) in key)
+
+
+class DecisionTable():
+    """
+    LRU table from vote counts to the policy's action rewards.
+
+    Args:
+        policy: POMDPPolicy of the Dai et al POMDP
+        bucket_width: width of the skill buckets, see skill_bucket
+        max_entries: number of vote counts remembered
+    """
+    def __init__(self, policy, num_difficulty_bins=11, num_answer_choices=2,
+                 bucket_width=0.1, max_entries=10000):
+        self.policy = policy
+        self.num_difficulty_bins = num_difficulty_bins
+        self.num_answer_choices = num_answer_choices
+        self.bucket_width = bucket_width
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_action_rewards(self, keys):
+        """
+        Returns (keys x actions) matrix, same as
+        POMDPPolicy.get_action_rewards_batch for the beliefs of the keys.
+        """
+        out = np.empty((len(keys), len(self.policy.actions)))
+        missing = OrderedDict()
+        with self.lock:
+            for (i, key) in enumerate(keys):
+                rewards = self.entries.pop(key, None)
+                if rewards is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self.entries[key] = rewards
+                    out[i] = rewards
+            #repeats of a new key within the batch are computed once
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        if len(missing) == 0:
+            return out
+
+        #Evaluate all new vote counts in one batch
+        engine = BeliefEngine(len(missing), self.num_difficulty_bins,
+                              self.num_answer_choices)
+        questions = []
+        observations = []
+        skills = []
+        for (row, key) in enumerate(missing):
+            for (bucket, zeros, ones) in key:
+                questions += [row] * (zeros + ones)
+                observations += [0] * zeros + [1] * ones
+                skills += [bucket * self.bucket_width] * (zeros + ones)
+        engine.observe(questions, observations, skills)
+        rewards = self.policy.get_action_rewards_batch(engine.beliefs())
+
+        with self.lock:
+            for (row, (key, rows)) in enumerate(missing.iteritems()):
+                out[rows] = rewards[row]
+                self.entries.pop(key, None)
+                self.entries[key] = rewards[row]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return out
+
+
+#One table per loaded policy, dropped along with the policy
+_tables = weakref.WeakKeyDictionary()
+_tables_lock = threading.Lock()
+
+def decision_table(policy, **kwargs):
+    """
+    Return the DecisionTable of the policy, making it on first use.
+    """
+    with _tables_lock:
+        table = _tables.get(policy)
+        if table is None:
+            table = DecisionTable(policy, **kwargs)
+            _tables[policy] = table
+        return table
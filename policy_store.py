@@ -0,0 +1,250 @@
+"""
+Shared store of solved POMDP policies.
+
+Policies are addressed by a hash of every parameter of the model they were
+solved for, saved in the binary 'npz' policy format, and kept in a pluggable
+backend so each distinct POMDP is solved once for the whole fleet. Recently
+used policies are also kept in an in-process LRU.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import gridfs
+from mongoengine.connection import get_db
+import pomdp_policy
+from app import app
+from redis_util import redis_get_policy_lock_var
+
+#Delete a lock only if we still hold it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lock_script = app.redis.register_script(RELEASE_LOCK_SCRIPT)
+
+def policy_key(params):
+    """
+    Hash of a dict of model parameters, same for equal dicts.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+class LocalPolicyBackend():
+    """
+    Keeps policies in a directory of the local filesystem.
+    Only shared between processes on the same host.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Return path of the stored npz file, or None if not stored.
+        """
+        path = self.path(key)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def put(self, key, policy, params):
+        policy.save(self.path(key))
+        tmp_path = '%s.%d.tmp' % (self.params_path(key), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(params, f)
+        os.rename(tmp_path, self.params_path(key))
+
+    def params_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def list_params(self):
+        """
+        Return dict {key : params} of every stored policy.
+        """
+        out = {}
+        for filename in os.listdir(self.directory):
+            key, ext = os.path.splitext(filename)
+            if ext == '.json':
+                with open(os.path.join(self.directory, filename)) as f:
+                    out[key] = json.load(f)
+        return out
+
+
+class GridFSPolicyBackend(LocalPolicyBackend):
+    """
+    Keeps policies in Mongo GridFS, shared by every dyno and worker.
+    Downloaded policies are cached in a local directory so they can be
+    memory mapped.
+    """
+    def __init__(self, directory, collection='policies'):
+        LocalPolicyBackend.__init__(self, directory)
+        self.collection = collection
+
+    def fs(self):
+        return gridfs.GridFS(get_db(), collection=self.collection)
+
+    def get(self, key):
+        path = LocalPolicyBackend.get(self, key)
+        if path is not None:
+            return path
+
+        fs = self.fs()
+        if not fs.exists(filename=key):
+            return None
+        path = self.path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(fs.get_last_version(filename=key).read())
+        os.rename(tmp_path, path)
+        return path
+
+    def put(self, key, policy, params):
+        LocalPolicyBackend.put(self, key, policy, params)
+        fs = self.fs()
+        if not fs.exists(filename=key):
+            with open(self.path(key), 'rb') as f:
+                fs.put(f, filename=key, params=params)
+
+    def list_params(self):
+        files = get_db()[self.collection + '.files']
+        return {f['filename'] : f['params'] for f in
+                files.find({'params' : {'$exists' : True}},
+                           {'filename' : True, 'params' : True})}
+
+
+class PolicyStore():
+    """
+    Content-addressed policy store with an in-process LRU in front of
+    a backend.
+
+    Args:
+        backend: LocalPolicyBackend or GridFSPolicyBackend
+        cache_size: number of policies kept in memory
+        lease: seconds a process may hold the lock to solve a policy
+        poll_interval: seconds between checks while waiting for a solve
+    """
+    def __init__(self, backend, cache_size=16, lease=900, poll_interval=1.0):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, params):
+        """
+        Return the POMDPPolicy solved for these parameters, or None.
+        """
+        key = policy_key(params)
+        with self.lock:
+            if key in self.cache:
+                policy = self.cache.pop(key)
+                self.cache[key] = policy
+                return policy
+
+        path = self.backend.get(key)
+        if path is None:
+            return None
+        policy = pomdp_policy.POMDPPolicy(path, file_format='npz')
+        self.remember(key, policy)
+        return policy
+
+    def put(self, params, policy):
+        """
+        Store a policy solved for these parameters.
+        """
+        key = policy_key(params)
+        self.backend.put(key, policy, params)
+        self.remember(key, policy)
+
+    def nearest(self, params):
+        """
+        Return the stored policy closest to these parameters, or None.
+
+        Candidates must match every parameter except average_gamma,
+        reward_incorrect and timeout. Distance is the absolute gamma
+        difference plus the relative reward_incorrect difference.
+        """
+        def distance(other):
+            for name in params:
+                if (name not in ('average_gamma', 'reward_incorrect', 'timeout')
+                    and other.get(name) != params[name]):
+                    return None
+            reward_scale = max(abs(params['reward_incorrect']), 1)
+            return (abs(other['average_gamma'] - params['average_gamma']) +
+                    abs(other['reward_incorrect'] - params['reward_incorrect']) /
+                    float(reward_scale))
+
+        best_params, best_distance = None, None
+        for other in self.backend.list_params().itervalues():
+            d = distance(other)
+            if d is not None and (best_distance is None or d < best_distance):
+                best_params, best_distance = other, d
+        if best_params is None:
+            return None
+        return self.get(best_params)
+
+    def get_or_solve(self, params, solve, wait=True):
+        """
+        Return the policy for these parameters, calling solve() to make it
+        if no process has yet.
+
+        Only one process in the fleet solves each set of parameters at a
+        time. Others wait for its result, or get None straight away if
+        wait is False. If the solver dies, its lease expires and a waiter
+        takes over.
+        """
+        lock_var = redis_get_policy_lock_var(policy_key(params))
+        while 1:
+            policy = self.get(params)
+            if policy is not None:
+                return policy
+
+            token = str(uuid.uuid4())
+            if app.redis.set(lock_var, token, nx=True, ex=self.lease):
+                try:
+                    #solved while we were taking the lock?
+                    policy = self.get(params)
+                    if policy is None:
+                        policy = solve()
+                        self.put(params, policy)
+                    return policy
+                finally:
+                    release_lock_script(keys=[lock_var], args=[token])
+
+            if not wait:
+                return None
+            time.sleep(self.poll_interval)
+
+    def remember(self, key, policy):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = policy
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+def make_policy_store():
+    """
+    Build the policy store described by the app config.
+    """
+    directory = app.config.get('POLICY_STORE_DIR', 'policies')
+    if app.config.get('POLICY_STORE_BACKEND', 'gridfs') == 'gridfs':
+        backend = GridFSPolicyBackend(directory)
+    else:
+        backend = LocalPolicyBackend(directory)
+    return PolicyStore(backend, app.config.get('POLICY_STORE_CACHE_SIZE', 16),
+                       app.config.get('POLICY_SOLVE_LEASE', 900),
+                       app.config.get('POLICY_SOLVE_POLL_INTERVAL', 1.0))
+
+policy_store = make_policy_store()
@@ -3,7 +3,9 @@
 import os
 import subprocess
 import tempfile
+import time
 import shutil
+import numpy as np
 import pomdp_policy
 
 class POMDP(object):
@@ -15,45 +17,71 @@ class POMDP(object):
         """Return parsed policy."""
         raise NotImplementedError
 
+    @staticmethod
+    def closures_to_arrays(states, actions, observations, f_start,
+                           f_transition, f_observation, f_reward):
+        """
+        Evaluate model closures once into arrays, returns tuple
+        (start[s], T[a,s,s1], O[a,s1,o], R[a,s]).
+        R[a,s] is the expected immediate reward of taking a in s.
+        """
+        start = np.array([f_start(s) for s in states], dtype=np.float64)
+        T = np.array([[[f_transition(s, a, s1) for s1 in states]
+                       for s in states] for a in actions], dtype=np.float64)
+        O = np.array([[[f_observation(s1, a, o) for o in observations]
+                       for s1 in states] for a in actions], dtype=np.float64)
+        R_full = np.array([[[f_reward(s, a, s1) for s1 in states]
+                            for s in states] for a in actions], dtype=np.float64)
+        R = (T * R_full).sum(axis=2)
+        return start, T, O, R
+
     def write_cassandra(self, fo, states, actions, observations, f_start,
                         f_transition, f_observation, f_reward, discount):
         """Write a Cassandra-style POMDP file."""
+        start, T, O, R = self.closures_to_arrays(
+            states, actions, observations, f_start, f_transition,
+            f_observation, f_reward)
+        self.write_cassandra_arrays(fo, states, actions, observations,
+                                    start, T, O, R, discount)
+
+    def write_cassandra_arrays(self, fo, states, actions, observations,
+                               start, T, O, R, discount):
+        """
+        Write a Cassandra-style POMDP file from model arrays
+        (see closures_to_arrays). Only non-zero entries are written,
+        the format defaults the rest to 0.
+        """
         if discount >= 1.0:
             raise Exception('Discount must be less than 1.0')
 
+        states = [str(s) for s in states]
+        actions = [str(a) for a in actions]
+        observations = [str(o) for o in observations]
+
         # Write header
         fo.write('discount: {}\n'.format(discount))
         fo.write('values: reward\n')
-        fo.write('states: {}\n'.format(' '.join(str(s) for s in states)))
-        fo.write('actions: {}\n'.format(' '.join(str(a) for a in actions)))
+        fo.write('states: {}\n'.format(' '.join(states)))
+        fo.write('actions: {}\n'.format(' '.join(actions)))
         fo.write('observations: {}\n'.format(' '.join(observations)))
 
-        fo.write('start: {}\n'.format(' '.join(str(f_start(s)) for
-                                               s in states)))
+        fo.write('start: {}\n'.format(' '.join(repr(float(p)) for
+                                               p in start)))
 
         fo.write('\n\n### Transitions\n')
-        for s in states:
-            for a in actions:
-                for s1 in states:
-                    fo.write('T: {} : {} : {} {}\n'.format(
-                        a, s, s1, f_transition(s, a, s1)))
-                fo.write('\n')
+        fo.writelines('T: %s : %s : %s %r\n' % (
+            actions[a], states[s], states[s1], float(T[a, s, s1]))
+            for (a, s, s1) in zip(*np.nonzero(T)))
 
         fo.write('\n\n### Observations\n')
-        for s in states:
-            for a in actions:
-                for o in observations:
-                    fo.write('O: {} : {} : {} {}\n'.format(
-                        a, s, o, f_observation(s, a, o)))
-                fo.write('\n')
+        fo.writelines('O: %s : %s : %s %r\n' % (
+            actions[a], states[s1], observations[o], float(O[a, s1, o]))
+            for (a, s1, o) in zip(*np.nonzero(O)))
 
         fo.write('\n\n### Rewards\n')
-        for s in states:
-            for a in actions:
-                for s1 in states:
-                    fo.write('R: {} : {} : {} : * {}\n'.format(
-                        a, s, s1, f_reward(s, a, s1)))
-                fo.write('\n')
+        fo.writelines('R: %s : %s : * : * %r\n' % (
+            actions[a], states[s], float(R[a, s]))
+            for (a, s) in zip(*np.nonzero(R)))
 
 
 class ZPOMDP(POMDP):
@@ -62,40 +90,232 @@ class ZPOMDP(POMDP):
         pass
 
     def solve(self, states, actions, observations, f_start, f_transition,
-              f_observation, f_reward, discount, timeout=None, directory=None):
+              f_observation, f_reward, discount, timeout=None, directory=None,
+              policy_filename=None):
         """
-        Optional: save model and policy files in pre-existing directory
+        Solve a model given by closures, see solve_arrays
+        """
+        start, T, O, R = self.closures_to_arrays(
+            states, actions, observations, f_start, f_transition,
+            f_observation, f_reward)
+        return self.solve_arrays(states, actions, observations, start, T, O,
+                                 R, discount, timeout=timeout,
+                                 directory=directory,
+                                 policy_filename=policy_filename)
+
+    def solve_arrays(self, states, actions, observations, start, T, O, R,
+                     discount, timeout=None, directory=None,
+                     policy_filename=None):
+        """
+        Model and policy files are written to a fresh temporary directory,
+        so concurrent solves never share files.
+        Optional: create the temporary directory in pre-existing directory
+        Optional: atomically publish the policy file as policy_filename,
+        which must be on the same filesystem as directory
         """
         if directory:
-            # save files in user directory
             assert os.path.isdir(directory)
-            d = directory
-        else:
-            # temporary, only return policy
-            d = tempfile.mkdtemp()
-
-        model_filename = os.path.join(d, 'm.pomdp')
-        policy_filename = os.path.join(d, 'p.policy')
-        with open(model_filename, 'w') as f:
-            self.write_cassandra(
-                f, states, actions, observations, f_start,
-                f_transition, f_observation, f_reward, discount)
-        args = [os.environ['ZMDP_ALIAS'], 'solve', model_filename,
-                '-o', policy_filename]
-        if timeout:
-            args += ['-t', str(timeout)]
-
-        print args
-        exit_status = subprocess.call(args)
-
-        # NOTE check that solver ran successfully
-        assert exit_status == 0
-
-        # parse policy output
-        policy = pomdp_policy.POMDPPolicy(policy_filename, file_format='zmdp', n_states=len(states))
-
-        if not directory:
+        d = tempfile.mkdtemp(dir=directory)
+
+        try:
+            model_filename = os.path.join(d, 'm.pomdp')
+            solved_filename = os.path.join(d, 'p.policy')
+            with open(model_filename, 'w') as f:
+                self.write_cassandra_arrays(
+                    f, states, actions, observations, start, T, O, R,
+                    discount)
+            args = [os.environ['ZMDP_ALIAS'], 'solve', model_filename,
+                    '-o', solved_filename]
+            if timeout:
+                args += ['-t', str(timeout)]
+
+            print args
+            exit_status = subprocess.call(args)
+
+            # NOTE check that solver ran successfully
+            assert exit_status == 0
+
+            # parse policy output
+            policy = pomdp_policy.POMDPPolicy(solved_filename, file_format='zmdp', n_states=len(states))
+
+            if policy_filename:
+                os.rename(solved_filename, policy_filename)
+        finally:
             # delete temporary directory
             shutil.rmtree(d)
-            
+
         return policy
+
+
+class PBVIPOMDP(POMDP):
+    """
+    In-process point-based value iteration (PBVI) solver.
+
+    Alternates between expanding a set of reachable beliefs (stochastic
+    simulation with exploratory actions) and backing up alpha vectors at
+    every belief in the set, all with NumPy. Meant for small models like
+    PengPOMDP, no external solver needed.
+
+    Args:
+        max_beliefs: stop expanding the belief set beyond this size
+        max_stalls: stop expanding after this many expansions in a row
+            found no new belief
+        tolerance: backups stop when no belief value improves by more
+        seed: for the random belief expansion
+    """
+    def __init__(self, max_beliefs=1000, tolerance=1e-6, seed=0, max_stalls=3):
+        self.max_beliefs = max_beliefs
+        self.max_stalls = max_stalls
+        self.tolerance = tolerance
+        self.random = np.random.RandomState(seed)
+
+    def solve(self, states, actions, observations, f_start, f_transition,
+              f_observation, f_reward, discount, timeout=None, directory=None,
+              policy_filename=None):
+        """
+        Solve a model given by closures, see solve_arrays
+        """
+        start, T, O, R = self.closures_to_arrays(
+            states, actions, observations, f_start, f_transition,
+            f_observation, f_reward)
+        return self.solve_arrays(states, actions, observations, start, T, O,
+                                 R, discount, timeout=timeout)
+
+    def solve_arrays(self, states, actions, observations, start, T, O, R,
+                     discount, timeout=None, directory=None,
+                     policy_filename=None):
+        """
+        Anytime: returns the best policy found within timeout seconds, or
+        when converged on the largest belief set. directory and
+        policy_filename are accepted for compatibility and ignored.
+        Returns POMDPPolicy.
+        """
+        if discount >= 1.0:
+            raise Exception('Discount must be less than 1.0')
+        deadline = time.time() + timeout if timeout else None
+        def out_of_time():
+            return deadline is not None and time.time() > deadline
+
+        alphas, alpha_actions = self.blind_alphas(T, R, discount)
+        beliefs = np.array([start], dtype=np.float64)
+        stalled = 0
+        while 1:
+            converged = False
+            while not converged and not out_of_time():
+                alphas, alpha_actions, converged = self.backup(
+                    beliefs, alphas, alpha_actions, T, O, R, discount)
+            if out_of_time() or len(beliefs) >= self.max_beliefs:
+                break
+            expanded = self.expand(beliefs, T, O)
+            # expansion is random, give up after a few without new beliefs
+            stalled = stalled + 1 if len(expanded) == len(beliefs) else 0
+            if stalled >= self.max_stalls:
+                break
+            beliefs = expanded
+
+        return pomdp_policy.POMDPPolicy.from_arrays(alpha_actions, alphas)
+
+    @staticmethod
+    def blind_alphas(T, R, discount):
+        """
+        Value of always taking the same action, one alpha vector per
+        action. A lower bound to start from.
+        """
+        n_actions, n_states = R.shape
+        alphas = np.array([np.linalg.solve(
+            np.eye(n_states) - discount * T[a], R[a]) for a in range(n_actions)])
+        return alphas, np.arange(n_actions)
+
+    def sample(self, p):
+        """
+        Draw one index from each row of probabilities p.
+        """
+        u = self.random.random_sample((len(p), 1))
+        return (p.cumsum(axis=1) > u * p.sum(axis=1)[:, np.newaxis]).argmax(axis=1)
+
+    @staticmethod
+    def distances(points, beliefs):
+        """
+        Euclidean distance from each point to the closest belief.
+        """
+        squared = ((points ** 2).sum(axis=1)[:, np.newaxis] +
+                   (beliefs ** 2).sum(axis=1)[np.newaxis, :] -
+                   2 * points.dot(beliefs.T))
+        return np.sqrt(np.maximum(squared.min(axis=1), 0))
+
+    def expand(self, beliefs, T, O):
+        """
+        For every belief, simulate one step of every action and add the
+        successor farthest from the belief set.
+        """
+        n_actions = T.shape[0]
+        rows = np.arange(len(beliefs))
+        best = np.zeros_like(beliefs)
+        best_distance = np.zeros(len(beliefs))
+        for a in range(n_actions):
+            s = self.sample(beliefs)
+            s1 = self.sample(T[a, s])
+            o = self.sample(O[a, s1])
+            # O[a, :, o] puts the belief axis first
+            predicted = beliefs.dot(T[a]) * O[a, :, o]
+            p_o = predicted.sum(axis=1)
+            possible = p_o > 0
+            successors = np.zeros_like(beliefs)
+            successors[possible] = (predicted[possible] /
+                                    p_o[possible][:, np.newaxis])
+            distance = np.where(possible,
+                                self.distances(successors, beliefs), 0.0)
+            # round-off, not a new belief
+            distance[distance < 1e-6] = 0.0
+            better = distance > best_distance
+            best[better] = successors[better]
+            best_distance[better] = distance[better]
+
+        # add new successors, farthest first, without duplicates
+        new = best[rows[best_distance > 0]]
+        order = np.argsort(-best_distance[best_distance > 0])
+        new = new[order][:self.max_beliefs - len(beliefs)]
+        if len(new) == 0:
+            return beliefs
+        _, unique = np.unique(np.round(new, 12).view(
+            np.dtype((np.void, new.shape[1] * 8))), return_index=True)
+        return np.vstack([beliefs, new[np.sort(unique)]])
+
+    def backup(self, beliefs, alphas, alpha_actions, T, O, R, discount):
+        """
+        One point-based backup at every belief. A belief keeps its current
+        best alpha vector unless the backup improves its value.
+        Returns (alphas, alpha_actions, converged).
+        """
+        n_actions, n_obs = R.shape[0], O.shape[2]
+        values = beliefs.dot(alphas.T)
+        old_best = values.argmax(axis=1)
+        old_values = values[np.arange(len(beliefs)), old_best]
+
+        best_values = np.full(len(beliefs), -np.inf)
+        best_alphas = np.zeros((len(beliefs), alphas.shape[1]))
+        best_actions = np.zeros(len(beliefs), dtype=np.int64)
+        for a in range(n_actions):
+            alpha_a = np.tile(R[a], (len(beliefs), 1))
+            for o in range(n_obs):
+                # g[s,i] = discount * sum_s1 T[a,s,s1] O[a,s1,o] alphas[i,s1]
+                g = discount * T[a].dot(O[a, :, o][:, np.newaxis] * alphas.T)
+                best_i = beliefs.dot(g).argmax(axis=1)
+                alpha_a += g[:, best_i].T
+            value_a = (beliefs * alpha_a).sum(axis=1)
+            better = value_a > best_values
+            best_values[better] = value_a[better]
+            best_alphas[better] = alpha_a[better]
+            best_actions[better] = a
+
+        improved = best_values > old_values
+        new_alphas = np.where(improved[:, np.newaxis], best_alphas,
+                              alphas[old_best])
+        new_actions = np.where(improved, best_actions,
+                               alpha_actions[old_best])
+
+        # drop duplicate alpha vectors
+        _, unique = np.unique(np.hstack([new_alphas, new_actions[:, np.newaxis]]).view(
+            np.dtype((np.void, (alphas.shape[1] + 1) * 8))), return_index=True)
+        converged = (best_values - old_values).max() <= self.tolerance
+        return new_alphas[unique], new_actions[unique], converged
@@ -2,20 +2,26 @@
 Dai et al POMDP from aij paper.
 """
 import itertools
+import numpy as np
 
 TERMINAL_STATE = "TERMINAL-STATE"
 
 def is_terminal_state(s):
     return s == TERMINAL_STATE
 
+#state string => (d,v), so each string is only parsed once
+_parsed_states = {}
+
 def get_state(state_string):
     """Helper for Peng POMDP because Cassandra format doesn't work w/ (d,v) state pairs"""
     if state_string == TERMINAL_STATE:
         return TERMINAL_STATE
-    s = state_string.split("---")[1:]
-    d = float(s[0].replace("point","."))
-    v = True if s[1] == 'True' else False
-    return (d,v)
+    if state_string not in _parsed_states:
+        s = state_string.split("---")[1:]
+        d = float(s[0].replace("point","."))
+        v = True if s[1] == 'True' else False
+        _parsed_states[state_string] = (d,v)
+    return _parsed_states[state_string]
 
 def make_state(d,v):
     return "d-v---" + str(d).replace(".","point") + "---" + str(v)
@@ -36,6 +42,9 @@ class PengPOMDP(object):
         #NOTE additional terminal state - don't forget when computing probabilities
         #NOTE ordering: [(True,0.0),...,(True,1.0),(False,0.0),...,(False,1.0),<TERMINAL STATE>]
         self.states = [make_state(d,v) for v,d in itertools.product(answers, bins)] + [TERMINAL_STATE]
+        #structured form of the non-terminal states, in the same order
+        self.state_difficulties = np.array([d for v,d in itertools.product(answers, bins)])
+        self.state_values = np.array([v for v,d in itertools.product(answers, bins)])
         self.actions = ['create-another-job', 'submit-true', 'submit-false']
         self.observations = ['True', 'False', 'None']
         self.avg_worker_skill = avg_worker_skill
@@ -43,6 +52,42 @@ class PengPOMDP(object):
 #       self.reward_correct = reward_correct
 #       self.reward_incorrect = reward_incorrect
 
+    def model_arrays(self, gamma, create=-1, correct=0, incorrect=-10):
+        """
+        Vectorized equivalent of the closures below, same as
+        pomdp.POMDP.closures_to_arrays on them.
+        Returns tuple (start[s], T[a,s,s1], O[a,s1,o], R[a,s]).
+        """
+        n = len(self.states) - 1
+        terminal = n
+        create_job, submit_true, submit_false = range(3)
+        obs_true, obs_false, obs_none = range(3)
+        values = self.state_values
+
+        start = np.zeros(n + 1)
+        start[:n] = 1.0 / n
+
+        # terminal state stays, create stays in place, submit terminates
+        T = np.zeros((3, n + 1, n + 1))
+        T[:, terminal, terminal] = 1
+        T[create_job, :n, :n] = np.eye(n)
+        T[submit_true:, :n, terminal] = 1
+
+        # P(o = v|d) = a(d,gamma) = 0.5*(1+(1-d)^gamma) when creating a job
+        O = np.zeros((3, n + 1, 3))
+        O[:, terminal, obs_none] = 1
+        O[submit_true:, :, obs_none] = 1
+        p_correct = 0.5 * (1 + (1 - self.state_difficulties) ** gamma)
+        O[create_job, :n, obs_true] = np.where(values, p_correct, 1 - p_correct)
+        O[create_job, :n, obs_false] = np.where(values, 1 - p_correct, p_correct)
+
+        R = np.zeros((3, n + 1))
+        R[create_job, :n] = create
+        R[submit_true, :n] = np.where(values, correct, incorrect)
+        R[submit_false, :n] = np.where(values, incorrect, correct)
+
+        return start, T, O, R
+
     @staticmethod
     def CLOSURE_f_start(num_states):
         #NOTE assumes label prior = 0.5, difficulty prior = uniform over bins
@@ -1,7 +1,9 @@
 from __future__ import division
+import os
+import struct
+import zipfile
 import numpy as np
 import zmdp_util
-import random
 
 class POMDPPolicy:
     '''
@@ -17,8 +19,15 @@ class POMDPPolicy:
 
         pMatrix        The policy matrix, constructed from all of the
                        alpha vectors.
+
+        values         pMatrix as floats. Undefined zMDP entries are 0.
+
+        mask           Boolean matrix, True where an alpha vector entry is
+                       defined. A zMDP alpha vector only applies to beliefs
+                       with no mass on its undefined states.
     '''
-    def __init__(self, filename, file_format='policyx', n_states=None):
+    def __init__(self, filename, file_format='policyx', n_states=None,
+                 prune=False):
         self.file_format = file_format
         if file_format == 'policyx':
             tree = ee.parse(filename)
@@ -56,57 +65,240 @@ class POMDPPolicy:
             self.action_nums = [int(line.split()[n_states]) for
                                 line in lines_max_horizon]
         elif file_format == 'zmdp':
-            actions, alphas = zmdp_util.read_zmdp_policy(filename, n_states)
-            self.action_nums = actions
-            self.pMatrix = np.array(alphas)
+            actions, values, mask = zmdp_util.read_zmdp_policy_arrays(
+                filename, n_states)
+            self.action_nums = actions.tolist()
+            self.pMatrix = values
+            self.mask = mask
+        elif file_format == 'arrays':
+            # filled in by from_arrays
+            return
+        elif file_format == 'npz':
+            arrays = load_policy_npz(filename)
+            self.action_nums = arrays['actions'].tolist()
+            self.pMatrix = arrays['values']
+            self.mask = arrays['mask']
         else:
             raise NotImplementedError
+        self.init_matrices()
+        if prune:
+            self.prune()
 
-    def __repr__(self):
-        return "pMatrix: " + str(self.pMatrix) + "\naction_nums: " + str(self.action_nums)
+    @classmethod
+    def from_arrays(cls, action_nums, values, mask=None):
+        '''
+        Build a policy from alpha vectors held in memory, i.e. from an
+        in-process solver. mask defaults to every entry defined.
+        '''
+        policy = cls(None, file_format='arrays')
+        policy.action_nums = list(action_nums)
+        policy.pMatrix = np.asarray(values, dtype=np.float64)
+        if mask is not None:
+            policy.mask = np.asarray(mask, dtype=bool)
+        policy.init_matrices()
+        return policy
+
+    def init_matrices(self):
+        '''
+        Precompute the float value matrix, the mask of defined entries and
+        the alpha vector columns of each action for batched evaluation.
+        '''
+        self.values = np.asarray(self.pMatrix, dtype=np.float64)
+        if not hasattr(self, 'mask'):
+            self.mask = np.ones(self.values.shape, dtype=bool)
+        #The mask stays as loaded (possibly memory-mapped), only its
+        #summary is kept
+        self.fully_defined = bool(self.mask.all())
+        self.actions = np.unique(self.action_nums)
+        action_nums = np.asarray(self.action_nums)
+        self.action_columns = [np.flatnonzero(action_nums == a) for
+                               a in self.actions]
+
+    def prune(self, beliefs=None):
+        '''
+        Drop alpha vectors that can never give the max reward of their
+        action, keeping get_action_rewards unchanged.
 
-    def zmdp_filter(self, belief, alpha):
-        """Return true iff this alpha vector applies to this belief"""
-        return not any(b > 0 and a is None for b,a in zip(belief, alpha))
+        Exact: drops vectors pointwise dominated by another vector of the
+        same action that applies wherever they do.
+        Approximate, only if a (beliefs x states) matrix is given: also
+        drops vectors that give their action's max at none of the beliefs.
 
-    def zmdp_convert(self, alpha):
-        """Return new array with Nones replaced with 0's"""
-        return [a if a is not None else 0 for a in alpha]
+        Returns tuple (alpha vectors before, alpha vectors after).
+        '''
+        before = len(self.action_nums)
+        action_nums = np.asarray(self.action_nums)
+        keep = np.zeros(before, dtype=bool)
+        for columns in self.action_columns:
+            keep[columns] = ~self.dominated(self.values[columns],
+                                            self.mask[columns])
+
+        if beliefs is not None:
+            beliefs = np.atleast_2d(beliefs)
+            rewards = beliefs.dot(self.values.T)
+            rewards[:, ~keep] = -np.inf
+            if not self.fully_defined:
+                rewards[self.not_applicable(beliefs)] = -np.inf
+            used = np.zeros(before, dtype=bool)
+            for columns in self.action_columns:
+                best = columns[rewards[:, columns].argmax(axis=1)]
+                applicable = rewards[:, columns].max(axis=1) > -np.inf
+                used[best[applicable]] = True
+            keep &= used
+
+        self.action_nums = action_nums[keep].tolist()
+        self.pMatrix = self.values[keep]
+        self.mask = self.mask[keep]
+        self.init_matrices()
+        return before, len(self.action_nums)
+
+    @staticmethod
+    def dominated(values, mask, chunk=256):
+        '''
+        Returns bool array, True for each alpha vector pointwise dominated
+        by another one that is defined wherever it is. Of identical
+        vectors only the first is kept.
+        '''
+        n = len(values)
+        out = np.zeros(n, dtype=bool)
+        order = np.arange(n)
+        for start in range(0, n, chunk):
+            v = values[start:start+chunk, np.newaxis, :]
+            undefined = ~mask[start:start+chunk, np.newaxis, :]
+            # by[i,j]: j >= i wherever i is defined, and j is defined there
+            by = (undefined | (mask[np.newaxis, :, :] &
+                               (values[np.newaxis, :, :] >= v))).all(axis=2)
+            # equal[i,j]: identical vectors, i.e. i also dominates j
+            equal = (undefined | (values[np.newaxis, :, :] == v)).all(axis=2) & \
+                    (mask[np.newaxis, :, :] == ~undefined).all(axis=2)
+            rows = order[start:start+chunk, np.newaxis]
+            by &= ~equal | (order[np.newaxis, :] < rows)
+            out[start:start+chunk] = by.any(axis=1)
+        return out
+
+    def save(self, filename):
+        '''
+        Save the policy in the binary 'npz' format.
+        '''
+        save_policy_npz(filename, self.action_nums, self.values, self.mask)
+
+    def __repr__(self):
+        return "pMatrix: " + str(self.pMatrix) + "\naction_nums: " + str(self.action_nums)
 
     def get_best_action(self, belief):
         '''
         Returns tuple:
             (best-action-num, expected-reward-for-this-action).
         '''
-        res = self.get_action_rewards(belief)
-        max_reward = max(res.itervalues())
-        best_action = random.choice([a for a in res if res[a] == max_reward])
-        return (best_action, max_reward)
-
+        best_actions, max_rewards = self.get_best_actions_batch([belief])
+        return (int(best_actions[0]), max_rewards[0])
 
     def get_action_rewards(self, belief):
         '''
         Returns dictionary:
             action-num: max expected-reward.
         '''
-        if self.file_format == 'zmdp':
-            alpha_indices_relevant = [
-                i for i,alpha in enumerate(self.pMatrix) if
-                self.zmdp_filter(belief, alpha)]
-            alphas = []
-            actions = []
-            for i in alpha_indices_relevant:
-                alphas.append(self.zmdp_convert(self.pMatrix[i,:]))
-                actions.append(self.action_nums[i])
-            alphas = np.array(alphas)
-        else:
-            alphas = self.pMatrix
-            actions = self.action_nums
-        res = alphas.dot(belief)
-        d = dict()
-        for a,r in zip(actions, res):
-            if a not in d:
-                d[a] = r
+        rewards = self.get_action_rewards_batch([belief])[0]
+        return {int(a):r for a,r in zip(self.actions, rewards) if
+                r != -np.inf}
+
+    def get_action_rewards_batch(self, beliefs):
+        '''
+        Evaluate many beliefs at once.
+
+        Arguments:
+            beliefs - (beliefs x states) matrix
+
+        Returns (beliefs x actions) matrix of max expected rewards, with
+        columns in the order of self.actions and -inf where no alpha
+        vector of the action applies.
+        '''
+        beliefs = np.atleast_2d(np.asarray(beliefs, dtype=np.float64))
+        rewards = beliefs.dot(self.values.T)
+        if not self.fully_defined:
+            rewards[self.not_applicable(beliefs)] = -np.inf
+
+        out = np.empty((beliefs.shape[0], len(self.actions)))
+        for (i, columns) in enumerate(self.action_columns):
+            out[:, i] = rewards[:, columns].max(axis=1)
+        return out
+
+    def not_applicable(self, beliefs):
+        '''
+        Returns (beliefs x alpha vectors) bool matrix, True where the
+        belief has mass on any of the alpha vector's undefined states.
+        Beliefs are grouped by the states they have mass on, so the mask
+        is read once per group of states.
+        '''
+        support = beliefs > 0
+        groups = {}
+        for (i, row) in enumerate(support):
+            groups.setdefault(row.tostring(), []).append(i)
+        out = np.empty((len(beliefs), len(self.action_nums)), dtype=bool)
+        for rows in groups.itervalues():
+            out[rows] = ~self.mask[:, support[rows[0]]].all(axis=1)
+        return out
+
+    def get_best_actions_batch(self, beliefs):
+        '''
+        Returns tuple of arrays, one entry per belief:
+            (best-action-nums, expected-rewards-for-these-actions).
+        Ties are broken at random.
+        '''
+        return self.choose_best_actions(self.get_action_rewards_batch(beliefs))
+
+    def choose_best_actions(self, rewards):
+        '''
+        Same as get_best_actions_batch, from the matrix returned by
+        get_action_rewards_batch.
+        '''
+        max_rewards = rewards.max(axis=1)
+        ties = rewards == max_rewards[:, np.newaxis]
+        choice = np.argmax(ties * np.random.random(ties.shape), axis=1)
+        return (self.actions[choice], max_rewards)
+
+
+def save_policy_npz(filename, actions, values, mask):
+    """
+    Write policy arrays to an uncompressed .npz file, so that
+    load_policy_npz can memory map them.
+    The file is written under a temporary name and renamed into place.
+    """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, actions=np.asarray(actions, dtype=np.int64),
+                 values=np.asarray(values, dtype=np.float64),
+                 mask=np.asarray(mask, dtype=bool))
+    os.rename(tmp_filename, filename)
+
+def load_policy_npz(filename):
+    """
+    Return dict of read-only arrays memory mapped from an uncompressed .npz
+    file, so that processes loading the same policy share its pages.
+    """
+    arrays = {}
+    with open(filename, 'rb') as f:
+        for info in zipfile.ZipFile(f).infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise Exception('Compressed npz policies cannot be memory mapped')
+
+            # local file header is 30 bytes + file name + extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+
+            name = os.path.splitext(info.filename)[0]
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
             else:
-                d[a] = max(d[a], r)
-        return d
+                arrays[name] = np.memmap(f, dtype=dtype, mode='r',
+                                         offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
@@ -6,3 +6,48 @@ def redis_get_worker_assignments_var(task_id, worker_id):
 
 def redis_get_task_queue_var(task_id, strategy):
     return "queue_task%s_strategy%s" % (task_id, strategy)
+
+def redis_get_task_question_meta_var(task_id):
+    return "qmeta_task%s" % task_id
+
+def redis_get_task_question_names_var(task_id):
+    return "qnames_task%s" % task_id
+
+def redis_get_task_live_answers_var(task_id):
+    return "live_answers_task%s" % task_id
+
+def redis_get_worker_open_assignments_var(task_id, worker_source, worker_id):
+    return "open_task%s_worker%s_%s" % (task_id, worker_source, worker_id)
+
+def redis_get_task_open_assignment_workers_var(task_id):
+    return "open_workers_task%s" % task_id
+
+def redis_get_task_question_live_answers_var(task_id):
+    return "live_answers_questions_task%s" % task_id
+
+def redis_get_task_open_questions_var(task_id):
+    return "open_questions_task%s" % task_id
+
+def redis_get_pomdp_controller_cache_stats_var():
+    return "pomdp_controller_cache_stats"
+
+def redis_get_pomdp_controller_generation_var(task_id):
+    return "pomdp_controller_generation_task%s" % task_id
+
+def redis_get_task_beliefs_var(task_id):
+    return "beliefs_task%s" % task_id
+
+def redis_get_task_belief_skills_var(task_id):
+    return "belief_skills_task%s" % task_id
+
+def redis_get_task_belief_answers_var(task_id):
+    return "belief_answers_task%s" % task_id
+
+def redis_get_task_belief_votes_var(task_id):
+    return "belief_votes_task%s" % task_id
+
+def redis_get_policy_lock_var(policy_key):
+    return "policy_lock%s" % policy_key
+
+def redis_get_policy_queued_var(policy_key):
+    return "policy_queued%s" % policy_key
@@ -13,4 +13,9 @@ class Task(db.DynamicDocument):
     assignment_duration = db.IntField()
     
     total_task_budget = db.IntField()
+
+    # Mapping inference strategy -> what its last run covered
+    # Example format:
+    # 'EM' : {'complete_time' : answers completed until, 'num_answers' : n}
+    inference_state = db.DictField()
     
@@ -2,11 +2,14 @@ import traceback
 import unittest
 import schema
 from app import app, db, user_datastore
-from redis_util import redis_get_worker_assignments_var, redis_get_task_queue_var
+from redis_util import redis_get_worker_assignments_var, redis_get_task_queue_var, redis_get_task_question_meta_var, redis_get_task_question_names_var, redis_get_task_live_answers_var, redis_get_worker_open_assignments_var, redis_get_task_open_assignment_workers_var, redis_get_task_open_questions_var, redis_get_task_question_live_answers_var
+from api.util import get_cached_question, reconcile_live_answers, requeue, clear_task_open_assignments, OPEN_ASSIGNMENTS_LOADED, LIVE_ANSWERS_BUILT
+from controllers.pomdp_controller import POMDPController, controller_cache
 from flask.ext.security.registerable import register_user
 import uuid
 import json
 import time
+import datetime
 import psutil
 
 def clear_db():
@@ -1457,6 +1460,630 @@ class AppTestCase(unittest.TestCase):
 
         
         
+    def test_assign_min_answers_script(self):
+        test_question1_name = uuid.uuid1().hex
+        test_question1 = dict(question_name=test_question1_name,
+                              question_description='test question 1',
+                              question_data='1',
+                              requester_id=str(self.test_requester.id))
+
+        test_question2_name = uuid.uuid1().hex
+        test_question2 = dict(question_name=test_question2_name,
+                              question_description='test question 2',
+                              question_data='2',
+                              requester_id=str(self.test_requester.id))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='min_answers script test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=[test_question1, test_question2],
+                         answers_per_question=2)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+        q_ids = json.loads(rv.data)['question_ids']
+
+        task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
+
+        wt_pair_preview = dict(worker_id='MTURK_PREVIEW',
+                               worker_source='mturk',
+                               task_id=task_id,
+                               requester_id=str(self.test_requester.id),
+                               strategy='min_answers',
+                               preview=True)
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='min_answers')
+
+        #A preview picks a question but reserves nothing
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair_preview))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(json.loads(rv.data)['question_id'], q_ids)
+        self.assertEqual(0, len(schema.answer.Answer.objects(task=task_id)))
+        self.assertEqual(0, app.redis.zscore(task_queue_var, q_ids[0]))
+        self.assertEqual(0, app.redis.zscore(task_queue_var, q_ids[1]))
+        worker = schema.worker.Worker.objects.get(platform_id='MTURK_PREVIEW')
+        self.assertEqual(0, app.redis.scard(
+            redis_get_worker_assignments_var(task_id, worker.id)))
+
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        assign1 = json.loads(rv.data)
+        self.assertEqual(1, len(schema.answer.Answer.objects(task=task_id)))
+        self.assertEqual(1, app.redis.zscore(task_queue_var,
+                                             assign1['question_id']))
+
+        #The open assignment is handed back without a new reservation
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(assign1, json.loads(rv.data))
+        self.assertEqual(1, len(schema.answer.Answer.objects(task=task_id)))
+
+        #With unique_workers, the worker is not given its question again
+        test_answer = dict(question_name=assign1['question_name'],
+                           requester_id=str(self.test_requester.id),
+                           task_id=task_id,
+                           worker_id='MTURK_A',
+                           worker_source='mturk',
+                           value='1')
+        rv = self.app.put('/answers', content_type='application/json',
+                          data=json.dumps(test_answer))
+        self.assertEqual(200, rv.status_code)
+
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        assign2 = json.loads(rv.data)
+        self.assertNotEqual(assign1['question_id'], assign2['question_id'])
+
+        test_answer['question_name'] = assign2['question_name']
+        rv = self.app.put('/answers', content_type='application/json',
+                          data=json.dumps(test_answer))
+        self.assertEqual(200, rv.status_code)
+
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('error', json.loads(rv.data))
+
+        #A question leaves the queue once it reaches answers_per_question
+        for worker_id in ['MTURK_B', 'MTURK_C']:
+            wt_pair['worker_id'] = worker_id
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            self.assertIn('question_id', json.loads(rv.data))
+        self.assertEqual(0, app.redis.zcard(task_queue_var))
+        self.assertEqual(2, len(schema.answer.Answer.objects(
+            task=task_id, question=q_ids[0])))
+        self.assertEqual(2, len(schema.answer.Answer.objects(
+            task=task_id, question=q_ids[1])))
+
+        wt_pair['worker_id'] = 'MTURK_D'
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('error', json.loads(rv.data))
+
+    def test_assign_open_assignment_index(self):
+        questions = []
+        for i in range(2):
+            questions.append(dict(question_name=uuid.uuid1().hex,
+                                  question_description='question %d' % i,
+                                  question_data=str(i),
+                                  requester_id=str(self.test_requester.id)))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='open assignment test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=questions,
+                         assignment_duration=60)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+
+        open_var = redis_get_worker_open_assignments_var(task_id, 'mturk',
+                                                         'MTURK_A')
+        open_workers_var = redis_get_task_open_assignment_workers_var(task_id)
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='min_answers')
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        assign1 = json.loads(rv.data)
+        entry = json.loads(app.redis.hget(open_var, assign1['question_id']))
+        self.assertEqual(assign1['question_name'], entry['question_name'])
+        self.assertIsNotNone(entry['deadline'])
+        self.assertEqual(set([json.dumps(['mturk', 'MTURK_A'])]),
+                         app.redis.smembers(open_workers_var))
+
+        #The index is rebuilt from Mongo if Redis lost it
+        app.redis.delete(open_var)
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(assign1, json.loads(rv.data))
+        self.assertTrue(app.redis.hexists(open_var, OPEN_ASSIGNMENTS_LOADED))
+
+        #Answering closes the assignment
+        test_answer = dict(question_name=assign1['question_name'],
+                           requester_id=str(self.test_requester.id),
+                           task_id=task_id,
+                           worker_id='MTURK_A',
+                           worker_source='mturk',
+                           value='1')
+        rv = self.app.put('/answers', content_type='application/json',
+                          data=json.dumps(test_answer))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([OPEN_ASSIGNMENTS_LOADED], app.redis.hkeys(open_var))
+
+        #Clearing the task deletes the hashes of the recorded workers
+        clear_task_open_assignments(task_id)
+        self.assertFalse(app.redis.exists(open_var))
+        self.assertFalse(app.redis.exists(open_workers_var))
+
+    def test_assign_random_open_questions(self):
+        questions = []
+        for i in range(3):
+            questions.append(dict(question_name=uuid.uuid1().hex,
+                                  question_description='question %d' % i,
+                                  question_data=str(i),
+                                  requester_id=str(self.test_requester.id)))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='random strategy test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=questions,
+                         answers_per_question=2)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+        q_ids = json.loads(rv.data)['question_ids']
+
+        open_questions_var = redis_get_task_open_questions_var(task_id)
+        counts_var = redis_get_task_question_live_answers_var(task_id)
+        live_answers_var = redis_get_task_live_answers_var(task_id)
+
+        #Questions answered without an assignment are not drawn again
+        test_answer = dict(question_name=questions[0]['question_name'],
+                           requester_id=str(self.test_requester.id),
+                           task_id=task_id,
+                           worker_id='MTURK_A',
+                           worker_source='mturk',
+                           is_alive=True,
+                           value='1')
+        rv = self.app.put('/answers', content_type='application/json',
+                          data=json.dumps(test_answer))
+        self.assertEqual(200, rv.status_code)
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='random')
+
+        #A preview reserves nothing
+        wt_pair['preview'] = True
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(json.loads(rv.data)['question_id'], q_ids[1:])
+        self.assertEqual(1, int(app.redis.get(live_answers_var)))
+        del wt_pair['preview']
+
+        drawn = set()
+        for i in range(2):
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            assignment = json.loads(rv.data)
+            self.assertNotEqual(q_ids[0], assignment['question_id'])
+            drawn.add(assignment['question_id'])
+            self.assertEqual(1, int(app.redis.hget(
+                counts_var, assignment['question_id'])))
+
+            test_answer['question_name'] = assignment['question_name']
+            rv = self.app.put('/answers', content_type='application/json',
+                              data=json.dumps(test_answer))
+            self.assertEqual(200, rv.status_code)
+        self.assertEqual(set(q_ids[1:]), drawn)
+        self.assertEqual(3, int(app.redis.get(live_answers_var)))
+
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('error', json.loads(rv.data))
+        self.assertEqual(set(q_ids), app.redis.smembers(open_questions_var))
+
+        #Reserving the last slot of a question closes it
+        wt_pair['worker_id'] = 'MTURK_B'
+        for i in range(3):
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            self.assertIn('question_id', json.loads(rv.data))
+            wt_pair['worker_id'] = 'MTURK_B%d' % i
+        self.assertEqual(6, int(app.redis.get(live_answers_var)))
+        self.assertEqual(set(), app.redis.smembers(open_questions_var))
+
+        #Counters of a task with no open questions are not rebuilt
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='random strategy empty task',
+                         requester_id=str(self.test_requester.id),
+                         questions=[])
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+
+        wt_pair['task_id'] = task_id
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('error', json.loads(rv.data))
+        self.assertTrue(app.redis.hexists(
+            redis_get_task_question_live_answers_var(task_id),
+            LIVE_ANSWERS_BUILT))
+
+    def test_assign_bundle_and_single(self):
+        questions = []
+        for i in range(3):
+            questions.append(dict(question_name=uuid.uuid1().hex,
+                                  question_description='question %d' % i,
+                                  question_data=str(i),
+                                  requester_id=str(self.test_requester.id)))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='bundle test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=questions,
+                         answers_per_question=2,
+                         total_task_budget=4)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+
+        live_answers_var = redis_get_task_live_answers_var(task_id)
+
+        wt_bundle = dict(worker_id='MTURK_A',
+                         worker_source='mturk',
+                         task_id=task_id,
+                         requester_id=str(self.test_requester.id),
+                         num_questions=2)
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='min_answers')
+
+        rv = self.app.get('/assign_next_questions',
+                          content_type='application/json',
+                          data=json.dumps(wt_bundle))
+        self.assertEqual(200, rv.status_code)
+        bundle = json.loads(rv.data)['questions']
+        self.assertEqual(2, len(bundle))
+        self.assertEqual(2, len(schema.answer.Answer.objects(
+            task=task_id, status='Assigned')))
+        self.assertEqual(2, int(app.redis.get(live_answers_var)))
+
+        #The bundle's open assignments come back as they are
+        rv = self.app.get('/assign_next_questions',
+                          content_type='application/json',
+                          data=json.dumps(wt_bundle))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(
+            sorted(bundle, key=lambda q: q['question_id']),
+            sorted(json.loads(rv.data)['questions'],
+                   key=lambda q: q['question_id']))
+
+        #The single endpoint hands back one of the bundle's questions
+        #instead of reserving another one
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(json.loads(rv.data), bundle)
+        self.assertEqual(2, len(schema.answer.Answer.objects(
+            task=task_id, status='Assigned')))
+
+        #After a single assignment, a bundle returns that assignment
+        wt_pair['worker_id'] = 'MTURK_B'
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        single = json.loads(rv.data)
+
+        wt_bundle['worker_id'] = 'MTURK_B'
+        rv = self.app.get('/assign_next_questions',
+                          content_type='application/json',
+                          data=json.dumps(wt_bundle))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([single], json.loads(rv.data)['questions'])
+        self.assertEqual(3, int(app.redis.get(live_answers_var)))
+
+        #A bundle never goes over the total task budget
+        wt_bundle['worker_id'] = 'MTURK_C'
+        wt_bundle['num_questions'] = 3
+        rv = self.app.get('/assign_next_questions',
+                          content_type='application/json',
+                          data=json.dumps(wt_bundle))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, len(json.loads(rv.data)['questions']))
+        self.assertEqual(4, int(app.redis.get(live_answers_var)))
+
+        wt_bundle['worker_id'] = 'MTURK_D'
+        rv = self.app.get('/assign_next_questions',
+                          content_type='application/json',
+                          data=json.dumps(wt_bundle))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'error' : 'The total task budget has been reached'},
+                         json.loads(rv.data))
+
+    def test_assign_pomdp_without_policy(self):
+        test_question1 = dict(question_name=uuid.uuid1().hex,
+                              question_description='test question 1',
+                              question_data='1',
+                              requester_id=str(self.test_requester.id))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='pomdp test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=[test_question1])
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+        q_ids = json.loads(rv.data)['question_ids']
+
+        #A controller whose policy is still being solved
+        controller = POMDPController.__new__(POMDPController)
+        controller.policy = None
+        controller.policy_is_fallback = False
+        controller_cache.build = lambda task_id, settings: controller
+        try:
+            wt_pair = dict(worker_id='MTURK_A',
+                           worker_source='mturk',
+                           task_id=task_id,
+                           requester_id=str(self.test_requester.id),
+                           strategy='pomdp')
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            self.assertEqual(q_ids[0], json.loads(rv.data)['question_id'])
+        finally:
+            del controller_cache.build
+            controller_cache.invalidate(task_id)
+
+        #The question was reserved as with min_answers
+        task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
+        self.assertEqual(1, len(schema.answer.Answer.objects(
+            task=task_id, status='Assigned')))
+        self.assertIsNone(app.redis.zscore(task_queue_var, q_ids[0]))
+
+    def test_assign_total_budget_and_requeue(self):
+        questions = []
+        for i in range(3):
+            questions.append(dict(question_name=uuid.uuid1().hex,
+                                  question_description='question %d' % i,
+                                  question_data=str(i),
+                                  requester_id=str(self.test_requester.id)))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='total budget test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=questions,
+                         answers_per_question=2,
+                         total_task_budget=3)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+
+        live_answers_var = redis_get_task_live_answers_var(task_id)
+        task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='min_answers')
+
+        #Assignments stop at the total task budget
+        assigned = {}
+        for worker_id in ['MTURK_A', 'MTURK_B', 'MTURK_C']:
+            wt_pair['worker_id'] = worker_id
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            assigned[worker_id] = json.loads(rv.data)['question_id']
+        self.assertEqual(3, len(schema.answer.Answer.objects(
+            task=task_id, status='Assigned')))
+        self.assertEqual(3, int(app.redis.get(live_answers_var)))
+
+        wt_pair['worker_id'] = 'MTURK_D'
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'error' : 'The total task budget has been reached'},
+                         json.loads(rv.data))
+
+        #Requeueing an assignment frees its unit of the budget
+        requeue_data = dict(requester_id=str(self.test_requester.id),
+                            task_id=task_id,
+                            question_ids=[assigned['MTURK_A']],
+                            worker_ids=['MTURK_A'],
+                            worker_source='mturk',
+                            strategy='min_answers')
+        rv = self.app.post('/requeue', content_type='application/json',
+                           headers={'Authentication-Token':
+                                    self.test_requester_api_key},
+                           data=json.dumps(requeue_data))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, int(app.redis.get(live_answers_var)))
+        self.assertEqual(0, app.redis.zscore(task_queue_var,
+                                             assigned['MTURK_A']))
+        self.assertFalse(app.redis.hexists(
+            redis_get_worker_open_assignments_var(task_id, 'mturk',
+                                                  'MTURK_A'),
+            assigned['MTURK_A']))
+
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(assigned['MTURK_A'],
+                         json.loads(rv.data)['question_id'])
+        self.assertEqual(3, int(app.redis.get(live_answers_var)))
+
+        #Reconciling repairs a counter that drifted
+        app.redis.set(live_answers_var, 0)
+        reconcile_live_answers(task_id)
+        self.assertEqual(3, int(app.redis.get(live_answers_var)))
+
+        #Expired assignments are requeued and their answers deleted
+        schema.answer.Answer.objects(task=task_id, status='Assigned').update(
+            set__assign_time=datetime.datetime.now() -
+            datetime.timedelta(hours=2))
+        requeue()
+        self.assertEqual(0, len(schema.answer.Answer.objects(
+            task=task_id, status='Assigned')))
+        self.assertEqual(0, int(app.redis.get(live_answers_var)))
+
+        #A task without a total budget is not limited by one
+        schema.task.Task.objects(id=task_id).update(
+            unset__total_task_budget=True)
+        for worker_id in ['MTURK_E', 'MTURK_F', 'MTURK_G', 'MTURK_H']:
+            wt_pair['worker_id'] = worker_id
+            rv = self.app.get('/assign_next_question',
+                              content_type='application/json',
+                              data=json.dumps(wt_pair))
+            self.assertEqual(200, rv.status_code)
+            self.assertIn('question_id', json.loads(rv.data))
+
+    def test_assign_cached_metadata(self):
+        questions = []
+        for i in range(3):
+            questions.append(dict(question_name=uuid.uuid1().hex,
+                                  question_description='question %d' % i,
+                                  question_data=str(i),
+                                  requester_id=str(self.test_requester.id)))
+
+        test_task = dict(task_name=uuid.uuid1().hex,
+                         task_description='cached metadata test task',
+                         requester_id=str(self.test_requester.id),
+                         questions=questions)
+
+        rv = self.app.put('/tasks', content_type='application/json',
+                          headers={'Authentication-Token':
+                                   self.test_requester_api_key},
+                          data=json.dumps(test_task))
+        self.assertEqual(200, rv.status_code)
+        task_id = json.loads(rv.data)['task_id']
+        q_ids = json.loads(rv.data)['question_ids']
+        names = [q['question_name'] for q in questions]
+
+        meta_var = redis_get_task_question_meta_var(task_id)
+        names_var = redis_get_task_question_names_var(task_id)
+        self.assertEqual(3, app.redis.hlen(meta_var))
+        self.assertEqual(dict(zip(names, q_ids)), app.redis.hgetall(names_var))
+
+        #A miss loads just the question asked for
+        app.redis.delete(meta_var)
+        question = get_cached_question(task_id, question_name=names[1])
+        self.assertEqual(q_ids[1], str(question.id))
+        self.assertEqual('1', question.data)
+        self.assertEqual([q_ids[1]], app.redis.hkeys(meta_var))
+        self.assertIsNone(get_cached_question(task_id,
+                                              question_name='no such name'))
+
+        #A queued question deleted along with its metadata is dropped
+        #from the queue and another one assigned
+        task_queue_var = redis_get_task_queue_var(task_id, 'min_answers')
+        schema.question.Question.objects(id=q_ids[0]).delete()
+        app.redis.hdel(meta_var, q_ids[0])
+        app.redis.zadd(task_queue_var, -1, q_ids[0])
+
+        wt_pair = dict(worker_id='MTURK_A',
+                       worker_source='mturk',
+                       task_id=task_id,
+                       requester_id=str(self.test_requester.id),
+                       strategy='min_answers')
+        rv = self.app.get('/assign_next_question',
+                          content_type='application/json',
+                          data=json.dumps(wt_pair))
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(json.loads(rv.data)['question_id'], q_ids[1:])
+        self.assertIsNone(app.redis.zscore(task_queue_var, q_ids[0]))
+        worker = schema.worker.Worker.objects.get(platform_id='MTURK_A')
+        self.assertFalse(app.redis.sismember(
+            redis_get_worker_assignments_var(task_id, worker.id), q_ids[0]))
+
+        #Deleting the task deletes its Redis keys
+        delete_data = dict(requester_id=str(self.test_requester.id),
+                           task_id=task_id)
+        rv = self.app.post('/tasks/delete', content_type='application/json',
+                           headers={'Authentication-Token':
+                                    self.test_requester_api_key},
+                           data=json.dumps(delete_data))
+        self.assertEqual(200, rv.status_code)
+        for var in [meta_var, names_var, task_queue_var,
+                    redis_get_task_live_answers_var(task_id),
+                    redis_get_worker_assignments_var(task_id, worker.id)]:
+            self.assertFalse(app.redis.exists(var))
+
     def test_populate_db(self):
         # Start with clean DB for sanity
         clear_db()
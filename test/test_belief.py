@@ -0,0 +1,39 @@
+import unittest
+import numpy as np
+import util
+from belief import BeliefEngine
+
+class BeliefEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.diffs = [0.1*i for i in range(11)]
+        self.engine = BeliefEngine(3)
+
+    def test_init(self):
+        beliefs = self.engine.beliefs()
+        for q in range(3):
+            np.testing.assert_allclose(beliefs[q], util.initBelief(2, 11))
+
+    def test_matches_update_belief(self):
+        votes = [(0, 1, 1.0), (0, 0, 0.5), (2, 1, 2.3), (0, 1, 0.8),
+                 (2, 1, 1.7)]
+        questions, observations, skills = zip(*votes)
+        self.engine.observe(questions, observations, skills)
+
+        expected = [util.initBelief(2, 11) for q in range(3)]
+        for (q, o, g) in votes:
+            expected[q] = util.updateBelief(expected[q], None, o,
+                                            self.diffs, g)
+
+        np.testing.assert_allclose(self.engine.beliefs(), expected)
+
+    def test_long_history(self):
+        #Would underflow if accumulated as plain probabilities
+        n = 5000
+        self.engine.observe([1] * n, [1] * n, [3.0] * n)
+        belief = self.engine.beliefs(1)[0]
+        self.assertAlmostEqual(belief.sum(), 1.0)
+        self.assertTrue(np.all(np.isfinite(belief)))
+        self.assertGreater(belief[:11].sum(), 0.99)
+
+if __name__ == '__main__':
+    unittest.main()
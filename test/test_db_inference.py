@@ -5,6 +5,7 @@ import schema
 import random
 import itertools
 import time
+import datetime
 from aggregation import db_inference
 
 def randomID():
@@ -73,7 +74,8 @@ class EM_DB_TestCase(unittest.TestCase):
                     question=question,
                     task=test_task,
                     worker=worker,
-                    status='Completed')
+                    status='Completed',
+                    complete_time=datetime.datetime.now())
             voteDocs.append(v)
         print "pre insert time=", time.time()
         schema.answer.Answer.objects.insert(voteDocs)
@@ -91,6 +93,21 @@ class EM_DB_TestCase(unittest.TestCase):
         print "MV results:", res
 
 
+    def test_majority_votes(self):
+        """
+        Test majority vote counts from one aggregation
+        """
+        votes = db_inference.majority_votes(task_id=str(self.test_task.id))
+        self.assertEqual(len(votes), 10)
+        for (q_id, vote) in votes.iteritems():
+            self.assertEqual(sum(vote['counts'].values()), 5)
+            self.assertEqual(vote['count'], max(vote['counts'].values()))
+            self.assertEqual(vote['counts'][vote['label']], vote['count'])
+
+        q_id = votes.keys()[0]
+        self.assertEqual(db_inference.majority_votes(question_ids=[q_id]),
+                         {q_id : votes[q_id]})
+
     def test_db_em(self):
         """
         Test expectation maximization vote aggregation and skill/difficulty inference on DB
@@ -112,5 +129,85 @@ class EM_DB_TestCase(unittest.TestCase):
         print("Finished EM with DB...")
         print time.time()
 
+    def test_write_em_skips_unchanged(self):
+        """
+        Test writing the same EM results again writes nothing
+        """
+        res = db_inference.aggregate_task_EM(str(self.test_task.id))
+        n = len(res['posteriors']) + len(res['workers'])
+        self.assertEqual(db_inference.write_em(res),
+                         {'written' : 0, 'skipped' : n})
+
+        res['workers'] = {w_id : skill + 1 for (w_id, skill) in
+                          res['workers'].iteritems()}
+        self.assertEqual(db_inference.write_em(res, batch_size=2),
+                         {'written' : len(res['workers']),
+                          'skipped' : len(res['posteriors'])})
+
+    def test_load_votes(self):
+        """
+        Test votes are loaded as dense indices without dereferencing
+        """
+        votes = db_inference.load_votes(
+            db_inference.task_query(self.test_task.id, status='Completed'),
+            batch_size=7)
+        self.assertEqual(len(votes.values), 50)
+        self.assertEqual(len(votes.worker_ids), 5)
+        self.assertEqual(len(votes.question_ids), 10)
+        self.assertEqual(sorted(set(votes.workers.tolist())), range(5))
+        self.assertEqual(sorted(set(votes.questions.tolist())), range(10))
+        self.assertTrue(set(votes.values) <= set(['0', '1']))
+
+    def test_db_em_incremental(self):
+        """
+        Test incremental EM only adds the new worker after one new vote,
+        and ends up close to a full run on all votes
+        """
+        full = db_inference.aggregate_task_EM(str(self.test_task.id))
+
+        w = schema.worker.Worker(platform_id=randomID(),
+                                 platform_name="mturk")
+        w.save()
+        q = schema.question.Question.objects(task=self.test_task).first()
+        schema.answer.Answer(value='1', question=q, task=self.test_task,
+                             worker=w, status='Completed',
+                             complete_time=datetime.datetime.now()).save()
+
+        res = db_inference.aggregate_task_EM(str(self.test_task.id),
+                                             incremental=True)
+        self.assertEqual(set(res['workers']),
+                         set(full['workers']) | set([str(w.id)]))
+        self.assertEqual(set(res['posteriors']), set(full['posteriors']))
+        self.assertIn('skill', schema.worker.Worker.objects.get(
+            id=w.id).inference_results['EM'])
+
+        rerun = db_inference.run_em(db_inference.load_votes(
+            db_inference.task_query(self.test_task.id, status='Completed')))
+        for (q_id, posterior) in rerun['posteriors'].iteritems():
+            self.assertAlmostEqual(res['posteriors'][q_id], posterior,
+                                   delta=0.1)
+
+    def test_db_em_incremental_shared_workers(self):
+        """
+        Test incremental EM runs in full when another task's EM run
+        re-estimated one of the task's workers since the last run
+        """
+        db_inference.aggregate_task_EM(str(self.test_task.id))
+        answers = schema.answer.Answer.objects(task=self.test_task,
+                                               status='Completed')
+        result, changed = db_inference.run_em_incremental(
+            str(self.test_task.id), answers)
+        self.assertIsNotNone(result)
+
+        #As written by another task's run
+        w = answers.first().worker
+        schema.worker.Worker.objects(id=w.id).update_one(
+            set__inference_results__EM={
+                'skill' : 5.0,
+                'timestamp' : str(datetime.datetime.utcnow())})
+        result, changed = db_inference.run_em_incremental(
+            str(self.test_task.id), answers)
+        self.assertIsNone(result)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import numpy as np
+import util
+import pomdp_policy
+from decision_table import DecisionTable, decision_table, skill_bucket, vote_counts_key
+
+class DecisionTableTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.diffs = [0.1*i for i in range(11)]
+        self.policy = pomdp_policy.POMDPPolicy.from_arrays(
+            [0, 0, 1, 1, 2, 2], rng.uniform(-10, 0, (6, 23)))
+        self.table = DecisionTable(self.policy, max_entries=2)
+
+    def test_matches_beliefs(self):
+        votes = [(1.04, 1), (1.04, 1), (2.46, 0)]
+        counts = {}
+        belief = util.initBelief(2, 11)
+        for (skill, value) in votes:
+            counts.setdefault(str(skill_bucket(skill)), [0, 0])[value] += 1
+            belief = util.updateBelief(belief, None, value, self.diffs,
+                                       round(skill, 1))
+        self.assertEqual(vote_counts_key(counts), ((10, 0, 2), (25, 1, 0)))
+
+        rewards = self.table.get_action_rewards([vote_counts_key(counts), ()])
+        np.testing.assert_allclose(rewards, self.policy.get_action_rewards_batch(
+            [belief, util.initBelief(2, 11)]))
+
+    def test_lru(self):
+        keys = [(), ((10, 1, 0),), ((10, 0, 1),)]
+        first = self.table.get_action_rewards(keys[:2] + keys[:1])
+        self.assertEqual((self.table.hits, self.table.misses), (1, 2))
+        self.table.get_action_rewards(keys[2:])
+        self.assertEqual(list(self.table.entries), keys[1:])
+        np.testing.assert_allclose(self.table.get_action_rewards(keys[:2]),
+                                   first[:2])
+        self.assertEqual((self.table.hits, self.table.misses), (2, 4))
+
+    def test_one_table_per_policy(self):
+        self.assertIs(decision_table(self.policy), decision_table(self.policy))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pomdp_policy
+from app import app
+from redis_util import redis_get_policy_lock_var
+from policy_store import PolicyStore, LocalPolicyBackend, policy_key
+
+def make_params(**changes):
+    params = {'model' : 'dai',
+              'average_gamma' : 1.0,
+              'reward_incorrect' : -50,
+              'reward_correct' : 0,
+              'reward_create' : -1,
+              'discount' : 0.9999,
+              'timeout' : 300,
+              'num_difficulty_bins' : 11,
+              'num_answer_choices' : 2,
+              'solver' : 'zmdp'}
+    params.update(changes)
+    return params
+
+def make_policy(value):
+    """
+    One alpha vector per action, all equal to value, over 3 states.
+    """
+    return pomdp_policy.POMDPPolicy.from_arrays([0, 1, 2],
+                                                np.full((3, 3), value))
+
+class PolicyStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PolicyStore(LocalPolicyBackend(self.directory),
+                                 cache_size=2, lease=10, poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        app.redis.delete(redis_get_policy_lock_var(policy_key(make_params())))
+
+    def test_policy_key(self):
+        params = make_params()
+        reordered = dict(reversed(sorted(params.items())))
+        self.assertEqual(policy_key(params), policy_key(reordered))
+        self.assertEqual(policy_key(params), policy_key(make_params()))
+        self.assertNotEqual(policy_key(params),
+                            policy_key(make_params(discount=0.99)))
+        self.assertNotEqual(policy_key(params),
+                            policy_key(make_params(solver='pbvi')))
+
+    def test_put_get(self):
+        params = make_params()
+        self.assertIsNone(self.store.get(params))
+        self.store.put(params, make_policy(-1.0))
+
+        #Another process only sees the backend
+        store = PolicyStore(LocalPolicyBackend(self.directory))
+        policy = store.get(params)
+        self.assertEqual([0, 1, 2], policy.action_nums)
+        np.testing.assert_array_equal(np.full((3, 3), -1.0), policy.values)
+        self.assertEqual({policy_key(params) : params},
+                         store.backend.list_params())
+
+    def test_lru(self):
+        all_params = [make_params(average_gamma=gamma)
+                      for gamma in [1.0, 2.0, 3.0]]
+        for (i, params) in enumerate(all_params):
+            self.store.put(params, make_policy(-i))
+        self.assertEqual([policy_key(params) for params in all_params[1:]],
+                         self.store.cache.keys())
+
+        #A hit moves the policy to the end, a miss loads it from the backend
+        self.store.get(all_params[1])
+        policy = self.store.get(all_params[0])
+        np.testing.assert_array_equal(np.full((3, 3), 0.0), policy.values)
+        self.assertEqual([policy_key(all_params[1]),
+                          policy_key(all_params[0])],
+                         self.store.cache.keys())
+
+    def test_nearest(self):
+        params = make_params(average_gamma=1.3, reward_incorrect=-50)
+        self.assertIsNone(self.store.nearest(params))
+
+        #Only average_gamma, reward_incorrect and timeout may differ
+        self.store.put(make_params(average_gamma=1.3, discount=0.99),
+                       make_policy(-1.0))
+        self.store.put(make_params(average_gamma=1.3, solver='pbvi'),
+                       make_policy(-2.0))
+        self.assertIsNone(self.store.nearest(params))
+
+        self.store.put(make_params(average_gamma=2.0, timeout=60),
+                       make_policy(-3.0))
+        self.store.put(make_params(average_gamma=1.0, reward_incorrect=-100),
+                       make_policy(-4.0))
+        np.testing.assert_array_equal(np.full((3, 3), -3.0),
+                                      self.store.nearest(params).values)
+
+        self.store.put(make_params(average_gamma=1.5, reward_incorrect=-60),
+                       make_policy(-5.0))
+        np.testing.assert_array_equal(np.full((3, 3), -5.0),
+                                      self.store.nearest(params).values)
+
+    def test_get_or_solve_single_flight(self):
+        params = make_params()
+        lock_var = redis_get_policy_lock_var(policy_key(params))
+        started = threading.Event()
+        release = threading.Event()
+        solves = []
+
+        def solve():
+            solves.append(1)
+            started.set()
+            release.wait(10)
+            return make_policy(-1.0)
+
+        results = {}
+        def get_or_solve(name, store):
+            results[name] = store.get_or_solve(params, solve)
+
+        holder = threading.Thread(target=get_or_solve,
+                                  args=('holder', self.store))
+        holder.start()
+        self.assertTrue(started.wait(10))
+        self.assertTrue(app.redis.exists(lock_var))
+
+        #While the lease is held, callers that don't wait get nothing
+        self.assertIsNone(self.store.get_or_solve(params, solve, wait=False))
+
+        #A caller in another process waits for the holder's result
+        other_process = PolicyStore(LocalPolicyBackend(self.directory),
+                                    poll_interval=0.01)
+        waiter = threading.Thread(target=get_or_solve,
+                                  args=('waiter', other_process))
+        waiter.start()
+        release.set()
+        holder.join(10)
+        waiter.join(10)
+
+        self.assertEqual([1], solves)
+        np.testing.assert_array_equal(results['holder'].values,
+                                      results['waiter'].values)
+        self.assertFalse(app.redis.exists(lock_var))
+
+        #Once stored, nothing is solved again
+        self.assertIsNotNone(other_process.get_or_solve(params, solve))
+        self.assertEqual([1], solves)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+import StringIO
+import numpy as np
 import pomdp
 import pomdp_peng
 
@@ -196,5 +198,68 @@ class POMDPTestCase(unittest.TestCase):
         print "belief =",belief
         print "best action, expected reward = ", policy.get_best_action(belief)
 
+class PBVITestCase(unittest.TestCase):
+    def test_tiger(self):
+        tiger = TigerPOMDP()
+        policy = pomdp.PBVIPOMDP().solve(
+            tiger.states, tiger.actions, tiger.observations,
+            tiger.f_start, tiger.f_transition,
+            tiger.f_observation, tiger.f_reward,
+            discount=0.95, timeout=60)
+        action, reward = policy.get_best_action([0.5, 0.5])
+        self.assertEqual(0, action) # listen
+        action, reward = policy.get_best_action([0.01, 0.99])
+        self.assertEqual(2, action) # open-right
+
+    def test_peng_pomdp(self):
+        # Same beliefs and expectations as the zmdp test above
+        peng_pomdp = pomdp_peng.PengPOMDP(11, 0.5)
+        start, T, O, R = peng_pomdp.model_arrays(0.5, -1, 0, -10)
+        policy = pomdp.PBVIPOMDP().solve_arrays(
+            peng_pomdp.states, peng_pomdp.actions, peng_pomdp.observations,
+            start, T, O, R, discount=0.9999, timeout=60)
+
+        for (entries, expected_action, expected_reward) in [
+                ({0: 0.7, 1: 0.3}, 1, 0.0),
+                ({0: 0.95, 11: 0.05}, 1, -0.5),
+                ({0: 0.8999, 11: 0.1001}, 0, -1.0),
+                ({10: 0.5001, 21: 0.4999}, 1, -4.999)]:
+            belief = [0.0 for i in range(len(peng_pomdp.states))]
+            for (i, p) in entries.iteritems():
+                belief[i] = p
+            action, reward = policy.get_best_action(belief)
+            self.assertEqual(expected_action, action)
+            self.assertAlmostEqual(expected_reward, reward)
+
+class PengModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.peng_pomdp = pomdp_peng.PengPOMDP(11, 0.8)
+        self.rewards = (-1, 0, -10)
+
+    def test_model_arrays(self):
+        # Vectorized model must match the closures
+        p = self.peng_pomdp
+        expected = pomdp.POMDP.closures_to_arrays(
+            p.states, p.actions, p.observations,
+            p.CLOSURE_f_start(len(p.states)), p.f_transition,
+            p.CLOSURE_f_observation(0.8), p.CLOSURE_f_reward(*self.rewards))
+        arrays = p.model_arrays(0.8, *self.rewards)
+        for (a, e) in zip(arrays, expected):
+            np.testing.assert_allclose(a, e)
+
+    def test_write_sparse(self):
+        p = self.peng_pomdp
+        start, T, O, R = p.model_arrays(0.8, *self.rewards)
+        f = StringIO.StringIO()
+        pomdp.ZPOMDP().write_cassandra_arrays(
+            f, p.states, p.actions, p.observations, start, T, O, R, 0.99)
+        lines = f.getvalue().splitlines()
+        self.assertEqual(len([l for l in lines if l.startswith('T:')]),
+                         np.count_nonzero(T))
+        self.assertEqual(len([l for l in lines if l.startswith('O:')]),
+                         np.count_nonzero(O))
+        self.assertEqual(len([l for l in lines if l.startswith('R:')]),
+                         np.count_nonzero(R))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,386 @@
+import unittest
+import shutil
+import tempfile
+import uuid
+import json
+import datetime
+import time
+import bson
+import numpy as np
+import schema
+from app import app
+from decision_table import skill_bucket
+from redis_util import redis_get_task_live_answers_var, redis_get_pomdp_controller_cache_stats_var, redis_get_pomdp_controller_generation_var, redis_get_task_beliefs_var, redis_get_task_belief_skills_var, redis_get_task_belief_answers_var, redis_get_task_belief_votes_var
+from policy_store import PolicyStore, LocalPolicyBackend, policy_key
+from test.test_policy_store import make_policy
+import controllers.pomdp_controller
+from controllers.pomdp_controller import POMDPController, dai_policy_params, policy_grid, preload_policy_grid, POMDPControllerCache, update_question_belief, init_belief, update_belief, NUM_DIFFICULTY_BINS, NUM_ANSWER_CHOICES
+
+class FakeControllerCache(POMDPControllerCache):
+    """
+    Builds placeholder objects instead of solving for a controller.
+    """
+    def build(self, task_id, settings):
+        return object()
+
+class POMDPControllerCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.task_id = str(bson.ObjectId())
+        self.live_answers_var = redis_get_task_live_answers_var(self.task_id)
+        app.redis.set(self.live_answers_var, 10)
+        self.cache = FakeControllerCache(ttl=300, max_new_answers=5,
+                                         max_tasks=2)
+
+    def tearDown(self):
+        app.redis.delete(self.live_answers_var,
+                         redis_get_pomdp_controller_generation_var(
+                             self.task_id))
+
+    def stat(self, event):
+        return int(app.redis.hget(redis_get_pomdp_controller_cache_stats_var(),
+                                  event) or 0)
+
+    def test_hit(self):
+        controller = self.cache.get(self.task_id)
+        hits = self.stat('hits')
+        self.assertIs(controller, self.cache.get(self.task_id))
+        self.assertEqual(hits + 1, self.stat('hits'))
+        self.assertEqual(1, self.cache.stats()['cached_in_process'])
+
+    def test_miss(self):
+        misses = self.stat('misses')
+        controller = self.cache.get(self.task_id)
+        self.assertEqual(misses + 1, self.stat('misses'))
+
+        #Other settings get their own controller
+        other = self.cache.get(self.task_id, {'reward_incorrect' : -100})
+        self.assertIsNot(controller, other)
+        self.assertEqual(misses + 2, self.stat('misses'))
+
+        #The oldest task is evicted past max_tasks
+        self.cache.get(str(bson.ObjectId()))
+        self.assertEqual(2, len(self.cache.entries))
+        self.assertIsNot(controller, self.cache.get(self.task_id))
+
+    def test_ttl_expiry(self):
+        controller = self.cache.get(self.task_id)
+        for entry in self.cache.entries.values():
+            entry['created'] -= 301
+        self.assertIsNot(controller, self.cache.get(self.task_id))
+
+    def test_answer_count(self):
+        controller = self.cache.get(self.task_id)
+        app.redis.incrby(self.live_answers_var, 4)
+        self.assertIs(controller, self.cache.get(self.task_id))
+
+        #max_new_answers new answers since the controller was built
+        app.redis.incrby(self.live_answers_var, 1)
+        rebuilt = self.cache.get(self.task_id)
+        self.assertIsNot(controller, rebuilt)
+
+        #Any decrease, i.e. a requeue
+        app.redis.decr(self.live_answers_var)
+        self.assertIsNot(rebuilt, self.cache.get(self.task_id))
+
+    def test_live_answer_counter_missing(self):
+        #Without the counter, the task's live answers are counted in Mongo
+        app.redis.delete(self.live_answers_var)
+        controller = self.cache.get(self.task_id)
+        self.assertIs(controller, self.cache.get(self.task_id))
+
+    def test_invalidate(self):
+        controller = self.cache.get(self.task_id)
+        other_process = FakeControllerCache(ttl=300, max_new_answers=5,
+                                            max_tasks=2)
+        other_controller = other_process.get(self.task_id)
+
+        self.cache.invalidate(self.task_id)
+        self.assertEqual(0, len(self.cache.entries))
+        self.assertIsNot(controller, self.cache.get(self.task_id))
+        self.assertIsNot(other_controller, other_process.get(self.task_id))
+
+class BeliefStoreTestCase(unittest.TestCase):
+    """
+    Beliefs kept in Redis by update_question_belief and
+    POMDPController.rebuildBeliefs/syncBeliefs.
+    """
+    def setUp(self):
+        self.requester = schema.requester.Requester(
+            email='%s@crowdlab.com' % uuid.uuid1().hex, password='password')
+        self.requester.save()
+        self.task = schema.task.Task(name=uuid.uuid1().hex,
+                                     description='belief store test task',
+                                     requester=self.requester,
+                                     data='')
+        self.task.save()
+        self.questions = []
+        for i in range(2):
+            question = schema.question.Question(name=uuid.uuid1().hex,
+                                                description='question %d' % i,
+                                                data='',
+                                                task=self.task,
+                                                valid_answers=['0', '1'],
+                                                requester=self.requester)
+            question.save()
+            self.questions.append(question)
+        self.workers = []
+        for i in range(3):
+            worker = schema.worker.Worker(platform_id=uuid.uuid1().hex,
+                                          platform_name='mturk')
+            worker.save()
+            self.workers.append(worker)
+
+        #Build the controller without running EM or loading a policy
+        self.controller = POMDPController.__new__(POMDPController)
+        self.controller.task_id = str(self.task.id)
+        self.controller.task = self.task
+        self.controller.skills = {str(self.workers[0].id) : 1.0,
+                                  str(self.workers[1].id) : 2.0}
+        self.controller.average_gamma = 1.5
+        self.controller.num_difficulty_bins = NUM_DIFFICULTY_BINS
+        self.controller.num_answer_choices = NUM_ANSWER_CHOICES
+
+        self.beliefs_var = redis_get_task_beliefs_var(self.task.id)
+        self.skills_var = redis_get_task_belief_skills_var(self.task.id)
+        self.votes_var = redis_get_task_belief_votes_var(self.task.id)
+
+    def tearDown(self):
+        app.redis.delete(self.beliefs_var, self.skills_var, self.votes_var,
+                         redis_get_task_belief_answers_var(self.task.id))
+        schema.answer.Answer.objects(task=self.task).delete()
+        schema.question.Question.objects(task=self.task).delete()
+        for worker in self.workers:
+            worker.delete()
+        self.task.delete()
+        self.requester.delete()
+
+    def add_answer(self, question, worker, value, age=0):
+        answer = schema.answer.Answer(
+            value=value,
+            question=question,
+            task=self.task,
+            worker=worker,
+            status='Completed',
+            complete_time=datetime.datetime.now() -
+            datetime.timedelta(seconds=age))
+        answer.save()
+        return answer
+
+    def stored_beliefs(self):
+        return {q : json.loads(b) for (q, b) in
+                app.redis.hgetall(self.beliefs_var).iteritems()}
+
+    def test_answer_folded_once(self):
+        self.controller.rebuildBeliefs()
+        answer = self.add_answer(self.questions[0], self.workers[0], '1')
+        for delivery in range(2):
+            updated = update_question_belief(self.task.id, answer.id,
+                                             self.questions[0].id,
+                                             self.workers[0].id, '1', 1.0)
+            self.assertEqual(delivery == 0, updated)
+
+        q_id = str(self.questions[0].id)
+        np.testing.assert_allclose(self.stored_beliefs()[q_id],
+                                   update_belief(init_belief(), '1', 1.0))
+        bucket = skill_bucket(1.0, app.config.get(
+            'POLICY_DECISION_TABLE_SKILL_BUCKET', 0.1))
+        self.assertEqual({str(bucket) : [0, 1]},
+                         json.loads(app.redis.hget(self.votes_var, q_id)))
+
+    def test_rebuild_refold_deduplicated(self):
+        #Answers completed just now are both scanned and folded in again
+        for worker in self.workers[:2]:
+            self.add_answer(self.questions[0], worker, '1')
+        self.controller.rebuildBeliefs()
+
+        q_id = str(self.questions[0].id)
+        votes = json.loads(app.redis.hget(self.votes_var, q_id))
+        self.assertEqual(2, sum(sum(count) for count in votes.values()))
+        expected = update_belief(update_belief(init_belief(), '1', 1.0),
+                                 '1', 2.0)
+        np.testing.assert_allclose(self.stored_beliefs()[q_id], expected)
+
+    def test_sync_rebuilds_on_skill_change(self):
+        tolerance = app.config.get('BELIEF_SKILL_TOLERANCE', 0.05)
+        w_id = str(self.workers[0].id)
+        self.add_answer(self.questions[0], self.workers[0], '1', age=3600)
+        self.controller.rebuildBeliefs()
+
+        self.controller.skills[w_id] = 1.0 + tolerance / 2
+        self.controller.syncBeliefs()
+        self.assertEqual(1.0, float(app.redis.hget(self.skills_var, w_id)))
+
+        self.controller.skills[w_id] = 1.0 + tolerance * 2
+        self.controller.syncBeliefs()
+        self.assertEqual(1.0 + tolerance * 2,
+                         float(app.redis.hget(self.skills_var, w_id)))
+
+    def test_sync_ignores_non_binary_workers(self):
+        self.controller.skills[str(self.workers[2].id)] = 0.5
+        self.add_answer(self.questions[0], self.workers[2], 'maybe',
+                        age=3600)
+        self.controller.rebuildBeliefs()
+
+        rebuilds = []
+        self.controller.rebuildBeliefs = lambda: rebuilds.append(1)
+        self.controller.syncBeliefs()
+        self.assertEqual([], rebuilds)
+
+    def test_update_matches_rebuild(self):
+        self.controller.rebuildBeliefs()
+        votes = [(0, 0, '1'), (0, 1, '0'), (1, 2, '1'), (0, 2, '1'),
+                 (1, 0, '0')]
+        for (q, w, value) in votes:
+            answer = self.add_answer(self.questions[q], self.workers[w],
+                                     value, age=3600)
+            update_question_belief(self.task.id, answer.id,
+                                   self.questions[q].id, self.workers[w].id,
+                                   value,
+                                   self.controller.skills.get(
+                                       str(self.workers[w].id)))
+        updated = self.stored_beliefs()
+
+        app.redis.delete(self.beliefs_var, self.skills_var, self.votes_var,
+                         redis_get_task_belief_answers_var(self.task.id))
+        self.controller.rebuildBeliefs()
+        rebuilt = self.stored_beliefs()
+
+        self.assertEqual(set(updated), set(rebuilt))
+        for q_id in updated:
+            np.testing.assert_allclose(updated[q_id], rebuilt[q_id])
+
+    def test_zero_skill(self):
+        self.controller.skills = {str(self.workers[0].id) : 0.0,
+                                  str(self.workers[1].id) : 0.0}
+        self.controller.average_gamma = 0.0
+        self.add_answer(self.questions[0], self.workers[0], '1', age=3600)
+        self.add_answer(self.questions[0], self.workers[1], '0', age=3600)
+        self.controller.rebuildBeliefs()
+        for belief in self.stored_beliefs().values():
+            self.assertTrue(np.all(np.isfinite(belief)))
+
+        answer = self.add_answer(self.questions[1], self.workers[0], '1')
+        update_question_belief(self.task.id, answer.id, self.questions[1].id,
+                               self.workers[0].id, '1', 0.0)
+        answer = self.add_answer(self.questions[1], self.workers[1], '0')
+        update_question_belief(self.task.id, answer.id, self.questions[1].id,
+                               self.workers[1].id, '0', 0.0)
+        for belief in self.stored_beliefs().values():
+            self.assertTrue(np.all(np.isfinite(belief)))
+
+class PolicyFallbackTestCase(unittest.TestCase):
+    """
+    POMDPController.getPolicy/refreshPolicy against a local policy store.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PolicyStore(LocalPolicyBackend(self.directory))
+        self.queued = []
+        self.saved = (controllers.pomdp_controller.policy_store,
+                      controllers.pomdp_controller.queue_policy_solve)
+        controllers.pomdp_controller.policy_store = self.store
+        controllers.pomdp_controller.queue_policy_solve = self.queued.append
+
+        self.controller = POMDPController.__new__(POMDPController)
+        self.controller.average_gamma = 1.3
+        self.controller.reward_incorrect = -50
+        self.controller.discount = 0.9999
+        self.controller.timeout = 300
+        self.controller.policy_is_fallback = False
+        self.controller.policy_checked = 0
+
+    def tearDown(self):
+        (controllers.pomdp_controller.policy_store,
+         controllers.pomdp_controller.queue_policy_solve) = self.saved
+        shutil.rmtree(self.directory)
+
+    def refresh(self):
+        self.controller.policy_checked = 0
+        return self.controller.hasPolicy()
+
+    def test_exact_policy(self):
+        params = self.controller.getPolicyParams()
+        self.store.put(params, make_policy(-1.0))
+        self.assertIsNotNone(self.controller.getPolicy())
+        self.assertFalse(self.controller.policy_is_fallback)
+        self.assertEqual([], self.queued)
+
+    def test_fallback_then_exact(self):
+        params = self.controller.getPolicyParams()
+        self.store.put(dai_policy_params(2.0, -50, 0.9999, 300),
+                       make_policy(-2.0))
+        self.controller.policy = self.controller.getPolicy()
+        self.assertEqual([params], self.queued)
+        self.assertTrue(self.controller.policy_is_fallback)
+        np.testing.assert_array_equal(np.full((3, 3), -2.0),
+                                      self.controller.policy.values)
+
+        #Not switched before POLICY_REFRESH_INTERVAL
+        self.store.put(params, make_policy(-1.0))
+        self.controller.policy_checked = time.time()
+        self.controller.refreshPolicy()
+        self.assertTrue(self.controller.policy_is_fallback)
+
+        self.assertTrue(self.refresh())
+        self.assertFalse(self.controller.policy_is_fallback)
+        np.testing.assert_array_equal(np.full((3, 3), -1.0),
+                                      self.controller.policy.values)
+
+    def test_no_policy_yet(self):
+        #Nothing stored: no policy, and the request does not wait
+        self.controller.policy = self.controller.getPolicy()
+        self.assertIsNone(self.controller.policy)
+        self.assertEqual(1, len(self.queued))
+        self.assertFalse(self.refresh())
+
+        #A nearby policy is picked up while ours is being solved
+        self.store.put(dai_policy_params(2.0, -50, 0.9999, 300),
+                       make_policy(-2.0))
+        self.assertTrue(self.refresh())
+        self.assertTrue(self.controller.policy_is_fallback)
+
+        self.store.put(self.controller.getPolicyParams(), make_policy(-1.0))
+        self.assertTrue(self.refresh())
+        self.assertFalse(self.controller.policy_is_fallback)
+
+class PolicyGridTestCase(unittest.TestCase):
+    grid_settings = {'POLICY_GRID_GAMMAS' : [1.0, 2.0],
+                     'POLICY_GRID_REWARD_INCORRECT' : [-50, -100],
+                     'POLICY_GRID_DISCOUNTS' : [0.9999],
+                     'POLICY_GRID_TIMEOUT' : 300}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PolicyStore(LocalPolicyBackend(self.directory),
+                                 cache_size=1)
+        self.saved_store = controllers.pomdp_controller.policy_store
+        controllers.pomdp_controller.policy_store = self.store
+        self.saved_config = {name : app.config.get(name)
+                             for name in self.grid_settings}
+        app.config.update(self.grid_settings)
+
+    def tearDown(self):
+        controllers.pomdp_controller.policy_store = self.saved_store
+        for (name, value) in self.saved_config.iteritems():
+            if value is None:
+                app.config.pop(name, None)
+            else:
+                app.config[name] = value
+        shutil.rmtree(self.directory)
+
+    def test_preload(self):
+        grid = policy_grid()
+        self.assertEqual(4, len(grid))
+        self.assertEqual(4, len(set(policy_key(params) for params in grid)))
+
+        #Solved by another process, so only in the backend
+        for params in grid[:3]:
+            self.store.backend.put(policy_key(params), make_policy(-1.0),
+                                   params)
+        self.assertEqual(3, preload_policy_grid())
+        self.assertEqual(4, self.store.cache_size)
+        self.assertEqual(set(policy_key(params) for params in grid[:3]),
+                         set(self.store.cache))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pomdp_policy
+import zmdp_util
+
+# Three states, the last one terminal. Planes list only their defined entries.
+ZMDP_POLICY = """# test policy
+{
+  policyType => "MaxPlanesLowerBound",
+  numPlanes => 4,
+  planes => [
+    {
+      action => 0,
+      numEntries => 3,
+      entries => [
+        0, -1.5,
+        1, -1.5,
+        2, 0
+      ]
+    },
+    {
+      action => 1,
+      numEntries => 2,
+      entries => [
+        0, 0,
+        1, -10
+      ]
+    },
+    {
+      action => 2,
+      numEntries => 2,
+      entries => [
+        0, -10,
+        1, 0
+      ]
+    },
+    {
+      action => 1,
+      numEntries => 1,
+      entries => [
+        0, 0.5
+      ]
+    }
+  ]
+}
+"""
+
+class POMDPPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.policy')
+        with open(self.filename, 'w') as f:
+            f.write(ZMDP_POLICY)
+        self.policy = pomdp_policy.POMDPPolicy(self.filename,
+                                               file_format='zmdp',
+                                               n_states=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_action_rewards(self):
+        # Plane 3 is undefined on state 1, so only applies to the first belief
+        self.assertEqual(self.policy.get_action_rewards([1.0, 0.0, 0.0]),
+                         {0: -1.5, 1: 0.5, 2: -10.0})
+        self.assertEqual(self.policy.get_action_rewards([0.5, 0.5, 0.0]),
+                         {0: -1.5, 1: -5.0, 2: -5.0})
+
+    def test_batch(self):
+        beliefs = np.array([[1.0, 0.0, 0.0],
+                            [0.5, 0.5, 0.0],
+                            [0.1, 0.9, 0.0],
+                            [0.0, 0.0, 1.0]])
+        rewards = self.policy.get_action_rewards_batch(beliefs)
+        for (belief, row) in zip(beliefs, rewards):
+            single = self.policy.get_action_rewards(belief)
+            for (a, r) in zip(self.policy.actions, row):
+                self.assertEqual(single.get(a, -np.inf), r)
+
+        best_actions, best_rewards = self.policy.choose_best_actions(rewards)
+        self.assertEqual(list(best_actions[:3]), [1, 0, 2])
+        np.testing.assert_allclose(best_rewards[:3], [0.5, -1.5, -1.0])
+        # Only plane 0 is defined on the terminal state
+        self.assertEqual(best_actions[3], 0)
+
+    def test_parsers_agree(self):
+        actions, alphas = zmdp_util.read_zmdp_policy(self.filename, 3)
+        fast_actions, values, mask = zmdp_util.read_zmdp_policy_arrays(
+            self.filename, 3)
+        self.assertEqual(list(fast_actions), actions)
+        self.assertEqual(values.dtype, np.float64)
+        for (alpha, row, row_mask) in zip(alphas, values, mask):
+            self.assertEqual([a is not None for a in alpha], list(row_mask))
+            self.assertEqual([a if a is not None else 0 for a in alpha],
+                             list(row))
+
+    def test_npz(self):
+        npz_filename = os.path.join(self.directory, 'test.npz')
+        self.policy.save(npz_filename)
+        policy = pomdp_policy.POMDPPolicy(npz_filename, file_format='npz')
+        self.assertIsInstance(policy.pMatrix, np.memmap)
+        self.assertFalse(policy.values.flags.owndata)
+        self.assertEqual(policy.action_nums, self.policy.action_nums)
+        np.testing.assert_array_equal(policy.values, self.policy.values)
+        np.testing.assert_array_equal(policy.mask, self.policy.mask)
+        self.assertEqual(policy.get_action_rewards([0.5, 0.5, 0.0]),
+                         self.policy.get_action_rewards([0.5, 0.5, 0.0]))
+
+    def test_prune(self):
+        # Nothing in the test policy is dominated
+        self.assertEqual(self.policy.prune(), (4, 4))
+
+        values = [[0, -10, 0],   # action 0
+                  [-1, -11, 0],  # dominated by the first
+                  [0, -10, 0],   # duplicate of the first
+                  [-5, -5, 0],   # action 0, best only for beliefs near state 1
+                  [-9, -9, 0]]   # action 1, alone so never pruned
+        mask = np.ones((5, 3), dtype=bool)
+        mask[3, 2] = False  # undefined on the terminal state
+        policy = pomdp_policy.POMDPPolicy.from_arrays([0, 0, 0, 0, 1],
+                                                      values, mask)
+        beliefs = [[0.5, 0.5, 0.0], [0.9, 0.1, 0.0], [0.0, 0.0, 1.0]]
+        expected = [policy.get_action_rewards(b) for b in beliefs]
+
+        self.assertEqual(policy.prune(), (5, 3))
+        self.assertEqual(policy.action_nums, [0, 0, 1])
+        self.assertEqual([policy.get_action_rewards(b) for b in beliefs],
+                         expected)
+
+        # Approximate: only the first vector is best for action 0 here
+        self.assertEqual(policy.prune([[0.9, 0.1, 0.0]]), (3, 2))
+        self.assertEqual(policy.action_nums, [0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
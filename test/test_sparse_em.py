@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from aggregation import sparse_em
+
+class SparseEMTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.skills = rng.uniform(0.3, 3.0, 20)
+        difficulties = rng.uniform(0.05, 0.95, 1000)
+        self.labels = rng.randint(0, 2, 1000)
+        self.workers = np.concatenate([rng.choice(20, 7, replace=False) for
+                                       q in range(1000)])
+        self.questions = np.repeat(np.arange(1000), 7)
+        correct = (rng.random_sample(7000) <
+                   sparse_em.accuracy(difficulties[self.questions],
+                                      self.skills[self.workers]))
+        self.votes = np.where(correct, self.labels[self.questions],
+                              1 - self.labels[self.questions])
+
+    def test_beats_majority_vote(self):
+        posteriors, skills, difficulties = sparse_em.estimate_arrays(
+            self.workers, self.questions, self.votes, 20, 1000)
+        majority = np.bincount(self.questions, weights=self.votes) > 3.5
+        self.assertGreaterEqual(np.mean((posteriors > 0.5) == self.labels),
+                                np.mean(majority == self.labels))
+        self.assertGreater(np.corrcoef(skills, self.skills)[0, 1], 0.5)
+        self.assertTrue(np.all((difficulties > 0) & (difficulties < 1)))
+
+    def test_dicts(self):
+        em_votes = {('w%d' % w, 'q%d' % q) : {'vote' : v} for (w, q, v) in
+                    zip(self.workers, self.questions, self.votes)}
+        em_workers = {'w%d' % w : {'skill' : None} for w in range(20)}
+        em_workers['w0'] = {'skill' : 2.0, 'fixed' : True}
+        em_questions = {'q%d' % q : {'difficulty' : None} for q in range(1000)}
+        res = sparse_em.estimate(em_votes, em_workers, em_questions)
+
+        self.assertEqual(set(res), set(['posteriors', 'workers', 'questions']))
+        self.assertEqual(set(res['workers']), set(em_workers))
+        self.assertEqual(set(res['posteriors']), set(em_questions))
+        self.assertEqual(set(res['questions']), set(em_questions))
+        self.assertEqual(res['workers']['w0'], 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Solve and store every policy of the configured grid ahead of time
+# (POLICY_GRID_* in config.py), so no request has to wait for a solve.
+#
+# Usage from project root dir: python warm_policies.py [--processes N]
+#                                or python warm_policies.py --celery
+# NOTE needs the same environment as the app, i.e. env $(cat .env | xargs)
+
+import argparse
+import multiprocessing
+import sys
+import time
+from controllers.pomdp_controller import policy_grid, solve_dai_policy, warm_policy_grid
+from policy_store import policy_store
+
+def warm(params):
+    """
+    Solve one grid policy unless stored, returns (params, seconds, solved)
+    """
+    start = time.time()
+    solved = []
+    def solve():
+        solved.append(True)
+        return solve_dai_policy(params)
+    policy_store.get_or_solve(params, solve)
+    return params, time.time() - start, len(solved) > 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve and store every policy of the configured grid')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of solvers to run at once')
+    parser.add_argument('--celery', action='store_true',
+                        help='queue the solves on the celery workers instead')
+    args = parser.parse_args()
+
+    if args.celery:
+        print "Queued %d policy solves" % warm_policy_grid()
+        sys.exit(0)
+
+    grid = policy_grid()
+    policy_store.cache_size = max(policy_store.cache_size, len(grid))
+    print "Warming %d policies with %d solvers" % (len(grid), args.processes)
+
+    # PBVI solves in-process, so each solver needs a process of its own
+    pool = multiprocessing.Pool(args.processes)
+    for (i, (params, seconds, solved)) in enumerate(
+            pool.imap_unordered(warm, grid)):
+        print "[%d/%d] gamma=%s reward_incorrect=%s discount=%s %s in %.1fs" % (
+            i + 1, len(grid), params['average_gamma'],
+            params['reward_incorrect'], params['discount'],
+            'solved' if solved else 'already stored', seconds)
+    pool.close()
+    pool.join()
@@ -11,6 +11,7 @@
 import re
 import yaml
 import io
+import numpy as np
 
 def read_zmdp_policy(filename, state_count):
     """
@@ -50,3 +51,87 @@ def read_zmdp_policy(filename, state_count):
 
     yaml_data.close()
     return alpha_vector_actions, alpha_vectors
+
+
+ZMDP_TOKEN = re.compile(r'=>|[{}\[\]]|"[^"]*"|[^\s,{}\[\]"=]+')
+
+def read_zmdp_policy_arrays(filename, state_count):
+    """
+    return actions, values and mask arrays from zMDP policy file
+
+    Streaming alternative to read_zmdp_policy. Entries missing from a
+    plane are 0 in the values matrix and False in the mask.
+
+    arguments:
+        filename
+        state_count
+
+    returns:
+        actions - int array, action of each alpha vector
+        values - float64 (alpha vectors x states) matrix
+        mask - bool (alpha vectors x states) matrix of defined entries
+    """
+    policy_type = None
+    actions, planes = [], []
+    key, action, entries = None, None, None
+    depth = 0
+    in_entries = False
+    expect_value = False
+
+    with open(filename, 'r') as f:
+        for line in f:
+            comment = line.find('#')
+            if comment >= 0:
+                line = line[:comment]
+            #fast path for the bulk of the file: lines of index, value pairs
+            if in_entries and ']' not in line:
+                entries.extend(line.replace(',', ' ').split())
+                continue
+
+            for token in ZMDP_TOKEN.findall(line):
+                if in_entries:
+                    if token == ']':
+                        in_entries = False
+                    else:
+                        entries.append(token)
+                elif token == '=>':
+                    expect_value = True
+                elif expect_value:
+                    expect_value = False
+                    if key == 'entries':
+                        assert token == '[', 'malformed entries'
+                        in_entries = True
+                        entries = []
+                    elif key == 'action':
+                        action = int(token)
+                    elif key == 'policyType':
+                        policy_type = token.strip('"')
+                    elif token == '{':
+                        depth += 1
+                elif token == '{':
+                    depth += 1
+                elif token == '}':
+                    #closing a plane
+                    if depth == 2:
+                        actions.append(action)
+                        planes.append(entries)
+                        action, entries = None, None
+                    depth -= 1
+                elif token not in ('[', ']'):
+                    key = token
+
+    # sanity check
+    assert policy_type == 'MaxPlanesLowerBound', 'unrecognized policy'
+
+    #convert all entries at once, then scatter them into the matrices
+    values = np.zeros((len(planes), state_count), dtype=np.float64)
+    mask = np.zeros((len(planes), state_count), dtype=bool)
+    sizes = [len(entries) // 2 for entries in planes]
+    flat = np.array([e for entries in planes for e in entries],
+                    dtype=np.float64)
+    rows = np.repeat(np.arange(len(planes)), sizes)
+    state_ids = flat[0::2].astype(np.intp)
+    values[rows, state_ids] = flat[1::2]
+    mask[rows, state_ids] = True
+
+    return np.array(actions, dtype=np.int64), values, mask